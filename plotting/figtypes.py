@@ -56,24 +56,65 @@ yaxislabel = \
          r'Absolute transfer entropy (Kernel) (bits)',
      u'directional_transfer_entropy_kernel':
          r'Directional transfer entropy (Kernel) (bits)',
+     u'absolute_transfer_entropy_kernel_native':
+         r'Absolute transfer entropy (Kernel) (bits)',
+     u'directional_transfer_entropy_kernel_native':
+         r'Directional transfer entropy (Kernel) (bits)',
      u'absolute_transfer_entropy_kraskov':
          r'Absolute transfer entropy (Kraskov) (bits)',
      u'directional_transfer_entropy_kraskov':
-         r'Directional transfer entropy (Kraskov) (bits)'}
+         r'Directional transfer entropy (Kraskov) (bits)',
+     u'absolute_transfer_entropy_kraskov_native':
+         r'Absolute transfer entropy (Kraskov) (bits)',
+     u'directional_transfer_entropy_kraskov_native':
+         r'Directional transfer entropy (Kraskov) (bits)',
+     u'absolute_transfer_entropy_gaussian':
+         r'Absolute transfer entropy (Gaussian) (bits)',
+     u'directional_transfer_entropy_gaussian':
+         r'Directional transfer entropy (Gaussian) (bits)',
+     u'absolute_transfer_entropy_discrete_native':
+         r'Absolute transfer entropy (Discrete) (bits)',
+     u'directional_transfer_entropy_discrete_native':
+         r'Directional transfer entropy (Discrete) (bits)'}
 
 linelabels = \
     {'cross_correlation': r'Correlation',
      'absolute_transfer_entropy_kernel': r'Absolute TE (Kernel)',
      'directional_transfer_entropy_kernel': r'Directional TE (Kernel)',
+     'absolute_transfer_entropy_kernel_native': r'Absolute TE (Kernel)',
+     'directional_transfer_entropy_kernel_native':
+         r'Directional TE (Kernel)',
      'absolute_transfer_entropy_kraskov': r'Absolute TE (Kraskov)',
-     'directional_transfer_entropy_kraskov': r'Directional TE (Kraskov)'}
+     'directional_transfer_entropy_kraskov': r'Directional TE (Kraskov)',
+     'absolute_transfer_entropy_kraskov_native': r'Absolute TE (Kraskov)',
+     'directional_transfer_entropy_kraskov_native':
+         r'Directional TE (Kraskov)',
+     'absolute_transfer_entropy_gaussian': r'Absolute TE (Gaussian)',
+     'directional_transfer_entropy_gaussian': r'Directional TE (Gaussian)',
+     'absolute_transfer_entropy_discrete_native': r'Absolute TE (Discrete)',
+     'directional_transfer_entropy_discrete_native':
+         r'Directional TE (Discrete)'}
 
 fitlinelabels = \
     {'cross_correlation': r'Correlation fit',
      'absolute_transfer_entropy_kernel': r'Absolute TE (Kernel) fit',
      'directional_transfer_entropy_kernel': r'Directional TE (Kernel) fit',
+     'absolute_transfer_entropy_kernel_native': r'Absolute TE (Kernel) fit',
+     'directional_transfer_entropy_kernel_native':
+         r'Directional TE (Kernel) fit',
      'absolute_transfer_entropy_kraskov': r'Absolute TE (Kraskov) fit',
-     'directional_transfer_entropy_kraskov': r'Directional TE (Kraskov) fit'}
+     'directional_transfer_entropy_kraskov': r'Directional TE (Kraskov) fit',
+     'absolute_transfer_entropy_kraskov_native':
+         r'Absolute TE (Kraskov) fit',
+     'directional_transfer_entropy_kraskov_native':
+         r'Directional TE (Kraskov) fit',
+     'absolute_transfer_entropy_gaussian': r'Absolute TE (Gaussian) fit',
+     'directional_transfer_entropy_gaussian':
+         r'Directional TE (Gaussian) fit',
+     'absolute_transfer_entropy_discrete_native':
+         r'Absolute TE (Discrete) fit',
+     'directional_transfer_entropy_discrete_native':
+         r'Directional TE (Discrete) fit'}
 
 
 def fig_timeseries(graphdata, graph, scenario, savedir):
@@ -4,9 +4,11 @@
 """
 
 import csv
+import hashlib
 import json
 import logging
 import os
+from collections import OrderedDict
 
 import matplotlib.pyplot as plt
 import networkx as nx
@@ -14,26 +16,16 @@ import numpy as np
 import pandas as pd
 import sklearn.preprocessing
 import tables as tb
-from numba import jit
 
 import config_setup
 import gaincalc
 import transentropy
 
-
-@jit
-def shuffle_data(input_data):
-    """Returns a (seeded) randomly shuffled array of data.
-    The data input needs to be a two-dimensional numpy array.
-
-    """
-
-    shuffled = np.random.permutation(input_data)
-
-    shuffled_formatted = np.zeros((1, len(shuffled)))
-    shuffled_formatted[0, :] = shuffled
-
-    return shuffled_formatted
+# Per-process cache of surrogate arrays in least recently used order
+surr_cache = OrderedDict()
+# Counters used to monitor the effectiveness of the surrogate cache, and the
+# running total of the bytes held by its entries
+surr_cache_stats = {'hits': 0, 'misses': 0, 'bytes': 0}
 
 
 def getfolders(path):
@@ -54,35 +46,186 @@ def getfolders(path):
     return folders
 
 
-@jit
-def gen_iaaft_surrogates(data, iterations):
-    """Generates iAAFT surrogates
+def gen_iaaft_surrogates_batch(data, num, seed=None, tolerance=1e-3,
+                               max_iterations=100):
+    """Generates a batch of iAAFT surrogates of a univariate signal.
+
+    All surrogates are iterated together as the rows of a two-dimensional
+    array, using row-wise FFTs and a vectorised rank-reorder. Each row is
+    iterated until the relative change in its spectrum error between
+    successive iterations falls below the tolerance (Schreiber2000a), or
+    until the maximum number of iterations is reached.
+
+    Parameters
+    ----------
+        data : one-dimensional numpy.ndarray
+            The signal to generate surrogates of.
+        num : int
+            The number of surrogates to generate.
+        seed : int, optional
+            Seed of the random starting permutations, making the surrogates
+            reproducible.
+        tolerance : float, default=1e-3
+            Relative change in the spectrum error below which a surrogate is
+            considered converged.
+        max_iterations : int, default=100
+            Maximum number of iterations for any surrogate.
+
+    Returns
+    -------
+        surrogates : numpy.ndarray
+            Array of shape (num, len(data)) with one surrogate per row.
+
+    """
+    data = np.asarray(data, dtype=float).ravel()
+    samples = len(data)
+    randomstate = np.random.RandomState(seed)
+
+    # Sorted amplitudes and Fourier amplitudes of the original signal
+    sorted_data = np.sort(data)
+    amplitudes = np.abs(np.fft.rfft(data))
+
+    # Random permutations as starting points
+    surrogates = data[randomstate.rand(num, samples).argsort(axis=1)]
+
+    active = np.arange(num)
+    previous_error = np.empty(num)
+    previous_error.fill(np.inf)
+
+    for iteration in range(max_iterations):
+        spectra = np.fft.rfft(surrogates[active], axis=1)
+        error = np.sqrt(np.mean(
+            (np.abs(spectra) - amplitudes) ** 2, axis=1))
+
+        # Impose the amplitude spectrum of the original signal
+        adjusted = np.fft.irfft(amplitudes * np.exp(1j * np.angle(spectra)),
+                                n=samples, axis=1)
+        # Impose the amplitude distribution of the original signal
+        ranks = adjusted.argsort(axis=1)
+        reordered = np.empty_like(adjusted)
+        reordered[np.arange(len(active))[:, np.newaxis], ranks] = \
+            sorted_data
+        surrogates[active] = reordered
+
+        converged = (np.abs(previous_error[active] - error) <=
+                     tolerance * error)
+        previous_error[active] = error
+        active = active[~converged]
+        if len(active) == 0:
+            break
+
+    return surrogates
+
+
+def gen_surrogates(data, num, method, seed=None):
+    """Generates a batch of surrogates of a univariate signal.
+
+    Parameters
+    ----------
+        data : one-dimensional numpy.ndarray
+            The signal to generate surrogates of.
+        num : int
+            The number of surrogates to generate.
+        method : str
+            Either 'iAAFT' or 'random_shuffle'.
+        seed : int, optional
+            Seed making the surrogates reproducible.
+
+    Returns
+    -------
+        surrogates : numpy.ndarray
+            Array of shape (num, len(data)) with one surrogate per row.
+            The first rows of a larger batch equal a smaller batch generated
+            with the same seed.
+
+    """
+    if method == 'iAAFT':
+        return gen_iaaft_surrogates_batch(data, num, seed)
+    elif method == 'random_shuffle':
+        data = np.asarray(data, dtype=float).ravel()
+        randomstate = np.random.RandomState(seed)
+        return data[randomstate.rand(num, len(data)).argsort(axis=1)]
+    else:
+        raise NameError("Surrogate generation method not recognized")
+
+
+def get_surrogates(data, num, method, seed=None, key=None,
+                   max_megabytes=256):
+    """Returns a batch of surrogates of a univariate signal, making use of
+    the surrogate cache of this process if a key is provided.
+
+    Cached surrogates are reused for any request of the same or a smaller
+    number of surrogates. The least recently used entries are evicted once
+    the cache exceeds its memory cap.
+
+    Parameters
+    ----------
+        key : tuple, optional
+            Identifies the signal, typically (variable, box, startindex,
+            size). The method, seed and a digest of the data are added to
+            the key so that a key can never return surrogates of different
+            data.
+        max_megabytes : float, default=256
+            Memory cap of the cache.
+
+    Other parameters are as for gen_surrogates.
 
     """
-    # Make copy to  prevent rotation of array
-    data_f = data.copy()
-#    start_time = time.clock()
-    xs = data_f.copy()
-    # sorted amplitude stored
-    xs.sort()
-    # amplitude of fourier transform of orig
-    pwx = np.abs(np.fft.fft(data_f))
+    if key is None:
+        return gen_surrogates(data, num, method, seed)
 
-    data_f.shape = (-1, 1)
-    # random permutation as starting point
-    xsur = np.random.permutation(data_f)
-    xsur.shape = (1, -1)
+    data = np.ascontiguousarray(data, dtype=float)
+    key = tuple(key) + (method, seed,
+                        hashlib.sha1(data.tobytes()).hexdigest())
 
-    for i in range(iterations):
-        fftsurx = pwx*np.exp(1j*np.angle(np.fft.fft(xsur)))
-        xoutb = np.real(np.fft.ifft(fftsurx))
-        ranks = xoutb.argsort(axis=1)
-        xsur[:, ranks] = xs
+    if key in surr_cache and len(surr_cache[key]) >= num:
+        surr_cache_stats['hits'] += 1
+        # Mark as most recently used
+        surrogates = surr_cache.pop(key)
+        surr_cache[key] = surrogates
+        return surrogates[:num]
 
-#    end_time = time.clock()
-#    logging.info("Time to generate surrogates: " + str(end_time - start_time))
+    surr_cache_stats['misses'] += 1
+    surrogates = gen_surrogates(data, num, method, seed)
 
-    return(xsur)
+    if key in surr_cache:
+        surr_cache_stats['bytes'] -= surr_cache.pop(key).nbytes
+    max_bytes = max_megabytes * 2**20
+    if surrogates.nbytes <= max_bytes:
+        surr_cache[key] = surrogates
+        surr_cache_stats['bytes'] += surrogates.nbytes
+        while surr_cache_stats['bytes'] > max_bytes:
+            _, evicted = surr_cache.popitem(last=False)
+            surr_cache_stats['bytes'] -= evicted.nbytes
+
+    return surrogates
+
+
+def surr_cache_info():
+    """Returns the number of hits and misses of the surrogate cache of this
+    process, as well as the resulting hit rate, number of entries and memory
+    used in megabytes.
+
+    """
+    hits = surr_cache_stats['hits']
+    misses = surr_cache_stats['misses']
+    if hits + misses > 0:
+        hit_rate = float(hits) / (hits + misses)
+    else:
+        hit_rate = None
+
+    megabytes = surr_cache_stats['bytes'] / 2.**20
+
+    return {'hits': hits, 'misses': misses, 'hit_rate': hit_rate,
+            'size': len(surr_cache), 'megabytes': megabytes}
+
+
+def clear_surr_cache():
+    """Removes all surrogates from the cache and resets the counters."""
+    surr_cache.clear()
+    surr_cache_stats['hits'] = 0
+    surr_cache_stats['misses'] = 0
+    surr_cache_stats['bytes'] = 0
 
 
 class ResultReconstructionData:
@@ -1254,33 +1397,42 @@ def split_tsdata(inputdata, samplerate, boxsize, boxnum):
 
 
     """
-    # Get total number of samples
-    samples = len(inputdata)
-#    print "Number of samples: ", samples
-    # Convert boxsize to number of samples
-    boxsizesamples = int(round(boxsize / samplerate))
-#    print "Box size in samples: ", boxsizesamples
-    # Calculate starting index for each box
-
     if boxnum == 1:
         boxes = [inputdata]
 
     else:
-        boxstartindex = np.empty((1, boxnum))[0]
-        boxstartindex[:] = np.NAN
-        boxstartindex[0] = 0
-        boxstartindex[-1] = samples - boxsizesamples
-        samplesbetween = \
-            ((float(samples - boxsizesamples)) / float(boxnum - 1))
-        boxstartindex[1:-1] = [round(samplesbetween * index)
-                               for index in range(1, boxnum-1)]
-        boxes = [inputdata[int(boxstartindex[i]):int(boxstartindex[i]) +
-                           int(boxsizesamples)]
+        # Convert boxsize to number of samples
+        boxsizesamples = int(round(boxsize / samplerate))
+        boxstartindex = box_startindexes(len(inputdata), samplerate,
+                                         boxsize, boxnum)
+        boxes = [inputdata[boxstartindex[i]:boxstartindex[i] +
+                           boxsizesamples]
                  for i in range(int(boxnum))]
 
     return boxes
 
 
+def box_startindexes(samples, samplerate, boxsize, boxnum):
+    """Returns the index of the first sample of each box that split_tsdata
+    cuts from a dataset of the given number of samples."""
+    if boxnum == 1:
+        return [0]
+
+    # Convert boxsize to number of samples
+    boxsizesamples = int(round(boxsize / samplerate))
+    # Calculate starting index for each box
+    boxstartindex = np.empty((1, boxnum))[0]
+    boxstartindex[:] = np.NAN
+    boxstartindex[0] = 0
+    boxstartindex[-1] = samples - boxsizesamples
+    samplesbetween = \
+        ((float(samples - boxsizesamples)) / float(boxnum - 1))
+    boxstartindex[1:-1] = [round(samplesbetween * index)
+                           for index in range(1, boxnum-1)]
+
+    return [int(startindex) for startindex in boxstartindex]
+
+
 def calc_signalent(vardata, weightcalcdata):
     """Calculates single signal differential entropies
     by making use of the JIDT continuous box-kernel implementation.
@@ -26,6 +26,8 @@ import json
 import logging
 import multiprocessing
 import os
+import shutil
+import tempfile
 import time
 
 import h5py
@@ -35,8 +37,21 @@ import config_setup
 import data_processing
 import datagen
 import gaincalc_oneset
+import transentropy
 from gaincalculators import (PartialCorrWeightcalc, CorrWeightcalc,
-                             TransentWeightcalc)
+                             TransentWeightcalc, analytic_estimators)
+
+
+# Weight calculation methods that make use of JIDT
+jidt_methods = ['transfer_entropy_kernel',
+                'transfer_entropy_kraskov',
+                'transfer_entropy_discrete']
+
+
+# Settings that only affect the significance stage and not the weights
+significance_settings = ['sigtest', 'te_thresh_method', 'te_surr_method',
+                         'te_thresh_mode', 'allthresh', 'thresh_delay_step',
+                         'surr_seed', 'surr_cache_size', 'surr_threads']
 
 
 class WeightcalcData(object):
@@ -82,8 +97,16 @@ class WeightcalcData(object):
         self.scenarios = self.caseconfig['scenarios']
         # Get methods
         self.methods = self.caseconfig['methods']
+        # Get JVM settings used by JIDT
+        if 'jvm' in self.caseconfig:
+            self.jvm_settings = self.caseconfig['jvm']
+        else:
+            self.jvm_settings = {}
+        transentropy.configure_jvm(**self.jvm_settings)
 
         self.do_multiprocessing = do_multiprocessing
+        # Number of worker processes sharing the cores, set by weightcalc
+        self.numworkers = 1
 
         self.casename = case
 
@@ -126,17 +149,61 @@ class WeightcalcData(object):
         self.sigtest = self.caseconfig[settings_name]['sigtest']
         if self.sigtest:
             # The transfer entropy threshold calculation method be either
-            # 'sixsigma' or 'rankorder'
+            # 'sixsigma', 'rankorder' or 'analytic' (linear-Gaussian only)
             self.te_thresh_method = \
                 self.caseconfig[settings_name]['te_thresh_method']
             # The transfer entropy surrogate generation method be either
             # 'iAAFT' or 'random_shuffle'
-            self.te_surr_method = \
-                self.caseconfig[settings_name]['te_surr_method']
+            if 'te_surr_method' in self.caseconfig[settings_name]:
+                self.te_surr_method = \
+                    self.caseconfig[settings_name]['te_surr_method']
+            else:
+                # Not required by the analytic threshold method
+                self.te_surr_method = None
+            # Analytic thresholds are meaningless for other estimators
+            if self.te_thresh_method == 'analytic':
+                for method in self.methods:
+                    if (method[:16] == 'transfer_entropy' and
+                            method[17:] not in analytic_estimators):
+                        raise ValueError(
+                            "Analytic thresholds do not apply to method " +
+                            method)
+        # The rank-order threshold mode can be either 'full' to evaluate all
+        # surrogates or 'sequential' to stop once the test is decided
+        if 'te_thresh_mode' in self.caseconfig[settings_name]:
+            self.te_thresh_mode = \
+                self.caseconfig[settings_name]['te_thresh_mode']
+        else:
+            self.te_thresh_mode = 'full'
         if 'allthresh' in self.caseconfig[settings_name]:
             self.allthresh = self.caseconfig[settings_name]['allthresh']
         else:
             self.allthresh = False
+        # With allthresh, thresholds can be calculated at every delay step
+        # (and at the best delays) only and interpolated in between
+        if 'thresh_delay_step' in self.caseconfig[settings_name]:
+            self.thresh_delay_step = \
+                self.caseconfig[settings_name]['thresh_delay_step']
+        else:
+            self.thresh_delay_step = 1
+        # Seed of the surrogate generator, making thresholds reproducible
+        # regardless of the number of workers and surrogate threads unless
+        # explicitly set to null
+        if 'surr_seed' in self.caseconfig[settings_name]:
+            self.surr_seed = self.caseconfig[settings_name]['surr_seed']
+        else:
+            self.surr_seed = 0
+        # Memory cap of the surrogate cache of each process in megabytes
+        if 'surr_cache_size' in self.caseconfig[settings_name]:
+            self.surr_cache_size = \
+                self.caseconfig[settings_name]['surr_cache_size']
+        else:
+            self.surr_cache_size = 256
+        # Number of threads used to evaluate surrogates within each process
+        if 'surr_threads' in self.caseconfig[settings_name]:
+            self.surr_threads = self.caseconfig[settings_name]['surr_threads']
+        else:
+            self.surr_threads = 1
 
         # Get sampling rate and unit name
         self.sampling_rate = (self.caseconfig[settings_name]
@@ -149,13 +216,97 @@ class WeightcalcData(object):
         else:
             self.startindex = 0
 
+        # Get the scheduler, either 'causevar' to run one task per causevar
+        # or 'tasks' to split the work into (causevar, affectedvar, delay
+        # block) tasks that are scheduled longest first
+        if 'scheduler' in self.caseconfig[settings_name]:
+            self.scheduler = self.caseconfig[settings_name]['scheduler']
+        else:
+            self.scheduler = 'causevar'
+
+        # Get the correlation engine, either 'box' to evaluate all pairs of
+        # a box at once or 'pair' to evaluate each pair separately.
+        # Also applies to the linear-Gaussian and native discrete transfer
+        # entropy estimators.
+        if 'correlation_engine' in self.caseconfig[settings_name]:
+            self.correlation_engine = \
+                self.caseconfig[settings_name]['correlation_engine']
+        else:
+            self.correlation_engine = 'box'
+
+        # Get the delay search, either 'full' to evaluate the weights at all
+        # delays or 'coarse_to_fine' to evaluate them on a grid of every
+        # delay_search_stride-th delay and then at all delays around the
+        # delay_search_peaks largest weights of the grid
+        if 'delay_search' in self.caseconfig[settings_name]:
+            self.delay_search = self.caseconfig[settings_name]['delay_search']
+        else:
+            self.delay_search = 'full'
+        if 'delay_search_stride' in self.caseconfig[settings_name]:
+            self.delay_search_stride = \
+                self.caseconfig[settings_name]['delay_search_stride']
+        else:
+            self.delay_search_stride = 10
+        if 'delay_search_peaks' in self.caseconfig[settings_name]:
+            self.delay_search_peaks = \
+                self.caseconfig[settings_name]['delay_search_peaks']
+        else:
+            self.delay_search_peaks = 3
+
+        # Calculate the transfer entropy only at the te_prescreen_delays
+        # delays of largest correlation magnitude and the delays within
+        # te_prescreen_radius of them, if set
+        if 'te_prescreen_delays' in self.caseconfig[settings_name]:
+            self.te_prescreen_delays = \
+                self.caseconfig[settings_name]['te_prescreen_delays']
+        else:
+            self.te_prescreen_delays = None
+        if 'te_prescreen_radius' in self.caseconfig[settings_name]:
+            self.te_prescreen_radius = \
+                self.caseconfig[settings_name]['te_prescreen_radius']
+        else:
+            self.te_prescreen_radius = 2
+
+        # Calculate the local transfer entropy over the full record once for
+        # every pair and delay and average it over the boxes, rather than
+        # estimating the transfer entropy in every box from scratch
+        if 'local_te' in self.caseconfig[settings_name]:
+            self.local_te = self.caseconfig[settings_name]['local_te']
+        else:
+            self.local_te = False
+        # Largest size in MB of the stored cumulative sums of the local
+        # transfer entropies
+        if 'local_te_store_limit' in self.caseconfig[settings_name]:
+            self.local_te_store_limit = \
+                self.caseconfig[settings_name]['local_te_store_limit']
+        else:
+            self.local_te_store_limit = 1024
+
         # Get parameters for Kraskov method
-        if 'transfer_entropy_kraskov' in self.methods:
+        if ('transfer_entropy_kraskov' in self.methods or
+                'transfer_entropy_kraskov_native' in self.methods):
             self.additional_parameters = \
                 self.caseconfig[settings_name]['additional_parameters']
 
+        # Get optional parameters for linear-Gaussian and discrete methods
+        if ('transfer_entropy_gaussian' in self.methods or
+                'transfer_entropy_discrete' in self.methods or
+                'transfer_entropy_discrete_native' in self.methods):
+            if 'additional_parameters' in self.caseconfig[settings_name]:
+                self.additional_parameters = \
+                    self.caseconfig[settings_name]['additional_parameters']
+            else:
+                self.additional_parameters = {}
+
+        # Get the number of threads of each JIDT Kraskov estimate
+        if 'transfer_entropy_kraskov' in self.methods:
+            self.estimator_threads = estimator_threads(
+                self.additional_parameters.get('estimator_threads'),
+                self.numworkers, self.surr_threads)
+
         # Get parameters for kernel method
-        if 'transfer_entropy_kernel' in self.methods:
+        if ('transfer_entropy_kernel' in self.methods or
+                'transfer_entropy_kernel_native' in self.methods):
             if 'kernel_width' in self.caseconfig[settings_name]:
                 self.kernel_width = \
                     self.caseconfig[settings_name]['kernel_width']
@@ -339,6 +490,11 @@ class WeightcalcData(object):
         self.boxes = data_processing.split_tsdata(
             self.inputdata, self.sampling_rate * self.sub_sampling_interval,
             self.boxsize, self.boxnum)
+        # Positions of the boxes in inputdata
+        self.boxstartindexes = data_processing.box_startindexes(
+            len(self.inputdata),
+            self.sampling_rate * self.sub_sampling_interval,
+            self.boxsize, self.boxnum)
 
         # Select which of the boxes to evaluate
         if self.transient:
@@ -397,7 +553,8 @@ def writecsv_weightcalc(filename, items, header):
         csv.writer(f).writerows(items)
 
 
-def calc_weights(weightcalcdata, method, scenario, writeoutput):
+def calc_weights(weightcalcdata, method, scenario, writeoutput, pool=None,
+                 weightstore=None):
     """Determines the maximum weight between two variables by searching through
     a specified set of delays.
 
@@ -408,7 +565,24 @@ def calc_weights(weightcalcdata, method, scenario, writeoutput):
         'cross_correlation'
         'partial_correlation' -- does not support time delays
         'transfer_entropy_kernel'
+        'transfer_entropy_kernel_native' -- kernel estimator that runs
+        without JIDT
         'transfer_entropy_kraskov'
+        'transfer_entropy_kraskov_native' -- Kraskov estimator that runs
+        without JIDT
+        'transfer_entropy_gaussian' -- linear-Gaussian estimator, evaluated
+        for all pairs of a box at once unless auto-embedding is used
+        'transfer_entropy_discrete'
+        'transfer_entropy_discrete_native' -- discrete estimator that
+        quantises the data into base levels and is evaluated for all pairs
+        of a box at once
+        pool : WorkerPool, optional
+        Worker pool on which the weights are calculated. The weights are
+        calculated in the current process if not provided.
+        weightstore : dict, optional
+        Weights of a previous settings entry that only differs in its
+        significance settings, keyed by box index, which are reused instead
+        of calculated again. Empty entries are filled for later use.
 
     TODO: Fix partial correlation method to make use of time delays
 
@@ -418,10 +592,21 @@ def calc_weights(weightcalcdata, method, scenario, writeoutput):
         weightcalculator = CorrWeightcalc(weightcalcdata)
     elif method == 'transfer_entropy_kernel':
         weightcalculator = TransentWeightcalc(weightcalcdata, 'kernel')
+    elif method == 'transfer_entropy_kernel_native':
+        weightcalculator = TransentWeightcalc(weightcalcdata,
+                                              'kernel_native')
     elif method == 'transfer_entropy_kraskov':
         weightcalculator = TransentWeightcalc(weightcalcdata, 'kraskov')
+    elif method == 'transfer_entropy_kraskov_native':
+        weightcalculator = TransentWeightcalc(weightcalcdata,
+                                              'kraskov_native')
     elif method == 'transfer_entropy_discrete':
         weightcalculator = TransentWeightcalc(weightcalcdata, 'discrete')
+    elif method == 'transfer_entropy_gaussian':
+        weightcalculator = TransentWeightcalc(weightcalcdata, 'gaussian')
+    elif method == 'transfer_entropy_discrete_native':
+        weightcalculator = TransentWeightcalc(weightcalcdata,
+                                              'discrete_native')
     elif method == 'partial_correlation':
         weightcalculator = PartialCorrWeightcalc(weightcalcdata)
 
@@ -430,8 +615,10 @@ def calc_weights(weightcalcdata, method, scenario, writeoutput):
     elif not weightcalcdata.sigtest:
         sigstatus = 'nosigtest'
 
-    if method == 'transfer_entropy_kraskov':
-        if weightcalcdata.additional_parameters['auto_embed']:
+    if method in ['transfer_entropy_kraskov',
+                  'transfer_entropy_kraskov_native',
+                  'transfer_entropy_gaussian']:
+        if weightcalcdata.additional_parameters.get('auto_embed', False):
             embedstatus = 'autoembedding'
         else:
             embedstatus = 'naive'
@@ -506,59 +693,231 @@ def calc_weights(weightcalcdata, method, scenario, writeoutput):
         signalent_filename_template = \
             os.path.join(signalentstoredir, '{}_{}_{}_box{:03d}.csv')
 
-    for boxindex in weightcalcdata.boxindexes:
-        box = weightcalcdata.boxes[boxindex]
-
-        # Calculate single signal entropies - do not worry about
-        # delays, but still do it according to different boxes
-        if weightcalcdata.single_entropies:
-            # Calculate single signal entropies of all variables
-            # and save output in similar format to
-            # standard weight calculation results
-            signalentlist = []
-            for varindex, _ in enumerate(weightcalcdata.variables):
-                vardata = box[:, varindex][startindex:startindex+size]
-                entropy = data_processing.calc_signalent(vardata,
-                                                         weightcalcdata)
-                signalentlist.append(entropy)
-
-            # Write the signal entropies to file - one file for each box
-            # Each file will only have one line as we are not
-            # calculating for different delays as is done for the case of
-            # variable pairs.
-
-            # Need to add another axis to signalentlist in order to make
-            # it a sequence so that it can work with writecsv_weightcalc
-            signalentlist = np.asarray(signalentlist)
-            signalentlist = \
-                signalentlist[np.newaxis, :]
-
-            writecsv_weightcalc(signalent_filename(
-                'signal_entropy',
-                boxindex+1),
-                signalentlist, signalent_headerline)
-
-        # Start parallelising code here
-        # Create one process for each causevarindex
-
-        ###########################################################
-
-        non_iter_args = [
-            weightcalcdata, weightcalculator,
-            box, startindex, size,
-            newconnectionmatrix,
-            method, boxindex,
-            filename, headerline, writeoutput]
-
-        # Run the script that will handle multiprocessing
-        gaincalc_oneset.run(non_iter_args,
-                            weightcalcdata.do_multiprocessing)
-
-        ########################################################
+    # Workers receive the box data through memory-mapped files instead of
+    # having the complete data sets pickled along with every task
+    if pool is not None:
+        storedir = tempfile.mkdtemp(prefix='weightcalc_')
+        sharedinputdata = gaincalc_oneset.publish_array(
+            weightcalcdata.inputdata, storedir)
+        workerdata = gaincalc_oneset.worker_weightcalcdata(
+            weightcalcdata, sharedinputdata)
+
+    try:
+        # Local transfer entropies are calculated over the complete data
+        # once and averaged over every box
+        if weightcalcdata.local_te and method[:16] == 'transfer_entropy':
+            inputdata = weightcalcdata.inputdata
+            weightcalculator.set_boxembeddings(weightcalcdata, inputdata,
+                                               0, len(inputdata))
+            localstore = gaincalc_oneset.calc_local_store(
+                weightcalcdata, weightcalculator, newconnectionmatrix,
+                config_setup.ensure_existence(
+                    os.path.join(weightstoredir, 'local_te'), make=True),
+                pool)
+        else:
+            localstore = None
+
+        for boxindex in weightcalcdata.boxindexes:
+            box = weightcalcdata.boxes[boxindex]
+
+            # Calculate single signal entropies - do not worry about
+            # delays, but still do it according to different boxes
+            if weightcalcdata.single_entropies:
+                # Calculate single signal entropies of all variables
+                # and save output in similar format to
+                # standard weight calculation results
+                signalentlist = []
+                for varindex, _ in enumerate(weightcalcdata.variables):
+                    vardata = box[:, varindex][startindex:startindex+size]
+                    entropy = data_processing.calc_signalent(vardata,
+                                                             weightcalcdata)
+                    signalentlist.append(entropy)
+
+                # Write the signal entropies to file - one file for each box
+                # Each file will only have one line as we are not
+                # calculating for different delays as is done for the case of
+                # variable pairs.
+
+                # Need to add another axis to signalentlist in order to make
+                # it a sequence so that it can work with writecsv_weightcalc
+                signalentlist = np.asarray(signalentlist)
+                signalentlist = \
+                    signalentlist[np.newaxis, :]
+
+                writecsv_weightcalc(signalent_filename(
+                    'signal_entropy',
+                    boxindex+1),
+                    signalentlist, signalent_headerline)
+
+            if localstore is not None:
+                # Average the local transfer entropies over the box, using
+                # the embeddings searched over the complete data
+                windowstart = \
+                    weightcalcdata.boxstartindexes[boxindex] + startindex
+                weightcalculator.set_localweights(localstore, windowstart,
+                                                  windowstart + size)
+            else:
+                # Run the auto-embedding search once for every variable of
+                # the box rather than for every pair, delay and surrogate
+                if method[:16] == 'transfer_entropy':
+                    weightcalculator.set_boxembeddings(weightcalcdata, box,
+                                                       startindex, size)
+
+                # Evaluate all correlation, linear-Gaussian and native
+                # discrete transfer entropy weights of the box at once
+                if ((method in ['cross_correlation',
+                                'transfer_entropy_gaussian',
+                                'transfer_entropy_discrete_native']) and
+                        (weightcalcdata.correlation_engine == 'box')):
+                    weightcalculator.set_boxweights(weightcalcdata, box,
+                                                    startindex, size)
+
+            # Correlate all pairs of the box at all delays to select the
+            # delays at which the transfer entropy is calculated
+            if method[:16] == 'transfer_entropy':
+                weightcalculator.set_prescreen(weightcalcdata, box,
+                                               startindex, size)
+
+            # Start parallelising code here
+            # Create one process for each causevarindex
+
+            ###########################################################
+
+            if pool is not None:
+                sharedbox = gaincalc_oneset.publish_array(box, storedir)
+                # The box tensors are shared in the same way rather than
+                # pickled along with the calculator for every task
+                workercalculator = gaincalc_oneset.worker_weightcalculator(
+                    weightcalculator, storedir)
+                non_iter_args = [
+                    workerdata, workercalculator,
+                    sharedbox, startindex, size,
+                    newconnectionmatrix,
+                    method, boxindex,
+                    filename, headerline, writeoutput]
+            else:
+                non_iter_args = [
+                    weightcalcdata, weightcalculator,
+                    box, startindex, size,
+                    newconnectionmatrix,
+                    method, boxindex,
+                    filename, headerline, writeoutput]
+
+            # Run the script that will handle multiprocessing
+            if weightstore is not None:
+                boxweightstore = weightstore.setdefault(boxindex, {})
+            else:
+                boxweightstore = None
+
+            gaincalc_oneset.run(non_iter_args, pool, boxweightstore)
+
+            if pool is not None:
+                gaincalc_oneset.unpublish_array(sharedbox)
+                gaincalc_oneset.unpublish_weightcalculator(workercalculator)
+
+            ########################################################
+
+    finally:
+        if pool is not None:
+            shutil.rmtree(storedir, ignore_errors=True)
 
     return None
 
 
+def plan_settings_sweep(caseconfig, settings_set):
+    """Groups the settings of a scenario that only differ in settings of the
+    significance stage, so that their weights only need to be calculated
+    once per group.
+
+    Within each group, settings evaluating more surrogates are placed first
+    so that the surrogates of the settings that follow can be taken from
+    theirs, for example the 19 rank-order surrogates from the 30 sixsigma
+    surrogates. The surrogates are cached per process, so that they are
+    only reliably reused in serial runs; on a worker pool a combination is
+    reused only when it lands on the same worker for both settings.
+
+    Returns
+    -------
+        settings_groups : list of lists
+            Groups of settings names, in order of first appearance.
+
+    """
+    groupkeys = []
+    settings_groups = []
+    for settings_name in settings_set:
+        weightsettings = dict(
+            (key, value) for key, value in caseconfig[settings_name].items()
+            if key not in significance_settings)
+        groupkey = json.dumps(weightsettings, sort_keys=True)
+        if groupkey in groupkeys:
+            settings_groups[groupkeys.index(groupkey)].append(settings_name)
+        else:
+            groupkeys.append(groupkey)
+            settings_groups.append([settings_name])
+
+    def surrogate_count(settings_name):
+        settings = caseconfig[settings_name]
+        if not settings['sigtest']:
+            return 0
+        return gaincalc_oneset.surrogate_count(settings['te_thresh_method'])
+
+    return [sorted(settings_group, key=surrogate_count, reverse=True)
+            for settings_group in settings_groups]
+
+
+def pool_size(caseconfig, scenarios):
+    """Returns the number of worker processes that leaves enough cores for
+    the largest number of concurrent estimator threads requested by the
+    settings of any of the scenarios.
+
+    Each worker evaluates up to surr_threads surrogates at the same time and
+    each of these estimates runs estimator_threads threads.
+
+    """
+    requested = [
+        caseconfig[settings_name].get(
+            'additional_parameters', {}).get('estimator_threads', 1) *
+        caseconfig[settings_name].get('surr_threads', 1)
+        for scenario in scenarios
+        for settings_name in caseconfig[scenario]['settings']]
+
+    return max(1, multiprocessing.cpu_count() // max(requested + [1]))
+
+
+def estimator_threads(requested, numworkers, surr_threads=1):
+    """Returns the number of threads used by each JIDT Kraskov estimate.
+
+    Parameters
+    ----------
+        requested : int or None
+            The estimator_threads value of the additional parameters, if
+            specified.
+        numworkers : int
+            Number of worker processes that run estimates at the same time.
+        surr_threads : int, default=1
+            Number of estimates each worker runs at the same time.
+
+    Returns
+    -------
+        threads : int
+            The requested number of threads, limited to the cores available
+            to each estimate so that the cores are not oversubscribed. All of
+            the cores available to each estimate if not requested.
+
+    """
+    available = max(1, multiprocessing.cpu_count() //
+                    (numworkers * surr_threads))
+    if requested is None:
+        return available
+    if requested > available:
+        logging.info("Limiting estimator threads from " + str(requested) +
+                     " to " + str(available) + " for " + str(numworkers) +
+                     " workers with " + str(surr_threads) +
+                     " surrogate threads")
+
+    return max(1, min(requested, available))
+
+
 def weightcalc(mode, case, writeoutput=False, single_entropies=False,
                fftcalc=False, do_multiprocessing=False):
     """Reports the maximum weight as well as associated delay
@@ -595,21 +954,54 @@ def weightcalc(mode, case, writeoutput=False, single_entropies=False,
     weightcalcdata = WeightcalcData(mode, case, single_entropies, fftcalc,
                                     do_multiprocessing)
 
-    for scenario in weightcalcdata.scenarios:
-        logging.info("Running scenario {}".format(scenario))
-        # Update scenario-specific fields of weightcalcdata object
-        weightcalcdata.scenariodata(scenario)
-        for settings_name in weightcalcdata.settings_set:
-            weightcalcdata.setsettings(scenario, settings_name)
-            logging.info("Now running settings {}".format(settings_name))
-
-            for method in weightcalcdata.methods:
-                logging.info("Method: " + method)
-
-                start_time = time.clock()
-                calc_weights(weightcalcdata, method, scenario, writeoutput)
-                end_time = time.clock()
-                print(end_time - start_time)
+    # A single worker pool is shared by all scenarios, settings, methods and
+    # boxes and shut down once all weights have been calculated
+    if do_multiprocessing:
+        # Start the JVM in every worker up front if any method requires JIDT
+        if any(method in jidt_methods for method in weightcalcdata.methods):
+            infodynamicsloc = weightcalcdata.infodynamicsloc
+        else:
+            infodynamicsloc = None
+        # Leave room for the threads of multi-threaded estimators
+        weightcalcdata.numworkers = pool_size(weightcalcdata.caseconfig,
+                                              weightcalcdata.scenarios)
+        pool = gaincalc_oneset.create_pool(
+            numworkers=weightcalcdata.numworkers,
+            infodynamicsloc=infodynamicsloc,
+            jvm_settings=weightcalcdata.jvm_settings)
+    else:
+        pool = None
+
+    try:
+        for scenario in weightcalcdata.scenarios:
+            logging.info("Running scenario {}".format(scenario))
+            # Update scenario-specific fields of weightcalcdata object
+            weightcalcdata.scenariodata(scenario)
+            for settings_group in plan_settings_sweep(
+                    weightcalcdata.caseconfig, weightcalcdata.settings_set):
+                # Weights shared by the settings of the group per method
+                if len(settings_group) > 1:
+                    weightstores = dict((method, {})
+                                        for method in weightcalcdata.methods)
+                else:
+                    weightstores = dict((method, None)
+                                        for method in weightcalcdata.methods)
+
+                for settings_name in settings_group:
+                    weightcalcdata.setsettings(scenario, settings_name)
+                    logging.info(
+                        "Now running settings {}".format(settings_name))
+
+                    for method in weightcalcdata.methods:
+                        logging.info("Method: " + method)
+
+                        start_time = time.clock()
+                        calc_weights(weightcalcdata, method, scenario,
+                                     writeoutput, pool, weightstores[method])
+                        end_time = time.clock()
+                        print(end_time - start_time)
+    finally:
+        gaincalc_oneset.close_pool(pool)
 
 if __name__ == '__main__':
     multiprocessing.freezeSupport()
@@ -6,14 +6,150 @@ process interruption tolerant up to a single causevar analysis.
 
 """
 
+import copy
 import csv
+import json
 import logging
 import os
+import tempfile
+from collections import deque
 from functools import partial
 
 import numpy as np
-import pathos
-from pathos.multiprocessing import ProcessingPool as Pool
+from pathos.helpers import ProcessPool, cpu_count
+
+import data_processing
+import transentropy
+
+# Per-process cache of memory-mapped arrays keyed by file name
+shared_arrays = {}
+
+# Attributes of WeightcalcData holding complete data sets that are not needed
+# by the workers
+worker_excluded_data = ['inputdata_raw', 'inputdata_normstep',
+                        'inputdata_bandgapfiltered', 'inputdata_originalrate',
+                        'boxes']
+
+
+class SharedArray(object):
+    """Lightweight handle to an array published to a memory-mapped file.
+
+    Only the file name and array metadata are pickled when the handle is
+    sent to a worker. The array is mapped into memory the first time it is
+    indexed in a process, after which it is shared with all other processes
+    through the operating system page cache.
+
+    Indexing the handle indexes the mapped array, so that it can be used in
+    place of the array wherever only slices are taken.
+
+    """
+
+    def __init__(self, filename, shape, dtype):
+        self.filename = filename
+        self.shape = shape
+        self.dtype = dtype
+
+    def load(self):
+        """Returns the memory-mapped array."""
+        if self.filename not in shared_arrays:
+            # Release arrays whose files have since been removed
+            for filename in list(shared_arrays):
+                if not os.path.exists(filename):
+                    del shared_arrays[filename]
+            shared_arrays[self.filename] = np.load(self.filename,
+                                                   mmap_mode='r')
+        return shared_arrays[self.filename]
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __len__(self):
+        return self.shape[0]
+
+
+def publish_array(data, storedir):
+    """Writes an array to a new file in storedir and returns a SharedArray
+    handle to it."""
+    data = np.ascontiguousarray(data)
+    filehandle, filename = tempfile.mkstemp(suffix='.npy', dir=storedir)
+    with os.fdopen(filehandle, 'wb') as datafile:
+        np.save(datafile, data)
+
+    return SharedArray(filename, data.shape, data.dtype)
+
+
+def unpublish_array(sharedarray):
+    """Removes the file of a SharedArray handle. Processes that have mapped
+    the array release it when they next load another array."""
+    shared_arrays.pop(sharedarray.filename, None)
+    if os.path.exists(sharedarray.filename):
+        os.remove(sharedarray.filename)
+
+
+def worker_weightcalcdata(weightcalcdata, inputdata):
+    """Returns a shallow copy of weightcalcdata for sending to workers,
+    without the complete data sets and with inputdata replaced by a
+    SharedArray handle."""
+    workerdata = copy.copy(weightcalcdata)
+    for attribute in worker_excluded_data:
+        if hasattr(workerdata, attribute):
+            setattr(workerdata, attribute, None)
+    workerdata.inputdata = inputdata
+
+    return workerdata
+
+
+def publish_tensors(tensors, storedir):
+    """Publishes a tensor, or each of a list of tensors, to storedir and
+    returns the SharedArray handles in the same structure."""
+    if isinstance(tensors, (list, tuple)):
+        return [publish_array(tensor, storedir) for tensor in tensors]
+    return publish_array(tensors, storedir)
+
+
+def worker_weightcalculator(weightcalculator, storedir):
+    """Returns a shallow copy of weightcalculator for sending to workers,
+    with the weight tensors of the current box, if evaluated at box level,
+    published to storedir and replaced by SharedArray handles. The
+    correlation calculator used to pre-screen the transfer entropy delays
+    is copied in the same way."""
+    workercalculator = copy.copy(weightcalculator)
+    if weightcalculator.boxweights is not None:
+        workercalculator.boxweights = publish_tensors(
+            weightcalculator.boxweights, storedir)
+    if getattr(weightcalculator, 'prescreen', None) is not None:
+        workercalculator.prescreen = worker_weightcalculator(
+            weightcalculator.prescreen, storedir)
+
+    return workercalculator
+
+
+def unpublish_weightcalculator(workercalculator):
+    """Removes the files of the tensors published by
+    worker_weightcalculator."""
+    tensors = workercalculator.boxweights
+    if not isinstance(tensors, (list, tuple)):
+        tensors = [tensors]
+    for tensor in tensors:
+        if isinstance(tensor, SharedArray):
+            unpublish_array(tensor)
+    if getattr(workercalculator, 'prescreen', None) is not None:
+        unpublish_weightcalculator(workercalculator.prescreen)
+
+
+class WorkerPool(ProcessPool):
+    """Process pool running the workers prepared by init_worker.
+
+    The pathos ProcessingPool ignores the number of processes as well as the
+    initializer, so the underlying multiprocess pool, which pickles with dill
+    in the same way, is used directly.
+
+    """
+
+    @property
+    def ncpus(self):
+        """Number of worker processes."""
+        return self._processes
 
 
 def writecsv_weightcalc(filename, datalines, header):
@@ -33,11 +169,454 @@ def readcsv_weightcalc(filename):
     return values, header
 
 
+def affectedvar_exists(method, filename, boxindex, causevar, affectedvar):
+    """Tests whether the results of a causevar and affectedvar combination
+    have already been written to file by a previous run.
+
+    """
+    if method[:16] == 'transfer_entropy':
+        testlocation = filename('auxdata_directional', boxindex+1, causevar)
+        if os.path.exists(testlocation):
+            # Open CSV file and read names of second affected vars
+            auxdatafile = np.genfromtxt(testlocation, delimiter=',',
+                                        usecols=np.arange(0, 2),
+                                        dtype=str)
+            affectedvars = auxdatafile[:, 1]
+            if affectedvar in affectedvars:
+                print("Affected variable results in existence")
+                return True
+
+    return False
+
+
+def calc_weights_pair(weightcalcdata, weightcalculator,
+                      box, startindex, size, method, boxindex,
+                      causevarindex, affectedvarindex, sample_delays,
+                      storedweights=None):
+    """Calculates the weights (and significance thresholds if required) of
+    a single causevar and affectedvar combination over a list of delays.
+
+    If the weights, properties, dimensionality and pre-screening
+    correlations of the combination are provided as storedweights, typically
+    from a settings entry that only differs in its significance settings,
+    only the significance thresholds are calculated.
+
+    Returns
+    -------
+        weightlist : list
+            Weights for each delay, or a list of directional and absolute
+            weight lists if the method provides both.
+        sigthreshlist : list
+            Significance thresholds in the same format as weightlist, empty if
+            allthresh is not set.
+        interpolated : list of bool
+            Indicates for each delay whether the significance thresholds were
+            interpolated rather than calculated.
+        proplist : list or None
+            Forward and backward estimator properties for each delay, if
+            provided by the method.
+        twodimensions : bool
+            Indicates whether directional and absolute weights are returned.
+        prescreenlist : list or None
+            Correlations used to pre-screen the transfer entropy delays, see
+            calc_pair_weights.
+
+    """
+    if storedweights is None:
+        weightlist, proplist, twodimensions, prescreenlist = \
+            calc_pair_weights(weightcalcdata, weightcalculator,
+                              box, startindex, size, method,
+                              causevarindex, affectedvarindex, sample_delays)
+    else:
+        weightlist, proplist, twodimensions, prescreenlist = storedweights
+
+    sigthreshlist, interpolated = \
+        calc_pair_sigthresh(weightcalcdata, weightcalculator,
+                            box, startindex, size, method, boxindex,
+                            causevarindex, affectedvarindex, sample_delays,
+                            weightlist, twodimensions)
+
+    return weightlist, sigthreshlist, interpolated, proplist, \
+        twodimensions, prescreenlist
+
+
+def calc_pair_weights(weightcalcdata, weightcalculator,
+                      box, startindex, size, method,
+                      causevarindex, affectedvarindex, sample_delays):
+    """Calculates the weights of a single causevar and affectedvar
+    combination over a list of delays.
+
+    With the coarse_to_fine delay search, only some of the delays are
+    evaluated (see search_delays) and the weights of the others are NaN.
+
+    Returns the weightlist, proplist, twodimensions and prescreenlist in the
+    format of calc_weights_pair. The prescreenlist holds the correlations at
+    every delay if te_prescreen_delays is set for a transfer entropy method,
+    and is None otherwise.
+
+    """
+    def evaluate(delays):
+        return calc_delay_weights(weightcalcdata, weightcalculator,
+                                  box, startindex, size, method,
+                                  causevarindex, affectedvarindex, delays)
+
+    if method[:16] == 'transfer_entropy' and \
+            weightcalculator.prescreen is not None:
+        prescreenlist = list(weightcalculator.prescreen_weights(
+            box, startindex, size, causevarindex, affectedvarindex,
+            sample_delays))
+    else:
+        prescreenlist = None
+
+    # Transfer entropies evaluated at box level need no pre-screening
+    if prescreenlist is not None and weightcalculator.boxweights is None:
+        weights = search_delays(weightcalcdata, evaluate, method,
+                                sample_delays,
+                                prescreen_delays(weightcalcdata,
+                                                 prescreenlist))
+    elif weightcalcdata.delay_search == 'coarse_to_fine':
+        weights = search_delays(weightcalcdata, evaluate, method,
+                                sample_delays)
+    else:
+        weights = evaluate(sample_delays)
+
+    return tuple(weights) + (prescreenlist,)
+
+
+def prescreen_delays(weightcalcdata, corrlist):
+    """Returns the indexes of the te_prescreen_delays delays with the
+    largest correlation magnitude, together with those of all delays within
+    te_prescreen_radius of them."""
+    numdelays = len(corrlist)
+    radius = weightcalcdata.te_prescreen_radius
+
+    delayindexes = set()
+    for peakindex in np.argsort(-np.abs(corrlist))[
+            :weightcalcdata.te_prescreen_delays]:
+        delayindexes.update(range(max(peakindex - radius, 0),
+                                  min(peakindex + radius + 1, numdelays)))
+
+    return sorted(delayindexes)
+
+
+def search_delays(weightcalcdata, evaluate, method, sample_delays,
+                  candidates=None):
+    """Evaluates the weights on a grid of every delay_search_stride-th
+    delay first, and then at all delays around the delay_search_peaks
+    largest weights of the grid.
+
+    The grid includes the first and last delays and the delay of zero.
+    With bidirectional delays, the peaks are searched separately among the
+    positive and negative delays, and the correlation methods are ranked by
+    the magnitude of their weights.
+
+    Parameters
+    ----------
+        evaluate : function
+            Returns the weightlist, proplist and twodimensions of a list of
+            delays, in the format of calc_weights_pair.
+        candidates : list of int, optional
+            Indexes of the delays to evaluate instead of the grid, such as
+            those of prescreen_delays. The first and last delays and the
+            delay of zero are added and no refinement follows.
+
+    Returns
+    -------
+        The weightlist, proplist and twodimensions over all sample delays,
+        in the format of calc_weights_pair, with NaN weights and None
+        properties at the delays that were not evaluated.
+
+    """
+    numdelays = len(sample_delays)
+    stride = weightcalcdata.delay_search_stride
+
+    # The delay of zero is used as base value of the weights
+    if weightcalcdata.bidirectional_delays:
+        baseindex = numdelays // 2
+        segments = [range(0, baseindex), range(baseindex, numdelays)]
+    else:
+        baseindex = 0
+        segments = [range(numdelays)]
+
+    weights = {}
+    properties = {}
+
+    def evaluate_indexes(delayindexes):
+        delayindexes = sorted(set(delayindexes) - set(weights))
+        if not delayindexes:
+            return
+        weightlist, proplist, twodimensions = evaluate(
+            [sample_delays[delayindex] for delayindex in delayindexes])
+        if not twodimensions:
+            weightlist = [weightlist]
+        for n, delayindex in enumerate(delayindexes):
+            weights[delayindex] = [curve[n] for curve in weightlist]
+            if proplist is not None:
+                properties[delayindex] = [props[n] for props in proplist]
+        return twodimensions
+
+    if candidates is None:
+        gridindexes = set(range(0, numdelays, stride))
+        numpeaks = weightcalcdata.delay_search_peaks
+    else:
+        gridindexes = set(candidates)
+        numpeaks = 0
+    gridindexes.update([0, numdelays - 1, baseindex])
+    twodimensions = evaluate_indexes(gridindexes)
+
+    # Refine around the peaks of every weight curve on the grid
+    fineindexes = set()
+    for curve in range(len(weights[baseindex])):
+        for segment in segments:
+            evaluated = [delayindex for delayindex in segment
+                         if delayindex in weights]
+            values = np.array([weights[delayindex][curve]
+                               for delayindex in evaluated])
+            if method in ['cross_correlation', 'partial_correlation']:
+                values = np.abs(values)
+            peakindexes = [evaluated[n]
+                           for n in np.argsort(-values)[:numpeaks]]
+            for peakindex in peakindexes:
+                fineindexes.update(
+                    range(max(peakindex - stride + 1, segment[0]),
+                          min(peakindex + stride, segment[-1] + 1)))
+    evaluate_indexes(fineindexes)
+
+    logging.info("Evaluated " + str(len(weights)) + " of " +
+                 str(numdelays) + " delays")
+
+    numcurves = len(weights[baseindex])
+    weightlist = [[weights[delayindex][curve] if delayindex in weights
+                   else np.nan for delayindex in range(numdelays)]
+                  for curve in range(numcurves)]
+    if properties:
+        proplist = [[properties[delayindex][direction]
+                     if delayindex in properties else None
+                     for delayindex in range(numdelays)]
+                    for direction in range(2)]
+    else:
+        proplist = None
+
+    if twodimensions:
+        return weightlist, proplist, twodimensions
+    else:
+        return weightlist[0], proplist, twodimensions
+
+
+def calc_delay_weights(weightcalcdata, weightcalculator,
+                       box, startindex, size, method,
+                       causevarindex, affectedvarindex, sample_delays):
+    """Calculates the weights of a single causevar and affectedvar
+    combination at every delay in a list, see calc_pair_weights."""
+    weightlist = []
+    directional_weightlist = []
+    absolute_weightlist = []
+    sigfwd_list = []
+    sigbwd_list = []
+    propfwd_list = []
+    propbwd_list = []
+
+    if method == 'cross_correlation':
+        # All delays are evaluated in a single pass
+        if weightcalculator.boxweights is not None:
+            weightlist = weightcalculator.get_boxweights(
+                causevarindex, affectedvarindex, sample_delays)
+        else:
+            weightlist = weightcalculator.calcweights_alldelays(
+                box, causevarindex, affectedvarindex,
+                startindex, size, sample_delays)
+        twodimensions = False
+
+    elif weightcalculator.boxweights is not None:
+        # Transfer entropies of the box have been evaluated at once
+        [directional_weightlist, absolute_weightlist], \
+            [propfwd_list, propbwd_list] = weightcalculator.get_boxweights(
+                causevarindex, affectedvarindex, sample_delays)
+        twodimensions = True
+
+    else:
+        for delay in sample_delays:
+            logging.info("Now testing delay: " + str(delay))
+
+            causevardata = \
+                (box[:, causevarindex]
+                    [startindex:startindex+size])
+
+            affectedvardata = \
+                (box[:, affectedvarindex]
+                    [startindex+delay:startindex+size+delay])
+
+            weight, auxdata = \
+                weightcalculator.calcweight(causevardata,
+                                            affectedvardata,
+                                            weightcalcdata,
+                                            causevarindex,
+                                            affectedvarindex)
+
+            if len(weight) > 1:
+                # If weight contains directional as well as
+                # absolute weights, write to separate lists
+                directional_weightlist.append(weight[0])
+                absolute_weightlist.append(weight[1])
+            else:
+                weightlist.append(weight[0])
+
+            if auxdata is not None:
+                if len(auxdata) > 1:
+                    # This means we have auxdata for both the
+                    # forward and backward calculation
+                    [auxdata_fwd, auxdata_bwd] = auxdata
+                    [significance_fwd, properties_fwd] = auxdata_fwd
+                    [significance_bwd, properties_bwd] = auxdata_bwd
+                    sigfwd_list.append(significance_fwd)
+                    sigbwd_list.append(significance_bwd)
+                    propfwd_list.append(properties_fwd)
+                    propbwd_list.append(properties_bwd)
+
+        twodimensions = len(weight) > 1
+
+    if twodimensions:
+        weightlist = [directional_weightlist,
+                      absolute_weightlist]
+        proplist = [propfwd_list,
+                    propbwd_list]
+    else:
+        proplist = None
+
+    return weightlist, proplist, twodimensions
+
+
+def calc_pair_sigthresh(weightcalcdata, weightcalculator,
+                        box, startindex, size, method, boxindex,
+                        causevarindex, affectedvarindex, sample_delays,
+                        weightlist, twodimensions):
+    """Calculates the significance thresholds of a single causevar and
+    affectedvar combination over a list of delays if allthresh is set.
+
+    Thresholds are calculated at every delay, or at selected delays only
+    and interpolated in between if a threshold delay step is specified.
+
+    Returns the sigthreshlist and interpolated flags in the format of
+    calc_weights_pair.
+
+    """
+    numdelays = len(sample_delays)
+    interpolated = [False] * numdelays
+
+    if not weightcalcdata.allthresh:
+        if twodimensions:
+            return [[], []], interpolated
+        else:
+            return [], interpolated
+
+    if method == 'cross_correlation':
+        sigthreshlist = \
+            [weightcalculator.calcsigthresh()[0]
+             for _ in sample_delays]
+        return sigthreshlist, interpolated
+
+    if twodimensions:
+        weightlists = weightlist
+    else:
+        weightlists = [weightlist]
+
+    # Significance thresholds are calculated at every delay unless a delay
+    # step is specified
+    if weightcalcdata.thresh_delay_step == 1:
+        delayindexes = range(numdelays)
+    else:
+        delayindexes = select_thresh_delays(
+            weightlists, weightcalcdata.thresh_delay_step)
+    # Delays skipped by the delay search have no weights to test
+    delayindexes = [delayindex for delayindex in delayindexes
+                    if not np.isnan(weightlists[0][delayindex])]
+
+    # Auto-embedding search results of the box are reused for surrogates
+    if method[:16] == 'transfer_entropy':
+        embeddings = weightcalculator.pair_embeddings(causevarindex,
+                                                      affectedvarindex)
+    else:
+        embeddings = None
+
+    sigthresholds = []
+    for delayindex in delayindexes:
+        delay = sample_delays[delayindex]
+        causevardata = \
+            (box[:, causevarindex]
+                [startindex:startindex+size])
+        affectedvardata = \
+            (box[:, affectedvarindex]
+                [startindex+delay:startindex+size+delay])
+        sigthresholds.append(weightcalculator.calcsigthresh(
+            weightcalcdata, affectedvardata, causevardata,
+            (causevarindex, boxindex, startindex, size), embeddings))
+
+    sigthreshlists = []
+    for n in range(len(weightlists)):
+        sigthreshlist = [sigthreshold[n] for sigthreshold in sigthresholds]
+        if weightcalcdata.thresh_delay_step > 1:
+            # Interpolate between the delays calculated
+            sigthreshlist = interpolate_thresholds(
+                delayindexes, sigthreshlist, numdelays)
+        elif len(delayindexes) < numdelays:
+            sigthreshlist = dict(zip(delayindexes, sigthreshlist))
+            sigthreshlist = [sigthreshlist.get(delayindex, np.nan)
+                             for delayindex in range(numdelays)]
+        sigthreshlists.append(sigthreshlist)
+
+    if weightcalcdata.thresh_delay_step > 1:
+        interpolated = [delayindex not in delayindexes
+                        for delayindex in range(numdelays)]
+
+    if twodimensions:
+        return sigthreshlists, interpolated
+    else:
+        return sigthreshlists[0], interpolated
+
+
+def select_thresh_delays(weightlists, step):
+    """Returns the indexes of the delays at which significance thresholds
+    are calculated: every step-th delay, the last delay and the delay of the
+    maximum weight in each of the weight lists."""
+    numdelays = len(weightlists[0])
+    delayindexes = set(range(0, numdelays, step))
+    delayindexes.add(numdelays - 1)
+    for weightlist in weightlists:
+        delayindexes.add(int(np.nanargmax(weightlist)))
+
+    return sorted(delayindexes)
+
+
+def interpolate_thresholds(delayindexes, sigthresholds, numdelays):
+    """Linearly interpolates significance thresholds calculated at the
+    given delay indexes to all delays."""
+    return np.interp(np.arange(numdelays), delayindexes,
+                     sigthresholds).tolist()
+
+
 def calc_weights_oneset(weightcalcdata, weightcalculator,
                         box, startindex, size, newconnectionmatrix,
                         method, boxindex,
                         filename, headerline, writeoutput,
-                        causevarindex):
+                        causevarindex, pairresults=None,
+                        storedweights=None):
+    """Calculates the weights between a causevar and all affectedvars and
+    writes the results to file.
+
+    If pairresults is provided, it should map each affectedvarindex to the
+    weights, significance thresholds, threshold interpolation flags,
+    properties, dimensionality and report of that combination, which are
+    then used instead of calculating them.
+
+    If storedweights is provided, it maps affectedvarindexes to the weights,
+    properties, dimensionality and pre-screening correlations of a previous
+    calculation, which are reused while the significance stage is repeated.
+
+    Returns a dictionary with the weights, properties, dimensionality and
+    pre-screening correlations of each affectedvar analysed, keyed by
+    affectedvarindex.
+
+    """
 
     causevar = weightcalcdata.variables[causevarindex]
 
@@ -58,6 +637,17 @@ def calc_weights_oneset(weightcalcdata, weightcalculator,
         sig_directional_name = 'sigthresh_directional'
         sig_absolute_name = 'sigthresh_absolute'
         sig_neutral_name = 'sigthresh'
+        # Flags thresholds that were interpolated between calculated delays
+        interpolate_thresh = weightcalcdata.thresh_delay_step > 1
+        sig_interpolated_name = 'sigthresh_interpolated'
+    else:
+        interpolate_thresh = False
+
+    # The correlations used to pre-screen the transfer entropy delays are
+    # stored along with the weights
+    prescreen_name = 'prescreen_corr'
+    write_prescreen = (method[:16] == 'transfer_entropy' and
+                       weightcalcdata.te_prescreen_delays is not None)
 
     # Initiate datalines with delays
     datalines_directional = \
@@ -71,12 +661,17 @@ def calc_weights_oneset(weightcalcdata, weightcalculator,
     datalines_sigthresh_directional = datalines_directional.copy()
     datalines_sigthresh_absolute = datalines_directional.copy()
     datalines_sigthresh_neutral = datalines_directional.copy()
+    datalines_sigthresh_interpolated = datalines_directional.copy()
+    datalines_prescreen = datalines_directional.copy()
 
     # Initiate empty auxdata lists
     auxdata_directional = []
     auxdata_absolute = []
     auxdata_neutral = []
 
+    # Weights of the affectedvars analysed
+    pairweights = {}
+
     if method[:16] == 'transfer_entropy':
         if os.path.exists(filename(auxdirectional_name, boxindex+1, causevar)):
             auxdata_directional = list(np.genfromtxt(
@@ -98,6 +693,18 @@ def calc_weights_oneset(weightcalcdata, weightcalculator,
                 datalines_sigthresh_absolute = readcsv_weightcalc(
                   filename(sig_absolute_name, boxindex+1, causevar))
 
+            # Results written before thresh_delay_step was enabled have no
+            # interpolation flags
+            if interpolate_thresh and os.path.exists(
+                    filename(sig_interpolated_name, boxindex+1, causevar)):
+                datalines_sigthresh_interpolated, _ = readcsv_weightcalc(
+                    filename(sig_interpolated_name, boxindex+1, causevar))
+
+            if write_prescreen and os.path.exists(
+                    filename(prescreen_name, boxindex+1, causevar)):
+                datalines_prescreen, _ = readcsv_weightcalc(
+                    filename(prescreen_name, boxindex+1, causevar))
+
     for affectedvarindex in weightcalcdata.affectedvarindexes:
         affectedvar = weightcalcdata.variables[affectedvarindex]
 
@@ -109,95 +716,53 @@ def calc_weights_oneset(weightcalcdata, weightcalculator,
         do_test = not(newconnectionmatrix[affectedvarindex,
                                           causevarindex] == 0)
         # Test if the affectedvar has already been calculated
-        if (method[:16] == 'transfer_entropy') and do_test:
-            testlocation = filename(auxdirectional_name, boxindex+1, causevar)
-            if os.path.exists(testlocation):
-                # Open CSV file and read names of second affected vars
-                auxdatafile = np.genfromtxt(testlocation, delimiter=',',
-                                            usecols=np.arange(0, 2),
-                                            dtype=str)
-                affectedvars = auxdatafile[:, 1]
-                if affectedvar in affectedvars:
-                    print("Affected variable results in existence")
-                    exists = True
+        if do_test:
+            exists = affectedvar_exists(method, filename, boxindex,
+                                        causevar, affectedvar)
 
         if do_test and (exists is False):
-            weightlist = []
-            directional_weightlist = []
-            absolute_weightlist = []
-            sigthreshlist = []
-            directional_sigthreshlist = []
-            absolute_sigthreshlist = []
-            sigfwd_list = []
-            sigbwd_list = []
-            propfwd_list = []
-            propbwd_list = []
-
-            for delay in weightcalcdata.sample_delays:
-                logging.info("Now testing delay: " + str(delay))
-
-                causevardata = \
-                    (box[:, causevarindex]
-                        [startindex:startindex+size])
-
-                affectedvardata = \
-                    (box[:, affectedvarindex]
-                        [startindex+delay:startindex+size+delay])
-
-                weight, auxdata = \
-                    weightcalculator.calcweight(causevardata,
-                                                affectedvardata,
-                                                weightcalcdata,
-                                                causevarindex,
-                                                affectedvarindex)
-
-                # Calculate significance thresholds at each data point
-                if weightcalcdata.allthresh:
-                    sigthreshold = \
-                        weightcalculator.calcsigthresh(
-                            weightcalcdata, affectedvardata, causevardata)
-
-                if len(weight) > 1:
-                    # If weight contains directional as well as
-                    # absolute weights, write to separate lists
-                    directional_weightlist.append(weight[0])
-                    absolute_weightlist.append(weight[1])
-                    # Same approach with significance thresholds
-                    if weightcalcdata.allthresh:
-                        directional_sigthreshlist.append(
-                            sigthreshold[0])
-                        absolute_sigthreshlist.append(
-                            sigthreshold[1])
-
+            if pairresults is not None:
+                weightlist, sigthreshlist, interpolated, proplist, \
+                    twodimensions, prescreenlist, auxdata_thisvar = \
+                    pairresults[affectedvarindex]
+            else:
+                if storedweights is not None:
+                    storedweights_thisvar = \
+                        storedweights.get(affectedvarindex)
                 else:
-                    weightlist.append(weight[0])
-                    if weightcalcdata.allthresh:
-                        sigthreshlist.append(sigthreshold[0])
-
-                if auxdata is not None:
-                    if len(auxdata) > 1:
-                        # This means we have auxdata for both the forward and
-                        # backward calculation
-                        [auxdata_fwd, auxdata_bwd] = auxdata
-                        [significance_fwd, properties_fwd] = auxdata_fwd
-                        [significance_bwd, properties_bwd] = auxdata_bwd
-                        sigfwd_list.append(significance_fwd)
-                        sigbwd_list.append(significance_bwd)
-                        propfwd_list.append(properties_fwd)
-                        propbwd_list.append(properties_bwd)
+                    storedweights_thisvar = None
+
+                weightlist, sigthreshlist, interpolated, proplist, \
+                    twodimensions, prescreenlist = calc_weights_pair(
+                        weightcalcdata, weightcalculator,
+                        box, startindex, size, method,
+                        boxindex, causevarindex, affectedvarindex,
+                        weightcalcdata.sample_delays,
+                        storedweights_thisvar)
+
+                # Generate report according to each method
+                auxdata_thisvar = weightcalculator.report(
+                    weightcalcdata, causevarindex, affectedvarindex,
+                    weightlist, proplist)
+
+            pairweights[affectedvarindex] = \
+                (weightlist, proplist, twodimensions, prescreenlist)
+
+            if write_prescreen:
+                prescreen_thisvar = np.asarray(prescreenlist)
+                datalines_prescreen = \
+                    np.concatenate((datalines_prescreen,
+                                    prescreen_thisvar[:, np.newaxis]),
+                                   axis=1)
+
+            if interpolate_thresh:
+                interpolated_thisvar = \
+                    np.asarray(interpolated, dtype=int)[:, np.newaxis]
+                datalines_sigthresh_interpolated = \
+                    np.concatenate((datalines_sigthresh_interpolated,
+                                    interpolated_thisvar), axis=1)
 
-            if len(weight) > 1:
-
-                twodimensions = True
-
-                proplist = [propfwd_list,
-                            propbwd_list]
-
-#                siglist = [sigfwd_list,
-#                           sigbwd_list]
-
-                weightlist = [directional_weightlist,
-                              absolute_weightlist]
+            if twodimensions:
 
                 # Combine weight data
                 weights_thisvar_directional = np.asarray(weightlist[0])
@@ -217,20 +782,14 @@ def calc_weights_oneset(weightcalcdata, weightcalculator,
                                     weights_thisvar_absolute), axis=1)
 
                 # Write all the auxilliary weight data
-                # Generate and store report files according to each method
                 auxdata_thisvar_directional, auxdata_thisvar_absolute = \
-                    weightcalculator.report(
-                        weightcalcdata, causevarindex, affectedvarindex,
-                        weightlist, proplist)
+                    auxdata_thisvar
 
                 auxdata_directional.append(auxdata_thisvar_directional)
                 auxdata_absolute.append(auxdata_thisvar_absolute)
 
                 # Do the same for the significance threshold
                 if weightcalcdata.allthresh:
-                    sigthreshlist = [directional_sigthreshlist,
-                                     absolute_sigthreshlist]
-
                     sigthresh_thisvar_directional = \
                         np.asarray(sigthreshlist[0])
                     sigthresh_thisvar_directional = \
@@ -251,8 +810,6 @@ def calc_weights_oneset(weightcalcdata, weightcalculator,
 
             else:
 
-                twodimensions = False
-
                 weights_thisvar_neutral = np.asarray(weightlist)
                 weights_thisvar_neutral = \
                     weights_thisvar_neutral[:, np.newaxis]
@@ -262,15 +819,7 @@ def calc_weights_oneset(weightcalcdata, weightcalculator,
                                     weights_thisvar_neutral), axis=1)
 
                 # Write all the auxilliary weight data
-                # Generate and store report files according to each method
-                proplist = None
-
-                auxdata_thisvar_neutral = \
-                    weightcalculator.report(
-                        weightcalcdata, causevarindex, affectedvarindex,
-                        weightlist, proplist)
-
-                auxdata_neutral.append(auxdata_thisvar_neutral)
+                auxdata_neutral.append(auxdata_thisvar)
 
                 # Write the significance thresholds to file
                 if weightcalcdata.allthresh:
@@ -312,6 +861,11 @@ def calc_weights_oneset(weightcalcdata, weightcalculator,
                         sig_absolute_name, boxindex+1, causevar),
                         datalines_sigthresh_absolute, headerline)
 
+                if write_prescreen:
+                    writecsv_weightcalc(filename(
+                        prescreen_name, boxindex+1, causevar),
+                        datalines_prescreen, headerline)
+
             else:
                 writecsv_weightcalc(filename(
                     neutral_name, boxindex+1, causevar),
@@ -326,14 +880,492 @@ def calc_weights_oneset(weightcalcdata, weightcalculator,
                         sig_neutral_name, boxindex+1, causevar),
                         datalines_sigthresh_neutral, headerline)
 
+            if interpolate_thresh:
+                writecsv_weightcalc(filename(
+                    sig_interpolated_name, boxindex+1, causevar),
+                    datalines_sigthresh_interpolated, headerline)
+
+    if method[:16] == 'transfer_entropy':
+        logging.info("JIDT calculator cache: " +
+                     str(transentropy.tecalc_cache_info()))
+        logging.info("Surrogate cache: " +
+                     str(data_processing.surr_cache_info()))
+
     print("Done analysing causal variable: " + causevar +
           " [" + str(causevarindex+1) + "/" +
           str(len(weightcalcdata.causevarindexes)) + "]")
 
-    return None
+    return pairweights
+
+
+def task_cost(weightcalcdata, method, numdelays, stored=False):
+    """Estimates the relative cost of calculating the weights of a single
+    causevar and affectedvar combination over a number of delays.
+
+    Correlation and the linear-Gaussian and native discrete transfer entropy
+    estimators scale linearly with the test size, while the nearest
+    neighbour searches of the other transfer entropy estimators are taken to
+    scale as size log(size).
+    Significance thresholds calculated at every delay add
+    the cost of the surrogate estimates in both directions. If the weights
+    are stored, only the cost of the significance thresholds is included.
 
+    """
+    size = weightcalcdata.testsize
 
-def run(non_iter_args, do_multiprocessing):
+    if method == 'cross_correlation':
+        if stored:
+            return numdelays
+        return numdelays * size
+
+    if method in ['transfer_entropy_gaussian',
+                  'transfer_entropy_discrete_native']:
+        weightcost = numdelays * size
+    else:
+        weightcost = numdelays * size * np.log2(size)
+    if stored:
+        cost = 0.
+    else:
+        cost = weightcost
+    if weightcalcdata.allthresh and numdelays > 0:
+        # Fraction of delays at which thresholds are calculated
+        step = weightcalcdata.thresh_delay_step
+        fraction = min(1., (np.ceil(float(numdelays) / step) + 2) /
+                       numdelays)
+        cost += weightcost * 2 * fraction * \
+            surrogate_count(weightcalcdata.te_thresh_method)
+
+    return cost
+
+
+def report_cost(weightcalcdata, method):
+    """Estimates the relative cost of reporting on a single causevar and
+    affectedvar combination, which includes significance testing at the
+    best delays for the transfer entropy methods.
+
+    """
+    size = weightcalcdata.testsize
+
+    if method[:16] == 'transfer_entropy' and weightcalcdata.sigtest:
+        # Up to two sets of forward and backward surrogate estimates
+        return max(size, 4 * surrogate_count(weightcalcdata.te_thresh_method) *
+                   size * np.log2(size))
+
+    return size
+
+
+def surrogate_count(te_thresh_method):
+    """Returns the number of surrogates used by a significance threshold
+    method."""
+    if te_thresh_method == 'sixsigma':
+        return 30
+    elif te_thresh_method == 'rankorder':
+        return 19
+    return 0
+
+
+def delay_blocks(sample_delays, numblocks):
+    """Splits the sample delays into a number of contiguous blocks of near
+    equal size."""
+    numblocks = max(1, min(numblocks, len(sample_delays)))
+    bounds = np.linspace(0, len(sample_delays), numblocks + 1).astype(int)
+    return [list(sample_delays[bounds[i]:bounds[i + 1]])
+            for i in range(numblocks)]
+
+
+def merge_pair_results(blockresults):
+    """Combines the results of calc_weights_pair for consecutive delay
+    blocks of the same causevar and affectedvar combination."""
+    weightlist, sigthreshlist, interpolated, proplist, twodimensions, \
+        prescreenlist = blockresults[0]
+
+    for blockresult in blockresults[1:]:
+        block_weightlist, block_sigthreshlist, block_interpolated, \
+            block_proplist, _, block_prescreenlist = blockresult
+        interpolated = interpolated + block_interpolated
+        if prescreenlist is not None:
+            prescreenlist = prescreenlist + block_prescreenlist
+        if twodimensions:
+            weightlist = [weightlist[n] + block_weightlist[n]
+                          for n in range(2)]
+            sigthreshlist = [sigthreshlist[n] + block_sigthreshlist[n]
+                             for n in range(2)]
+            proplist = [proplist[n] + block_proplist[n] for n in range(2)]
+        else:
+            weightlist = weightlist + block_weightlist
+            sigthreshlist = sigthreshlist + block_sigthreshlist
+
+    return weightlist, sigthreshlist, interpolated, proplist, \
+        twodimensions, prescreenlist
+
+
+def calc_weights_task(weightcalcdata, weightcalculator,
+                      box, startindex, size, method, boxindex, task):
+    """Calculates the weights of a (causevar, affectedvar, delay block,
+    stored weights) task."""
+    causevarindex, affectedvarindex, sample_delays, storedweights = task
+    return calc_weights_pair(weightcalcdata, weightcalculator,
+                             box, startindex, size, method, boxindex,
+                             causevarindex, affectedvarindex, sample_delays,
+                             storedweights)
+
+
+def calc_weights_oneset_task(partial_gaincalc_oneset, task):
+    """Calculates the weights of a (causevar, stored weights) task."""
+    causevarindex, storedweights = task
+    return partial_gaincalc_oneset(causevarindex,
+                                   storedweights=storedweights)
+
+
+def report_task(weightcalcdata, weightcalculator, task):
+    """Generates the report of a (causevar, affectedvar) task."""
+    causevarindex, affectedvarindex, weightlist, proplist = task
+    return weightcalculator.report(weightcalcdata, causevarindex,
+                                   affectedvarindex, weightlist, proplist)
+
+
+def submit_task(function, task, pool):
+    """Starts the evaluation of the function for a single task on the pool
+    if provided and returns a function that waits for and returns the
+    result. Without a pool, the task is evaluated right away."""
+    if pool is not None:
+        return pool.apply_async(function, (task,)).get
+    else:
+        result = function(task)
+        return lambda: result
+
+
+def imap_tasks(function, tasks, pool):
+    """Evaluates the function for every task, in the given order, on the
+    pool if provided, iterating over the results as they become available so
+    that they do not all need to be held in memory at once. Tasks are handed
+    out one at a time so that the longest tasks, placed first, start
+    first."""
+    if pool is not None:
+        return pool.imap(function, tasks)
+    else:
+        return (function(task) for task in tasks)
+
+
+def local_te_task(weightcalculator, sample_delays, filenames, task):
+    """Calculates the local transfer entropies of a single (causevarindex,
+    affectedvarindex, cause, affected, causevardata, affectedvardata) task
+    and writes their cumulative sums to the (cause, affected) entries of the
+    forward and backward files of calc_local_store, see
+    TransentWeightcalc.calc_local_cumsums."""
+    (causevarindex, affectedvarindex, cause, affected,
+     causevardata, affectedvardata) = task
+    cumsums = [np.load(filename, mmap_mode='r+') for filename in filenames]
+    firstindexes, properties = weightcalculator.calc_local_cumsums(
+        causevardata, affectedvardata, causevarindex, affectedvarindex,
+        sample_delays, [direction[cause, affected] for direction in cumsums])
+    for direction in cumsums:
+        direction.flush()
+
+    return firstindexes, properties
+
+
+def calc_local_store(weightcalcdata, weightcalculator, newconnectionmatrix,
+                     storedir, pool=None):
+    """Calculates the local transfer entropies of every causevar and
+    affectedvar combination over the complete inputdata for every sample
+    delay, and stores their cumulative sums, from which the weights of each
+    box are set with TransentWeightcalc.set_localweights.
+
+    The calculation is done once regardless of the number of boxes and their
+    overlap, and the averages can be taken over any window of the data. The
+    cumulative sums are written by the workers to memory-mapped files in
+    storedir, together with the index of the first local value of every
+    series and an index of the variables and delays.
+
+    Raises
+    ------
+        ValueError
+            If the cumulative sums would take up more than
+            weightcalcdata.local_te_store_limit megabytes.
+
+    Returns
+    -------
+        localstore : dict
+            The forward and backward 'cumsums', indexed by (causevar,
+            affectedvar, delay, sample), and 'firstindexes', indexed by
+            (causevar, affectedvar, delay), together with the 'varindexes',
+            'sample_delays' and the forward and backward 'properties' of
+            every pair.
+
+    """
+    causevarindexes = list(weightcalcdata.causevarindexes)
+    affectedvarindexes = list(weightcalcdata.affectedvarindexes)
+    sample_delays = [int(delay) for delay in weightcalcdata.sample_delays]
+    inputdata = weightcalcdata.inputdata
+
+    pairs = [(causevarindex, affectedvarindex)
+             for causevarindex in causevarindexes
+             for affectedvarindex in affectedvarindexes
+             if not(newconnectionmatrix[affectedvarindex,
+                                        causevarindex] == 0)]
+
+    shape = (len(causevarindexes), len(affectedvarindexes),
+             len(sample_delays), len(inputdata) + 1)
+    storesize = 2 * np.prod(shape) * np.dtype(np.float64).itemsize / 1e6
+    if storesize > weightcalcdata.local_te_store_limit:
+        raise ValueError(
+            "The local transfer entropy sums of {} causevars, {} "
+            "affectedvars, {} delays and {} samples need {:.0f} MB, which "
+            "exceeds the local_te_store_limit of {} MB".format(
+                len(causevarindexes), len(affectedvarindexes),
+                len(sample_delays), len(inputdata), storesize,
+                weightcalcdata.local_te_store_limit))
+
+    filenames = [os.path.join(storedir, 'cumsums_' + direction + '.npy')
+                 for direction in ['fwd', 'bwd']]
+    # Create the files to which the workers write the sums
+    for filename in filenames:
+        np.lib.format.open_memmap(filename, mode='w+', dtype=np.float64,
+                                  shape=shape)
+    firstindexes = np.zeros((2,) + shape[:3], dtype=int)
+    properties = {}
+
+    logging.info("Calculating local transfer entropies of " +
+                 str(len(pairs)) + " combinations")
+
+    tasks = ((causevarindex, affectedvarindex,
+              causevarindexes.index(causevarindex),
+              affectedvarindexes.index(affectedvarindex),
+              inputdata[:, causevarindex], inputdata[:, affectedvarindex])
+             for causevarindex, affectedvarindex in pairs)
+    results = imap_tasks(partial(local_te_task, weightcalculator,
+                                 sample_delays, filenames), tasks, pool)
+    for pairindex, (pairfirstindexes, pairproperties) in enumerate(results):
+        causevarindex, affectedvarindex = pairs[pairindex]
+        firstindexes[:, causevarindexes.index(causevarindex),
+                     affectedvarindexes.index(affectedvarindex)] = \
+            pairfirstindexes
+        properties[(causevarindex, affectedvarindex)] = pairproperties
+
+    for direction, name in enumerate(['fwd', 'bwd']):
+        np.save(os.path.join(storedir, 'firstindexes_' + name + '.npy'),
+                firstindexes[direction])
+    with open(os.path.join(storedir, 'index.json'), 'w') as indexfile:
+        json.dump({'causevars': [weightcalcdata.variables[index]
+                                 for index in causevarindexes],
+                   'affectedvars': [weightcalcdata.variables[index]
+                                    for index in affectedvarindexes],
+                   'sample_delays': sample_delays}, indexfile)
+
+    return {'cumsums': [np.load(filename, mmap_mode='r')
+                        for filename in filenames],
+            'firstindexes': list(firstindexes),
+            'varindexes': (causevarindexes, affectedvarindexes),
+            'sample_delays': sample_delays,
+            'properties': properties}
+
+
+def run_tasks(non_iter_args, pool, numworkers, weightstore=None):
+    """Calculates the weights and reports of all causevar and affectedvar
+    combinations of a box by scheduling (causevar, affectedvar, delay block)
+    tasks longest first, followed by one report task per combination.
+
+    Combinations with weights in the weightstore (see run) are scheduled as
+    a single task that only repeats the significance stage.
+
+    The report of a combination is scheduled ahead of the remaining weight
+    tasks as soon as all of its delay blocks have completed. Only a few
+    tasks per worker are queued at a time, so that completed causevars can
+    be written while the remaining ones are calculated.
+
+    Yields
+    ------
+        causevarindex : int
+        causevarresults : dict
+            Pair results per affectedvarindex of the causevar, in the format
+            accepted by calc_weights_oneset, yielded once all tasks of the
+            causevar have completed.
+
+    """
+    [weightcalcdata, weightcalculator,
+     box, startindex, size,
+     newconnectionmatrix,
+     method, boxindex,
+     filename, _, _] = non_iter_args
+
+    variables = weightcalcdata.variables
+    pairs = [(causevarindex, affectedvarindex)
+             for causevarindex in weightcalcdata.causevarindexes
+             for affectedvarindex in weightcalcdata.affectedvarindexes
+             if not(newconnectionmatrix[affectedvarindex,
+                                        causevarindex] == 0) and
+             not affectedvar_exists(method, filename, boxindex,
+                                    variables[causevarindex],
+                                    variables[affectedvarindex])]
+
+    pairresults = dict((causevarindex, {})
+                       for causevarindex in weightcalcdata.causevarindexes)
+    # Affectedvars of every causevar still awaiting their report
+    pending = dict((causevarindex, set())
+                   for causevarindex in weightcalcdata.causevarindexes)
+    for causevarindex, affectedvarindex in pairs:
+        pending[causevarindex].add(affectedvarindex)
+
+    # Causevars without combinations to calculate are complete right away
+    for causevarindex in weightcalcdata.causevarindexes:
+        if not pending[causevarindex]:
+            yield causevarindex, pairresults[causevarindex]
+    if not pairs:
+        return
+
+    # Split the delays of each combination into enough blocks to keep all
+    # workers busy. Correlation evaluates all delays in a single pass.
+    # The delay search and pre-screening need all delays of a combination in
+    # a single task.
+    if method == 'cross_correlation' or \
+            weightcalcdata.delay_search == 'coarse_to_fine' or \
+            (method[:16] == 'transfer_entropy' and
+             weightcalcdata.te_prescreen_delays is not None):
+        numblocks = 1
+    else:
+        numblocks = int(np.ceil(4. * numworkers / len(pairs)))
+    blocks = delay_blocks(weightcalcdata.sample_delays, numblocks)
+
+    if weightstore is None:
+        weightstore = {}
+
+    tasks = []
+    for pair in pairs:
+        if pair in weightstore:
+            tasks.append(pair + (weightcalcdata.sample_delays,
+                                 weightstore[pair]))
+        else:
+            tasks += [pair + (block, None) for block in blocks]
+
+    order = sorted(range(len(tasks)), reverse=True,
+                   key=lambda n: task_cost(weightcalcdata, method,
+                                           len(tasks[n][2]),
+                                           tasks[n][3] is not None))
+
+    logging.info("Scheduling " + str(len(tasks)) + " weight tasks and " +
+                 str(len(pairs)) + " report tasks on " + str(numworkers) +
+                 " workers, estimated report cost " +
+                 str(report_cost(weightcalcdata, method)) + " each")
+
+    weight_function = partial(calc_weights_task, weightcalcdata,
+                              weightcalculator, box, startindex, size,
+                              method, boxindex)
+    report_function = partial(report_task, weightcalcdata, weightcalculator)
+
+    # Number of delay blocks and results of each combination, with the
+    # blocks keyed by task index so that they can be merged in order
+    blockcounts = dict((pair, 0) for pair in pairs)
+    for task in tasks:
+        blockcounts[task[:2]] += 1
+    blockresults = dict((pair, {}) for pair in pairs)
+    mergedresults = {}
+
+    weightqueue = deque(order)
+    reportqueue = deque()
+    submitted = deque()
+    maxsubmitted = 2 * numworkers
+
+    while weightqueue or reportqueue or submitted:
+        # Reports are submitted first so that causevars complete early
+        while len(submitted) < maxsubmitted and (reportqueue or weightqueue):
+            if reportqueue:
+                pair = reportqueue.popleft()
+                weightlist, _, _, proplist, _, _ = mergedresults[pair]
+                submitted.append(('report', pair, submit_task(
+                    report_function, pair + (weightlist, proplist), pool)))
+            else:
+                n = weightqueue.popleft()
+                submitted.append(('weights', n, submit_task(
+                    weight_function, tasks[n], pool)))
+
+        tasktype, key, result = submitted.popleft()
+
+        if tasktype == 'weights':
+            pair = tasks[key][:2]
+            blockresults[pair][key] = result()
+            if len(blockresults[pair]) == blockcounts[pair]:
+                mergedresults[pair] = merge_pair_results(
+                    [blockresults[pair][n]
+                     for n in sorted(blockresults[pair])])
+                del blockresults[pair]
+                reportqueue.append(pair)
+
+        else:
+            causevarindex, affectedvarindex = key
+            pairresults[causevarindex][affectedvarindex] = \
+                tuple(mergedresults.pop(key)) + (result(),)
+            pending[causevarindex].discard(affectedvarindex)
+            if not pending[causevarindex]:
+                yield causevarindex, pairresults.pop(causevarindex)
+
+
+def init_worker(infodynamicsloc, jvm_settings):
+    """Prepares a worker process by applying the JVM settings and, if the
+    location of JIDT is given, starting the JVM so that the startup cost is
+    not incurred during the first transfer entropy calculation."""
+    transentropy.configure_jvm(**jvm_settings)
+    if infodynamicsloc is not None:
+        transentropy.start_jvm(infodynamicsloc)
+
+
+def create_pool(numworkers=None, infodynamicsloc=None, jvm_settings=None):
+    """Creates the worker pool used for parallel weight calculation.
+
+    The pool is intended to be created once and reused for all boxes,
+    methods and settings, as starting the workers (and the JVM inside every
+    worker) is expensive.
+
+    Parameters
+    ----------
+        numworkers : int, optional
+            Number of worker processes. Defaults to the number of CPU cores.
+        infodynamicsloc : path, optional
+            Location of infodynamics.jar. If provided, the JVM is started
+            in every worker when the pool is created.
+        jvm_settings : dict, optional
+            JVM settings applied in every worker, see
+            transentropy.configure_jvm.
+
+    Returns
+    -------
+        pool : WorkerPool
+
+    """
+    if numworkers is None:
+        numworkers = cpu_count()
+    if jvm_settings is None:
+        jvm_settings = {}
+
+    logging.info("Starting pool of " + str(numworkers) + " workers")
+
+    return WorkerPool(processes=numworkers, initializer=init_worker,
+                      initargs=(infodynamicsloc, jvm_settings))
+
+
+def close_pool(pool):
+    """Shuts down a worker pool created by create_pool."""
+    if pool is None:
+        return
+
+    pool.close()
+    pool.join()
+
+
+def run(non_iter_args, pool=None, weightstore=None):
+    """Calculates the weights of a single box, running on the worker pool if
+    provided and in the current process otherwise.
+
+    The pool is not shut down afterwards so that it can be reused.
+
+    If a weightstore dictionary is provided, the weights, properties,
+    dimensionality and pre-screening correlations of every causevar and
+    affectedvar combination are taken from it, keyed by (causevarindex,
+    affectedvarindex), and only the significance stage is repeated.
+    Combinations not yet in the store are calculated in full and added to
+    it.
+
+    """
     [weightcalcdata, weightcalculator,
      box, startindex, size,
      newconnectionmatrix,
@@ -348,21 +1380,49 @@ def run(non_iter_args, do_multiprocessing):
         method, boxindex,
         filename, headerline, writeoutput)
 
-    if do_multiprocessing:
-        pool = Pool(processes=pathos.multiprocessing.cpu_count())
-        pool.map(partial_gaincalc_oneset,
-                 weightcalcdata.causevarindexes)
-
-        # Current solution to no close and join methods on ProcessingPool
-        # https://github.com/uqfoundation/pathos/issues/46
-
-        s = pathos.multiprocessing.__STATE['pool']
-        s.close()
-        s.join()
-        pathos.multiprocessing.__STATE['pool'] = None
+    def storedweights(causevarindex):
+        if weightstore is None:
+            return None
+        return dict((affectedvarindex,
+                     weightstore[(causevarindex, affectedvarindex)])
+                    for affectedvarindex in weightcalcdata.affectedvarindexes
+                    if (causevarindex, affectedvarindex) in weightstore)
+
+    if weightcalcdata.scheduler == 'tasks':
+        if pool is not None:
+            numworkers = pool.ncpus
+        else:
+            numworkers = 1
+
+        # Write the outputs of every causevar as soon as all of its tasks
+        # have completed
+        causevarweights = {}
+        for causevarindex, causevarresults in \
+                run_tasks(non_iter_args, pool, numworkers, weightstore):
+            causevarweights[causevarindex] = partial_gaincalc_oneset(
+                causevarindex, pairresults=causevarresults)
+
+        allpairweights = [causevarweights[causevarindex]
+                          for causevarindex in weightcalcdata.causevarindexes]
+
+    elif pool is not None:
+        allpairweights = pool.map(
+            partial(calc_weights_oneset_task, partial_gaincalc_oneset),
+            [(causevarindex, storedweights(causevarindex))
+             for causevarindex in weightcalcdata.causevarindexes])
 
     else:
-        for causevarindex in weightcalcdata.causevarindexes:
-            partial_gaincalc_oneset(causevarindex)
+        allpairweights = \
+            [calc_weights_oneset_task(
+                partial_gaincalc_oneset,
+                (causevarindex, storedweights(causevarindex)))
+             for causevarindex in weightcalcdata.causevarindexes]
+
+    if weightstore is not None:
+        for causevarindex, pairweights in \
+                zip(weightcalcdata.causevarindexes, allpairweights):
+            for affectedvarindex in pairweights:
+                weightstore[(causevarindex, affectedvarindex)] = \
+                    pairweights[affectedvarindex]
 
     return None
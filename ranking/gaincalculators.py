@@ -4,12 +4,47 @@ used by the gaincalc module.
 
 """
 # Standard libraries
+import hashlib
 import logging
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
+from scipy.signal import fftconvolve
+from scipy.stats import chi2
 
 import data_processing
 import transentropy
+import transentropy_native
+
+# Transfer entropy estimators for which analytic thresholds apply
+analytic_estimators = ['gaussian']
+
+# Per-process cache of surrogate transfer entropies in least recently used
+# order, see TransentWeightcalc.surr_te_key. Workers of a pool do not share
+# it, so surrogates are only reused across settings when the combination
+# is evaluated by the same process.
+surr_te_cache = OrderedDict()
+# Maximum number of surrogate batches in the cache
+surr_te_cache_entries = 4096
+
+# Per-process cache of auto-embedding search results in least recently used
+# order, keyed by estimator, search settings and data, see
+# TransentWeightcalc.search_embedding
+embedding_cache = OrderedDict()
+# Maximum number of search results in the cache
+embedding_cache_entries = 4096
+
+# Per-process thread pools used to evaluate surrogates, keyed by size
+surr_thread_pools = {}
+
+
+def get_surr_thread_pool(threads):
+    """Returns a thread pool of the given size, which is created on first
+    use and reused for the life of the process."""
+    if threads not in surr_thread_pools:
+        surr_thread_pools[threads] = ThreadPool(threads)
+    return surr_thread_pools[threads]
 
 
 class CorrWeightcalc(object):
@@ -32,6 +67,11 @@ class CorrWeightcalc(object):
                             'signchange', 'threshcorr', 'threshdir',
                             'threshpass', 'directionpass', 'dirval']
 
+        # Correlation tensor of the current box, if evaluated at box level
+        self.boxweights = None
+        self.boxvarindexes = None
+        self.boxdelays = None
+
     def calcweight(self, causevardata, affectedvardata, *args):
         """Calculates the correlation between two vectors containing
         timer series data.
@@ -41,6 +81,148 @@ class CorrWeightcalc(object):
         corrval = np.corrcoef(causevardata.T, affectedvardata.T)[1, 0]
         return [corrval], None
 
+    def calcweights_alldelays(self, box, causevarindex, affectedvarindex,
+                              startindex, size, sample_delays):
+        """Calculates the correlation between the causal vector and the
+        affected vector shifted by each of the sample delays in a single pass.
+
+        The cross products for all delays are obtained from one FFT-based
+        correlation, while the means and variances of the shifted affected
+        vectors are obtained from cumulative sums. The result is the same
+        list of weights that repeated calls to calcweight would produce,
+        including NaN for constant vectors.
+
+        """
+        mindelay = min(sample_delays)
+        maxdelay = max(sample_delays)
+
+        causevardata = box[:, causevarindex][startindex:startindex+size]
+        affectedsegment = \
+            box[:, affectedvarindex][startindex+mindelay:
+                                     startindex+size+maxdelay]
+
+        # Constant vectors are not correlated with anything, which the
+        # round-off in the variance sums would otherwise hide
+        changes = np.concatenate(
+            ([0], np.cumsum(np.diff(affectedsegment) != 0)))
+        constant = changes[size-1:] == changes[:len(changes)-size+1]
+        causeconstant = np.all(causevardata == causevardata[0])
+
+        causevardata = causevardata - np.mean(causevardata)
+        # Centre the segment to limit cancellation in the variance sums
+        affectedsegment = affectedsegment - np.mean(affectedsegment)
+
+        # Cross products of the centred causal vector with every window of
+        # the affected segment
+        crossproducts = fftconvolve(affectedsegment, causevardata[::-1],
+                                    mode='valid')
+
+        # Windowed sums and sums of squares of the affected segment
+        cumsum = np.concatenate(([0.], np.cumsum(affectedsegment)))
+        cumsum_sq = np.concatenate(([0.], np.cumsum(affectedsegment**2)))
+        windowsum = cumsum[size:] - cumsum[:-size]
+        windowsum_sq = cumsum_sq[size:] - cumsum_sq[:-size]
+        affectedss = windowsum_sq - (windowsum**2 / size)
+        affectedss[constant] = np.nan
+
+        causess = np.nan if causeconstant else np.sum(causevardata**2)
+
+        windowindexes = [delay - mindelay for delay in sample_delays]
+        corrvals = crossproducts[windowindexes] / \
+            np.sqrt(causess * affectedss[windowindexes])
+
+        return list(corrvals)
+
+    def calcweights_box(self, box, startindex, size, sample_delays,
+                        causevarindexes, affectedvarindexes):
+        """Calculates the correlation between every causal and affected
+        variable for every sample delay in a box.
+
+        Each delay requires a single matrix product between the block of
+        shifted affected vectors and the block of centred causal vectors.
+        The window variances of the affected vectors are obtained from
+        cumulative sums.
+
+        Returns
+        -------
+            boxweights : three-dimensional numpy.ndarray
+                Correlations indexed by (delay, affectedvar, causevar), in the
+                order given by the delay and variable index lists, which are
+                NaN for constant vectors.
+
+        """
+        mindelay = min(sample_delays)
+        maxdelay = max(sample_delays)
+
+        causedata = box[startindex:startindex+size, list(causevarindexes)]
+        affectedsegment = \
+            box[startindex+mindelay:startindex+size+maxdelay,
+                list(affectedvarindexes)]
+
+        # Constant vectors are not correlated with anything, which the
+        # round-off in the variance sums would otherwise hide
+        changes = np.concatenate(
+            (np.zeros((1, affectedsegment.shape[1])),
+             np.cumsum(np.diff(affectedsegment, axis=0) != 0, axis=0)))
+        constant = changes[size-1:] == changes[:len(changes)-size+1]
+        causeconstant = np.all(causedata == causedata[0], axis=0)
+
+        causedata = causedata - np.mean(causedata, axis=0)
+        # Centre the segment to limit cancellation in the variance sums
+        affectedsegment = affectedsegment - np.mean(affectedsegment, axis=0)
+
+        zerorow = np.zeros((1, affectedsegment.shape[1]))
+        cumsum = np.concatenate((zerorow, np.cumsum(affectedsegment, axis=0)))
+        cumsum_sq = np.concatenate(
+            (zerorow, np.cumsum(affectedsegment**2, axis=0)))
+        windowsum = cumsum[size:] - cumsum[:-size]
+        windowsum_sq = cumsum_sq[size:] - cumsum_sq[:-size]
+        affectedss = windowsum_sq - (windowsum**2 / size)
+        affectedss[constant] = np.nan
+
+        causess = np.sum(causedata**2, axis=0)
+        causess[causeconstant] = np.nan
+
+        windowindexes = [delay - mindelay for delay in sample_delays]
+
+        boxweights = np.empty((len(sample_delays), len(affectedvarindexes),
+                               len(causevarindexes)))
+        for delayindex, windowindex in enumerate(windowindexes):
+            # The centred causal block makes centring of the affected
+            # window unnecessary for the cross products
+            boxweights[delayindex] = np.dot(
+                affectedsegment[windowindex:windowindex+size].T, causedata)
+
+        boxweights /= np.sqrt(affectedss[windowindexes])[:, :, np.newaxis]
+        boxweights /= np.sqrt(causess)[np.newaxis, np.newaxis, :]
+
+        return boxweights
+
+    def set_boxweights(self, weightcalcdata, box, startindex, size):
+        """Evaluates and stores the correlation tensor of a box so that the
+        weights of individual pairs can be looked up by get_boxweights.
+
+        """
+        self.boxvarindexes = (list(weightcalcdata.causevarindexes),
+                              list(weightcalcdata.affectedvarindexes))
+        self.boxdelays = list(weightcalcdata.sample_delays)
+        self.boxweights = self.calcweights_box(
+            box, startindex, size, weightcalcdata.sample_delays,
+            weightcalcdata.causevarindexes, weightcalcdata.affectedvarindexes)
+
+    def get_boxweights(self, causevarindex, affectedvarindex,
+                       sample_delays):
+        """Returns the weights over the specified sample delays for a single
+        pair from the stored correlation tensor.
+
+        """
+        causevarindexes, affectedvarindexes = self.boxvarindexes
+        delayindexes = [self.boxdelays.index(delay)
+                        for delay in sample_delays]
+        return list(self.boxweights[
+            delayindexes, affectedvarindexes.index(affectedvarindex),
+            causevarindexes.index(causevarindex)])
+
     def calcsigthresh(self, *_):
         return [self.threshcorr]
 
@@ -60,8 +242,9 @@ class CorrWeightcalc(object):
         else:
             baseval = weightlist[0]
 
-        maxval = max(weightlist)
-        minval = min(weightlist)
+        # Delays skipped by the delay search have NaN weights
+        maxval = np.nanmax(weightlist)
+        minval = np.nanmin(weightlist)
         # Value used to break tie between maxval and minval if 1 and -1
         tol = 0.
         # Always select maxval if both are equal
@@ -204,18 +387,26 @@ class TransentWeightcalc(object):
                             'bias_mean', 'bias_std',
                             'threshpass', 'directionpass',
                             'k_hist_fwd', 'k_tau_fwd', 'l_hist_fwd',
-                            'l_tau_fwd', 'delay_fwd',
+                            'l_tau_fwd', 'delay_fwd', 'threads_fwd',
                             'k_hist_bwd', 'k_tau_bwd', 'l_hist_bwd',
-                            'l_tau_bwd', 'delay_bwd']
+                            'l_tau_bwd', 'delay_bwd', 'threads_bwd']
 
         self.estimator = estimator
         self.infodynamicsloc = weightcalcdata.infodynamicsloc
         if weightcalcdata.sigtest:
             self.te_thresh_method = weightcalcdata.te_thresh_method
 
-        if self.estimator == 'kraskov':
+        if self.estimator in ['kraskov', 'kraskov_native', 'gaussian',
+                              'discrete', 'discrete_native']:
             self.parameters = weightcalcdata.additional_parameters
 
+        # Use the thread count of JIDT Kraskov estimates that fits in the
+        # cores left to each worker process
+        if self.estimator == 'kraskov':
+            self.parameters = dict(
+                self.parameters,
+                estimator_threads=weightcalcdata.estimator_threads)
+
         # Test if parameters dictionary exists
         try:
             self.parameters.keys()
@@ -223,11 +414,381 @@ class TransentWeightcalc(object):
             self.parameters = {}
 
         # Add kernel bandwidth to parameters
-        if ((self.estimator == 'kernel') and
+        if ((self.estimator in ['kernel', 'kernel_native']) and
                 (weightcalcdata.kernel_width is not None)):
             self.parameters['kernel_width'] = \
                 weightcalcdata.kernel_width
 
+        # Forward and backward transfer entropy tensors of the current box,
+        # if evaluated at box level
+        self.boxweights = None
+        self.boxvarindexes = None
+        self.boxdelays = None
+        self.boxproperties = None
+        # Auto-embedding search results of the variables of the current box
+        self.boxembeddings = None
+        # Forward and backward properties of every pair if the box weights
+        # are averaged from local transfer entropies
+        self.localproperties = None
+        # Correlation calculator of the current box used to select the
+        # delays at which the transfer entropy is calculated
+        self.prescreen = None
+
+    def set_boxweights(self, weightcalcdata, box, startindex, size):
+        """Evaluates and stores the transfer entropy tensors of a box so
+        that the weights of individual pairs can be looked up by
+        get_boxweights.
+
+        Only the linear-Gaussian estimator with a fixed embedding and the
+        native discrete estimator can be evaluated at box level, for all
+        other cases nothing is stored and the pairs are evaluated
+        separately.
+
+        """
+        if self.estimator == 'gaussian':
+            if self.parameters.get('auto_embed', False):
+                return
+            embedding = [self.parameters.get('k_history', 1),
+                         self.parameters.get('k_tau', 1),
+                         self.parameters.get('l_history', 1),
+                         self.parameters.get('l_tau', 1),
+                         self.parameters.get('delay', 1)]
+            self.boxweights = transentropy_native.gaussian_te_box(
+                box, startindex, size, weightcalcdata.sample_delays,
+                weightcalcdata.causevarindexes,
+                weightcalcdata.affectedvarindexes, *embedding)
+        elif self.estimator == 'discrete_native':
+            k_history = self.parameters.get('destHistoryEmbedLength', 1)
+            embedding = [k_history, 1, 1, 1, 1]
+            self.boxweights = transentropy_native.discrete_te_box(
+                box, startindex, size, weightcalcdata.sample_delays,
+                weightcalcdata.causevarindexes,
+                weightcalcdata.affectedvarindexes,
+                self.parameters.get('base', 2), k_history)
+        else:
+            return
+
+        self.boxvarindexes = (list(weightcalcdata.causevarindexes),
+                              list(weightcalcdata.affectedvarindexes))
+        self.boxdelays = list(weightcalcdata.sample_delays)
+        self.boxproperties = \
+            transentropy_native.native_properties(embedding)
+        self.localproperties = None
+
+    def get_boxweights(self, causevarindex, affectedvarindex,
+                       sample_delays):
+        """Returns the directional and absolute weights over the specified
+        sample delays for a single pair from the stored transfer entropy
+        tensors, together with the forward and backward properties in the
+        format of gaincalc_oneset.calc_pair_weights.
+
+        """
+        causevarindexes, affectedvarindexes = self.boxvarindexes
+        delayindexes = [self.boxdelays.index(delay)
+                        for delay in sample_delays]
+        te_fwd, te_bwd = [tensor[delayindexes,
+                                 affectedvarindexes.index(affectedvarindex),
+                                 causevarindexes.index(causevarindex)]
+                          for tensor in self.boxweights]
+
+        weightlist = [list(te_fwd - te_bwd), list(te_fwd)]
+        if self.localproperties is not None:
+            proplist = [[properties] * len(sample_delays)
+                        for properties in
+                        self.localproperties[(causevarindex,
+                                              affectedvarindex)]]
+        else:
+            proplist = [[self.boxproperties] * len(sample_delays),
+                        [self.boxproperties] * len(sample_delays)]
+
+        return weightlist, proplist
+
+    def set_localweights(self, localstore, start, stop):
+        """Stores the transfer entropy tensors of a box as the averages of
+        the local transfer entropies of gaincalc_oneset.calc_local_store
+        over the window of the box, so that the weights of individual pairs
+        can be looked up by get_boxweights.
+
+        Parameters
+        ----------
+            localstore : dict
+                The cumulative sums of the local transfer entropies of all
+                pairs and delays.
+            start : int
+            stop : int
+                Positions of the window of the box in the data.
+
+        """
+        self.boxweights = [
+            np.transpose(transentropy_native.local_window_means(
+                cumsums, firstindexes, start, stop))
+            for cumsums, firstindexes in zip(localstore['cumsums'],
+                                             localstore['firstindexes'])]
+
+        self.boxvarindexes = localstore['varindexes']
+        self.boxdelays = localstore['sample_delays']
+        self.boxproperties = None
+        self.localproperties = localstore['properties']
+
+    def set_prescreen(self, weightcalcdata, box, startindex, size):
+        """Prepares the correlation of the pairs of a box at all sample
+        delays if te_prescreen_delays is set, which is evaluated at box
+        level unless the correlation engine is set to 'pair'.
+
+        """
+        if weightcalcdata.te_prescreen_delays is None:
+            self.prescreen = None
+            return
+
+        self.prescreen = CorrWeightcalc(weightcalcdata)
+        if weightcalcdata.correlation_engine == 'box':
+            self.prescreen.set_boxweights(weightcalcdata, box, startindex,
+                                          size)
+
+    def prescreen_weights(self, box, startindex, size, causevarindex,
+                          affectedvarindex, sample_delays):
+        """Returns the correlations of a pair over the sample delays from
+        the calculator prepared by set_prescreen, or None if there is
+        none."""
+        if self.prescreen is None:
+            return None
+        if self.prescreen.boxweights is not None:
+            return self.prescreen.get_boxweights(
+                causevarindex, affectedvarindex, sample_delays)
+        return self.prescreen.calcweights_alldelays(
+            box, causevarindex, affectedvarindex, startindex, size,
+            sample_delays)
+
+    def set_boxembeddings(self, weightcalcdata, box, startindex, size):
+        """Runs the auto-embedding search once for every variable of a box,
+        if auto_embed is set, so that it is not repeated for every pair,
+        delay, direction and surrogate.
+
+        The embedding of a variable depends only on its own data, and is
+        searched over its window of the box. It is used both when the
+        variable is the destination and when it is the source.
+
+        This is an approximation for the affected variables, whose data is
+        shifted by the sample delay in every pair. Their embedding is
+        searched over the unshifted window and used at every delay, rather
+        than searched again over every shifted window.
+
+        """
+        if not self.parameters.get('auto_embed', False):
+            self.boxembeddings = None
+            return
+
+        varindexes = set(weightcalcdata.causevarindexes) | \
+            set(weightcalcdata.affectedvarindexes)
+        self.boxembeddings = {}
+        for varindex in varindexes:
+            self.boxembeddings[varindex] = self.search_embedding(
+                box[:, varindex][startindex:startindex+size])
+
+    def search_embedding(self, data):
+        """Returns the history length and embedding delay selected for a
+        signal by the auto-embedding search of the estimator.
+
+        Results are kept in a bounded per-process cache, so that the search
+        over the same data is only done once.
+
+        """
+        data = np.ascontiguousarray(data, dtype=float).ravel()
+        key = (self.estimator, self.parameters.get('k_search_max', 5),
+               self.parameters.get('tau_search_max', 5),
+               self.parameters.get('kraskov_k', 4),
+               hashlib.sha1(data.tobytes()).hexdigest())
+
+        if key in embedding_cache:
+            # Mark as most recently used
+            embedding = embedding_cache.pop(key)
+        elif self.estimator in transentropy_native.native_estimators:
+            embedding = transentropy_native.auto_embedding(
+                data, 'affected', **self.parameters)
+        else:
+            # JIDT searches the destination and source embeddings on their
+            # own signals, so that the destination embedding of the signal
+            # paired with itself is that of the signal
+            _, [_, properties] = transentropy.calc_infodynamics_te(
+                self.infodynamicsloc, self.estimator, data, data,
+                **self.parameters)
+            embedding = [int(properties[0]), int(properties[1])]
+
+        embedding_cache[key] = embedding
+        while len(embedding_cache) > embedding_cache_entries:
+            embedding_cache.popitem(last=False)
+
+        return embedding
+
+    def pair_embeddings(self, causevarindex, affectedvarindex):
+        """Returns the embeddings of the affected and causal variable of a
+        pair from the auto-embedding search results of the current box, or
+        None if these are not available."""
+        if self.boxembeddings is None:
+            return None
+        return (self.boxembeddings[affectedvarindex],
+                self.boxembeddings[causevarindex])
+
+    def embedded_parameters(self, dest_embedding, source_embedding):
+        """Returns the estimator parameters with the auto-embedding search
+        replaced by the given destination and source embeddings. Manually
+        set embedding parameters take precedence as they do over the
+        search."""
+        parameters = dict(self.parameters)
+        parameters['auto_embed'] = False
+        if 'k_history' not in self.parameters and \
+                'k_tau' not in self.parameters:
+            parameters['k_history'], parameters['k_tau'] = dest_embedding
+        if 'l_history' not in self.parameters and \
+                'l_tau' not in self.parameters:
+            parameters['l_history'], parameters['l_tau'] = source_embedding
+        return parameters
+
+    def calc_te(self, affected_data, causal_data, parameters=None):
+        """Calculates the transfer entropy from the causal data to the
+        affected data with the estimator selected for this calculator.
+
+        Native estimators are evaluated in-process, while all others are
+        passed to JIDT. The parameters of the calculator are used unless
+        others are given.
+
+        """
+        if parameters is None:
+            parameters = self.parameters
+
+        if self.estimator in transentropy_native.native_estimators:
+            return transentropy_native.calc_native_te(
+                self.estimator, affected_data, causal_data,
+                **parameters)
+        else:
+            return transentropy.calc_infodynamics_te(
+                self.infodynamicsloc, self.estimator,
+                affected_data, causal_data, **parameters)
+
+    def calc_local_te(self, affected_data, causal_data, parameters=None):
+        """Calculates the local transfer entropy from the causal data to
+        the affected data at every sample, in the same way as calc_te.
+
+        """
+        if parameters is None:
+            parameters = self.parameters
+
+        if self.estimator in transentropy_native.native_estimators:
+            return transentropy_native.calc_native_local_te(
+                self.estimator, affected_data, causal_data,
+                **parameters)
+        else:
+            return transentropy.calc_infodynamics_local_te(
+                self.infodynamicsloc, self.estimator,
+                affected_data, causal_data, **parameters)
+
+    def calc_local_cumsums(self, causevardata, affectedvardata,
+                           causevarindex, affectedvarindex, sample_delays,
+                           cumsums):
+        """Calculates the local transfer entropy of a pair in both
+        directions for every sample delay over the complete data, and
+        writes their cumulative sums to cumsums, from which the averages
+        over any window can be taken with
+        transentropy_native.local_window_means.
+
+        The local values of the complete data are only held for a single
+        delay at a time, and the cumulative sums are written to the
+        provided arrays rather than passed between processes.
+
+        The auto-embedding search results of set_boxembeddings are used if
+        available, so that the embedding of the pair is the same for every
+        delay.
+
+        Parameters
+        ----------
+            cumsums : list of numpy.ndarray
+                Forward and backward arrays indexed by (delay, sample), with
+                one more sample than the data. Samples without an affected
+                sample delay samples later contribute zero.
+
+        Returns
+        -------
+            firstindexes : two-dimensional numpy.ndarray of int
+                Index of the first local value of the forward and backward
+                local transfer entropies, indexed by (direction, delay).
+            properties : list
+                Forward and backward properties.
+
+        """
+        samples = len(causevardata)
+        embeddings = self.pair_embeddings(causevarindex, affectedvarindex)
+        if embeddings is None:
+            parameters_fwd = parameters_bwd = None
+        else:
+            parameters_fwd = self.embedded_parameters(*embeddings)
+            parameters_bwd = self.embedded_parameters(embeddings[1],
+                                                      embeddings[0])
+
+        firstindexes = np.zeros((2, len(sample_delays)), dtype=int)
+        for delayindex, delay in enumerate(sample_delays):
+            logging.info("Now calculating local transfer entropy at "
+                         "delay: " + str(delay))
+            # Samples of the causal variable that are followed by an
+            # affected sample delay samples later
+            start = max(0, -delay)
+            stop = samples - max(0, delay)
+            causaldata = causevardata[start:stop]
+            affecteddata = affectedvardata[start+delay:stop+delay]
+
+            local_fwd, auxdata_fwd = self.calc_local_te(
+                affecteddata, causaldata, parameters_fwd)
+            local_bwd, auxdata_bwd = self.calc_local_te(
+                causaldata, affecteddata, parameters_bwd)
+
+            for direction, (local_te, auxdata) in \
+                    enumerate([(local_fwd, auxdata_fwd),
+                               (local_bwd, auxdata_bwd)]):
+                delaycumsums = cumsums[direction][delayindex]
+                delaycumsums[:start+1] = 0.
+                delaycumsums[start+1:stop+1] = np.cumsum(local_te)
+                delaycumsums[stop+1:] = delaycumsums[stop]
+                firstindexes[direction, delayindex] = auxdata[0]
+
+        return firstindexes, [auxdata_fwd[1], auxdata_bwd[1]]
+
+    def calc_te_pair(self, affected_data, causal_data, embeddings=None):
+        """Calculates the transfer entropy from the causal data to the
+        affected data (forward) as well as in the opposite direction
+        (backward).
+
+        Estimators that support it evaluate both directions in a single pass
+        over shared embeddings and neighbour searches, while all others are
+        called once for each direction.
+
+        If the embeddings of the affected and causal data are given, see
+        pair_embeddings, these are used instead of the auto-embedding
+        search.
+
+        """
+        if self.estimator in transentropy_native.paired_estimators:
+            parameters = self.parameters
+            if embeddings is not None:
+                parameters = dict(parameters,
+                                  affected_embedding=embeddings[0],
+                                  causal_embedding=embeddings[1])
+            [transent_fwd, transent_bwd], [auxdata_fwd, auxdata_bwd] = \
+                transentropy_native.calc_native_te_pair(
+                    self.estimator, affected_data, causal_data,
+                    **parameters)
+        else:
+            if embeddings is None:
+                parameters_fwd = parameters_bwd = None
+            else:
+                parameters_fwd = self.embedded_parameters(*embeddings)
+                parameters_bwd = self.embedded_parameters(
+                    embeddings[1], embeddings[0])
+            transent_fwd, auxdata_fwd = \
+                self.calc_te(affected_data, causal_data, parameters_fwd)
+            transent_bwd, auxdata_bwd = \
+                self.calc_te(causal_data, affected_data, parameters_bwd)
+
+        return [transent_fwd, transent_bwd], [auxdata_fwd, auxdata_bwd]
+
     def calcweight(self, causevardata, affectedvardata, weightcalcdata,
                    causevarindex, affectedvarindex):
         """"Calculates the transfer entropy between two vectors containing
@@ -239,15 +800,10 @@ class TransentWeightcalc(object):
 
         # Pass special estimator specific parameters in here
 
-        transent_fwd, auxdata_fwd = \
-            transentropy.calc_infodynamics_te(
-                self.infodynamicsloc, self.estimator,
-                affectedvardata.T, causevardata.T, **self.parameters)
-
-        transent_bwd, auxdata_bwd = \
-            transentropy.calc_infodynamics_te(
-                self.infodynamicsloc, self.estimator,
-                causevardata.T, affectedvardata.T, **self.parameters)
+        [transent_fwd, transent_bwd], [auxdata_fwd, auxdata_bwd] = \
+            self.calc_te_pair(affectedvardata.T, causevardata.T,
+                              self.pair_embeddings(causevarindex,
+                                                   affectedvarindex))
 
         transent_directional = transent_fwd - transent_bwd
         transent_absolute = transent_fwd
@@ -265,17 +821,18 @@ class TransentWeightcalc(object):
         # Initiate flag indicating whether direction test passed
         directionpass = None
 
+        # Delays skipped by the delay search have NaN weights
         if weightcalcdata.bidirectional_delays:
             baseval = weightlist[(len(weightlist) / 2)]
 
             # Get maximum weight in forward direction
             # This includes all positive delays including zero
             maxval_forward = \
-                max(weightlist[(len(weightlist) - 1) / 2:])
+                np.nanmax(weightlist[(len(weightlist) - 1) / 2:])
             # Get maximum weight in backward direction
             # This includes all negative delays exluding zero
             maxval_backward = \
-                max(weightlist[:(len(weightlist) - 1) / 2])
+                np.nanmax(weightlist[:(len(weightlist) - 1) / 2])
 
             delay_index_forward = weightlist.index(maxval_forward)
             delay_index_backward = weightlist.index(maxval_backward)
@@ -318,7 +875,7 @@ class TransentWeightcalc(object):
 
         else:
             baseval = weightlist[0]
-            maxval = max(weightlist)
+            maxval = np.nanmax(weightlist)
             delay_index = weightlist.index(maxval)
             bestdelay = weightcalcdata.actual_delays[delay_index]
 
@@ -382,6 +939,14 @@ class TransentWeightcalc(object):
         if weightcalcdata.sigtest:
             self.te_thresh_method = weightcalcdata.te_thresh_method
             self.te_surr_method = weightcalcdata.te_surr_method
+            self.surr_seed = weightcalcdata.surr_seed
+            self.surr_cache_size = weightcalcdata.surr_cache_size
+            self.surr_threads = weightcalcdata.surr_threads
+            self.te_thresh_mode = weightcalcdata.te_thresh_mode
+            # The surrogates are taken from the input data rather than a box
+            surr_key = (causevarindex, 'inputdata', startindex, size)
+            embeddings = self.pair_embeddings(causevarindex,
+                                              affectedvarindex)
             # Calculate threshold for transfer entropy
             thresh_causevardata = \
                 inputdata[:, causevarindex][startindex:startindex+size]
@@ -397,17 +962,30 @@ class TransentWeightcalc(object):
                                                startindex + size +
                                                bestdelay_sample_absolute]
 
+            # The absolute case is only decided here if it shares the
+            # best delay of the directional case
+            if delay_index_directional == delay_index_absolute:
+                observed = [maxval_directional, maxval_absolute]
+            else:
+                observed = [maxval_directional, None]
+
             # Do significance calculations for directional case
             if self.te_thresh_method == 'rankorder':
                 threshent_directional, threshent_absolute = \
                     self.thresh_rankorder(
                         thresh_affectedvardata_directional.T,
-                        thresh_causevardata.T)
+                        thresh_causevardata.T, surr_key, observed,
+                        embeddings)
             elif self.te_thresh_method == 'sixsigma':
                 threshent_directional, threshent_absolute = \
                     self.thresh_sixsigma(
                         thresh_affectedvardata_directional.T,
-                        thresh_causevardata.T)
+                        thresh_causevardata.T, surr_key, embeddings)
+            elif self.te_thresh_method == 'analytic':
+                threshent_directional, threshent_absolute = \
+                    self.thresh_analytic(
+                        thresh_affectedvardata_directional.T,
+                        thresh_causevardata.T, embeddings=embeddings)
 
             logging.info("The directional TE threshold is: " +
                          str(threshent_directional[0]))
@@ -424,12 +1002,18 @@ class TransentWeightcalc(object):
                     _, threshent_absolute = \
                         self.thresh_rankorder(
                             thresh_affectedvardata_absolute.T,
-                            thresh_causevardata.T)
+                            thresh_causevardata.T, surr_key,
+                            [None, maxval_absolute], embeddings)
                 elif self.te_thresh_method == 'sixsigma':
                     _, threshent_absolute = \
                         self.thresh_sixsigma(
                             thresh_affectedvardata_absolute.T,
-                            thresh_causevardata.T)
+                            thresh_causevardata.T, surr_key, embeddings)
+                elif self.te_thresh_method == 'analytic':
+                    _, threshent_absolute = \
+                        self.thresh_analytic(
+                            thresh_affectedvardata_absolute.T,
+                            thresh_causevardata.T, embeddings=embeddings)
 
             logging.info("The absolute TE threshold is: " +
                          str(threshent_absolute[0]))
@@ -478,13 +1062,21 @@ class TransentWeightcalc(object):
 
         return datalines
 
-    def calc_surr_te(self, affected_data, causal_data, num):
+    def calc_surr_te(self, affected_data, causal_data, num, surr_key=None,
+                     embeddings=None):
         """Calculates surrogate transfer entropy values for significance
         threshold purposes.
 
         Two methods for generating surrogate data is available:
         iAAFT (Schreiber 2000a) or random_shuffle in time.
 
+        If surr_key is provided, the surrogates are kept in a per-process
+        cache under that key (see data_processing.get_surrogates), so that
+        they are generated only once for all affected variables and delays.
+
+        If the embeddings of the pair are given, see pair_embeddings, the
+        surrogates are evaluated with the same embeddings as the data.
+
         Returns list of surrogate transfer entropy values of length num.
 
         """
@@ -492,43 +1084,142 @@ class TransentWeightcalc(object):
         # The causal (or source) data is replaced by surrogate data,
         # while the affected (or destination) data remains unchanged.
 
-        # Get the causal data in the correct format
-        # for surrogate generation
-        original_causal = np.zeros((1, len(causal_data)))
-        original_causal[0, :] = causal_data
+        surr_tsdata = data_processing.get_surrogates(
+            causal_data, num, self.te_surr_method, self.surr_seed,
+            surr_key, self.surr_cache_size)
 
-        if self.te_surr_method == 'iAAFT':
-            surr_tsdata = \
-                [data_processing.gen_iaaft_surrogates(
-                    original_causal, 10)
-                 for n in range(num)]
+        surr_te_fwd, surr_te_bwd = \
+            self.eval_surr_te(affected_data, surr_tsdata, range(num),
+                              self.surr_te_key(affected_data, causal_data,
+                                               surr_key, embeddings),
+                              embeddings)
 
-        elif self.te_surr_method == 'random_shuffle':
-            surr_tsdata = \
-                [data_processing.shuffle_data(causal_data) for n in range(num)]
+        surr_te_directional = \
+            [surr_te_fwd[n] - surr_te_bwd[n] for n in range(num)]
 
-        surr_te_fwd = []
-        surr_te_bwd = []
-        for n in range(num):
+        surr_te_absolute = [surr_te_fwd[n] for n in range(num)]
 
-            surr_te_fwd.append(transentropy.calc_infodynamics_te(
-                self.infodynamicsloc, self.estimator,
-                affected_data, surr_tsdata[n][0, :],
-                **self.parameters)[0])
+        return surr_te_directional, surr_te_absolute
 
-            surr_te_bwd.append(transentropy.calc_infodynamics_te(
-                self.infodynamicsloc, self.estimator,
-                surr_tsdata[n][0, :], affected_data,
-                **self.parameters)[0])
+    def surr_te_key(self, affected_data, causal_data, surr_key,
+                    embeddings=None):
+        """Returns the key of the surrogate transfer entropies of the given
+        data in the surrogate transfer entropy cache, or None if the
+        surrogates are not cached.
 
-        surr_te_directional = \
-            [surr_te_fwd[n] - surr_te_bwd[n] for n in range(num)]
+        The key identifies the surrogate batch, the estimator and its
+        parameters and embeddings as well as the data, so that the surrogate
+        transfer entropies can be shared by all settings that only differ in
+        their significance stage.
 
-        surr_te_absolute = [surr_te_fwd[n] for n in range(num)]
+        """
+        if surr_key is None:
+            return None
+
+        digests = tuple(
+            hashlib.sha1(np.ascontiguousarray(data, dtype=float).tobytes())
+            .hexdigest() for data in [affected_data, causal_data])
+
+        return tuple(surr_key) + \
+            (self.te_surr_method, self.surr_seed, self.estimator,
+             repr(sorted(self.parameters.items())), repr(embeddings)) + \
+            digests
+
+    def eval_surr_te(self, affected_data, surr_tsdata, indexes,
+                     cachekey=None, embeddings=None):
+        """Evaluates the forward and backward transfer entropy between the
+        affected data and the surrogates with the given indexes.
+
+        If a cache key is provided, surrogates evaluated before under the
+        same key are taken from the cache. As smaller batches of seeded
+        surrogates are the leading rows of larger ones, the 19 rank-order
+        surrogates are then taken from the 30 sixsigma surrogates and vice
+        versa.
+
+        If more than one surrogate thread is configured, the surrogates are
+        evaluated concurrently on a thread pool. JIDT and the native
+        estimators release the GIL during estimation. The results are
+        returned in the order of the indexes and do not depend on the
+        number of threads, as each surrogate is fully determined by its
+        seeded batch.
+
+        """
+        def surr_te_pair(n):
+            [surr_fwd, surr_bwd], _ = self.calc_te_pair(
+                affected_data, surr_tsdata[n], embeddings)
+            return surr_fwd, surr_bwd
+
+        if cachekey is None:
+            cached = {}
+        else:
+            # Mark as most recently used
+            cached = surr_te_cache.pop(cachekey, {})
+            surr_te_cache[cachekey] = cached
+            while len(surr_te_cache) > surr_te_cache_entries:
+                surr_te_cache.popitem(last=False)
+
+        missing = [n for n in indexes if n not in cached]
+        if self.surr_threads > 1:
+            results = get_surr_thread_pool(self.surr_threads).map(
+                surr_te_pair, missing)
+        else:
+            results = [surr_te_pair(n) for n in missing]
+        cached.update(zip(missing, results))
+
+        return [cached[n][0] for n in indexes], \
+            [cached[n][1] for n in indexes]
+
+    def calc_surr_te_sequential(self, affected_data, causal_data, num,
+                                surr_key=None, observed=None,
+                                embeddings=None):
+        """Calculates surrogate transfer entropy values one at a time until
+        the rank-order significance test is decided.
+
+        The test of an observed value fails as soon as a surrogate exceeds
+        it (or if it is not positive), while a pass is only guaranteed once
+        all num surrogates have been evaluated. Evaluation stops once the
+        tests of both the observed directional and absolute values have
+        failed. An observed value of None is not tested.
+
+        Returns lists of the directional and absolute surrogate transfer
+        entropy values evaluated, of length num at most.
+
+        """
+        surr_tsdata = data_processing.get_surrogates(
+            causal_data, num, self.te_surr_method, self.surr_seed,
+            surr_key, self.surr_cache_size)
+
+        def decided(observed_value, surr_te):
+            return (observed_value is None or not observed_value > 0 or
+                    max(surr_te) > observed_value)
+
+        cachekey = self.surr_te_key(affected_data, causal_data, surr_key,
+                                    embeddings)
+
+        # Surrogates are evaluated in rounds of one per thread
+        surr_te_directional = []
+        surr_te_absolute = []
+        for start in range(0, num, self.surr_threads):
+            surr_te_fwd, surr_te_bwd = self.eval_surr_te(
+                affected_data, surr_tsdata,
+                range(start, min(start + self.surr_threads, num)), cachekey,
+                embeddings)
+
+            surr_te_directional += [surr_fwd - surr_bwd for surr_fwd, surr_bwd
+                                    in zip(surr_te_fwd, surr_te_bwd)]
+            surr_te_absolute += surr_te_fwd
+
+            if decided(observed[0], surr_te_directional) and \
+                    decided(observed[1], surr_te_absolute):
+                break
+
+        logging.info("Evaluated " + str(len(surr_te_directional)) + " of " +
+                     str(num) + " surrogates")
 
         return surr_te_directional, surr_te_absolute
 
-    def thresh_rankorder(self, affected_data, causal_data):
+    def thresh_rankorder(self, affected_data, causal_data, surr_key=None,
+                         observed=None, embeddings=None):
         """Calculates the minimum threshold required for a transfer entropy
         value to be considered significant.
 
@@ -540,9 +1231,21 @@ class TransentWeightcalc(object):
         Alternatively, the second highest from 38 observations can be taken,
         etc.
 
+        If the observed directional and absolute values are provided and the
+        sequential threshold mode is used, surrogates are only evaluated
+        until the test is decided. The threshold then still decides the test
+        in the same way, but the threshold, bias mean and standard deviation
+        are those of the surrogates evaluated.
+
         """
-        surr_te_directional, surr_te_absolute = \
-            self.calc_surr_te(affected_data, causal_data, 19)
+        if observed is not None and self.te_thresh_mode == 'sequential':
+            surr_te_directional, surr_te_absolute = \
+                self.calc_surr_te_sequential(affected_data, causal_data, 19,
+                                             surr_key, observed, embeddings)
+        else:
+            surr_te_directional, surr_te_absolute = \
+                self.calc_surr_te(affected_data, causal_data, 19, surr_key,
+                                  embeddings)
 
         threshent_directional = max(surr_te_directional)
         nullbias_directional = np.mean(surr_te_directional)
@@ -555,7 +1258,8 @@ class TransentWeightcalc(object):
         return [threshent_directional, nullbias_directional, nullstd_directional], \
                [threshent_absolute, nullbias_absolute, nullstd_absolute]
 
-    def thresh_sixsigma(self, affected_data, causal_data):
+    def thresh_sixsigma(self, affected_data, causal_data, surr_key=None,
+                        embeddings=None):
         """Calculates the minimum threshold required for a transfer entropy
         value to be considered significant.
 
@@ -564,7 +1268,8 @@ class TransentWeightcalc(object):
 
         """
         surr_te_directional, surr_te_absolute = \
-            self.calc_surr_te(affected_data, causal_data, 30)
+            self.calc_surr_te(affected_data, causal_data, 30, surr_key,
+                              embeddings)
 
         surr_te_directional_mean = np.mean(surr_te_directional)
         surr_te_directional_stdev = np.std(surr_te_directional)
@@ -581,15 +1286,76 @@ class TransentWeightcalc(object):
         return [threshent_directional, surr_te_directional_mean, surr_te_directional_stdev], \
                [threshent_absolute, surr_te_absolute_mean, surr_te_absolute_stdev]
 
-    def calcsigthresh(self, weightcalcdata, affected_data, causal_data):
+    def thresh_analytic(self, affected_data, causal_data, alpha=0.05,
+                        embeddings=None):
+        """Calculates the minimum threshold required for a transfer entropy
+        value to be considered significant from the analytic null
+        distribution of the linear-Gaussian estimator, without surrogates.
+
+        Under the null hypothesis 2N times the transfer entropy in nats is
+        asymptotically chi-square distributed with as many degrees of freedom
+        as there are source history terms, where N is the number of
+        observations (Barnett2012). The absolute threshold is the (1 - alpha)
+        quantile of this distribution, converted to bits, with the bias mean
+        and standard deviation those of the distribution.
+
+        The same threshold is used for the directional case, which is
+        conservative as the directional value never exceeds the forward
+        value. Its null distribution has zero mean, with the standard
+        deviation of the difference of two independent forward estimates.
+
+        This distribution only applies to the linear-Gaussian estimator.
+
+        """
+        if self.estimator not in analytic_estimators:
+            raise ValueError("Analytic thresholds do not apply to the " +
+                             self.estimator + " estimator")
+
+        if embeddings is None:
+            parameters = self.parameters
+        else:
+            parameters = self.embedded_parameters(*embeddings)
+
+        k_history = int(parameters.get('k_history', 1))
+        k_tau = int(parameters.get('k_tau', 1))
+        l_history = int(parameters.get('l_history', 1))
+        l_tau = int(parameters.get('l_tau', 1))
+        delay = int(parameters.get('delay', 1))
+
+        # Number of observations after embedding
+        starttime = max((k_history - 1) * k_tau,
+                        (l_history - 1) * l_tau + delay - 1)
+        observations = len(affected_data) - starttime - 1
+
+        # Scales the chi-square distribution to transfer entropy in bits
+        scale = 1. / (2 * observations * np.log(2.))
+
+        threshent_absolute = chi2.ppf(1 - alpha, l_history) * scale
+        nullbias_absolute = l_history * scale
+        nullstd_absolute = np.sqrt(2 * l_history) * scale
+
+        return [threshent_absolute, 0., np.sqrt(2) * nullstd_absolute], \
+               [threshent_absolute, nullbias_absolute, nullstd_absolute]
+
+    def calcsigthresh(self, weightcalcdata, affected_data, causal_data,
+                      surr_key=None, embeddings=None):
         # print affected_data
         # print causal_data
         self.te_thresh_method = weightcalcdata.te_thresh_method
         self.te_surr_method = weightcalcdata.te_surr_method
+        self.surr_seed = weightcalcdata.surr_seed
+        self.surr_cache_size = weightcalcdata.surr_cache_size
+        self.surr_threads = weightcalcdata.surr_threads
         if self.te_thresh_method == 'rankorder':
             threshent_directional, threshent_absolute = \
-                self.thresh_rankorder(affected_data, causal_data)
+                self.thresh_rankorder(affected_data, causal_data, surr_key,
+                                      embeddings=embeddings)
         elif self.te_thresh_method == 'sixsigma':
             threshent_directional, threshent_absolute = \
-                self.thresh_sixsigma(affected_data, causal_data)
+                self.thresh_sixsigma(affected_data, causal_data, surr_key,
+                                     embeddings)
+        elif self.te_thresh_method == 'analytic':
+            threshent_directional, threshent_absolute = \
+                self.thresh_analytic(affected_data, causal_data,
+                                     embeddings=embeddings)
         return [threshent_directional[0], threshent_absolute[0]]
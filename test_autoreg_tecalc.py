@@ -7,10 +7,28 @@ an example on autoregressive data with known time delay.
 import unittest
 
 import jpype
+import numpy as np
 from sklearn import preprocessing
 
 from transentropy import calc_infodynamics_te as te_info
+from transentropy_native import calc_native_te as te_native
+from transentropy_native import calc_native_local_te as local_te_native
+from transentropy_native import discrete_te_box, gaussian_te_box
 from datagen import autoreg_datagen
+import gaincalculators
+
+
+class EmbeddingWeightcalcData(object):
+    """Settings required to set up a native weight calculator with
+    auto-embedding."""
+
+    def __init__(self, additional_parameters):
+        self.infodynamicsloc = "infodynamics.jar"
+        self.sigtest = False
+        self.kernel_width = None
+        self.additional_parameters = additional_parameters
+        self.causevarindexes = [0]
+        self.affectedvarindexes = [1]
 
 
 class TestAutoregressiveTransferEntropy(unittest.TestCase):
@@ -137,5 +155,194 @@ class TestAutoregressiveTransferEntropy(unittest.TestCase):
         delayedval = self.entropies_infodyn_kraskov[self.delay]
         self.assertEqual(maxval, delayedval)
 
+    def test_peakentropy_native_kraskov_noautoembed(self):
+        self.entropies_native_kraskov = []
+        for timelag in range(self.delay-5, self.delay+6):
+            print("Results for timelag of: ", str(timelag))
+            [x_pred, x_hist, y_hist] = autoreg_datagen(self.delay, timelag,
+                                                       self.samples,
+                                                       self.sub_samples)
+
+            x_hist_norm = preprocessing.scale(x_hist, axis=1)
+            y_hist_norm = preprocessing.scale(y_hist, axis=1)
+
+            # Calculate transfer entropy according to native method:
+
+            result_native, [significance, properties] = \
+                te_native('kraskov_native',
+                          x_hist_norm[0], y_hist_norm[0],
+                          test_significance=False,
+                          auto_embed=False)
+            self.entropies_native_kraskov.append(result_native)
+            print("Native TE result: %.4f bits" % result_native)
+
+            print(properties)
+
+        print(self.entropies_native_kraskov)
+
+        maxval = max(self.entropies_native_kraskov)
+        # The maximum lags with one sample
+        delayedval = self.entropies_native_kraskov[self.delay]
+        self.assertEqual(maxval, delayedval)
+
+    def test_native_kernel_matches_infodyn(self):
+        [_, x_hist, y_hist] = autoreg_datagen(
+            self.delay, self.delay, self.samples, self.sub_samples)
+
+        x_hist_norm = preprocessing.scale(x_hist, axis=1)
+        y_hist_norm = preprocessing.scale(y_hist, axis=1)
+
+        result_infodyn, _ = te_info(
+            'infodynamics.jar', 'kernel',
+            x_hist_norm[0], y_hist_norm[0],
+            **{'kernel_width': 0.1})
+        result_native, _ = te_native(
+            'kernel_native', x_hist_norm[0], y_hist_norm[0],
+            **{'kernel_width': 0.1})
+        print("Infodynamics TE result: %.4f bits" % result_infodyn)
+        print("Native TE result: %.4f bits" % result_native)
+
+        self.assertAlmostEqual(result_infodyn, result_native, places=6)
+
+    def test_peakentropy_native_gaussian(self):
+        self.entropies_native_gaussian = []
+        for timelag in range(self.delay-5, self.delay+6):
+            print("Results for timelag of: ", str(timelag))
+            [x_pred, x_hist, y_hist] = autoreg_datagen(self.delay, timelag,
+                                                       self.samples,
+                                                       self.sub_samples)
+
+            x_hist_norm = preprocessing.scale(x_hist, axis=1)
+            y_hist_norm = preprocessing.scale(y_hist, axis=1)
+
+            # Calculate transfer entropy according to linear-Gaussian method:
+
+            result_native, _ = te_native('gaussian',
+                                         x_hist_norm[0], y_hist_norm[0])
+            self.entropies_native_gaussian.append(result_native)
+            print("Gaussian TE result: %.4f bits" % result_native)
+
+        print(self.entropies_native_gaussian)
+
+        maxval = max(self.entropies_native_gaussian)
+        # The maximum lags with one sample
+        delayedval = self.entropies_native_gaussian[self.delay]
+        self.assertEqual(maxval, delayedval)
+
+    def test_native_box_matches_pair(self):
+        [_, x_hist, y_hist] = autoreg_datagen(
+            self.delay, 0, self.samples, self.sub_samples)
+
+        box = np.column_stack((preprocessing.scale(x_hist[0]),
+                               preprocessing.scale(y_hist[0])))
+        size = self.sub_samples // 2
+        sample_delays = range(0, 11)
+
+        # Box level evaluation gives the pairwise results in both directions
+        for estimator, te_box in [('gaussian', gaussian_te_box),
+                                  ('discrete_native', discrete_te_box)]:
+            te_fwd, te_bwd = te_box(box, 0, size, sample_delays, [0], [1])
+            for delayindex, delay in enumerate(sample_delays):
+                causevardata = box[0:size, 0]
+                affectedvardata = box[delay:size+delay, 1]
+                result_fwd, _ = te_native(estimator, affectedvardata,
+                                          causevardata)
+                result_bwd, _ = te_native(estimator, causevardata,
+                                          affectedvardata)
+
+                self.assertAlmostEqual(result_fwd, te_fwd[delayindex, 0, 0],
+                                       places=10)
+                self.assertAlmostEqual(result_bwd, te_bwd[delayindex, 0, 0],
+                                       places=10)
+
+    def test_pair_matches_separate(self):
+        [_, x_hist, y_hist] = autoreg_datagen(
+            self.delay, self.delay, self.samples, self.sub_samples)
+
+        x_hist_norm = preprocessing.scale(x_hist[0])
+        y_hist_norm = preprocessing.scale(y_hist[0])
+
+        # The tie-breaking noise of the Kraskov estimator is drawn in a
+        # different order for the separate backward estimate, and is left
+        # out so that both estimates see the same data
+        for estimator, parameters in [
+                ('kraskov_native', {'noise_level': 0}),
+                ('kraskov_native', {'noise_level': 0, 'k_history': 2,
+                                    'l_history': 3, 'delay': 2}),
+                ('gaussian', {}),
+                ('kernel_native', {}),
+                ('kernel', {})]:
+            weightcalcdata = EmbeddingWeightcalcData(parameters)
+            weightcalcdata.kernel_width = 0.5
+            weightcalculator = gaincalculators.TransentWeightcalc(
+                weightcalcdata, estimator)
+
+            [result_fwd, result_bwd], [auxdata_fwd, auxdata_bwd] = \
+                weightcalculator.calc_te_pair(x_hist_norm, y_hist_norm)
+            separate_fwd, separate_auxdata_fwd = weightcalculator.calc_te(
+                x_hist_norm, y_hist_norm)
+            separate_bwd, separate_auxdata_bwd = weightcalculator.calc_te(
+                y_hist_norm, x_hist_norm)
+
+            self.assertAlmostEqual(result_fwd, separate_fwd, places=10)
+            self.assertAlmostEqual(result_bwd, separate_bwd, places=10)
+            self.assertEqual(auxdata_fwd[1], separate_auxdata_fwd[1])
+            self.assertEqual(auxdata_bwd[1], separate_auxdata_bwd[1])
+
+    def test_native_box_embeddings(self):
+        [_, x_hist, y_hist] = autoreg_datagen(
+            self.delay, self.delay, self.samples, self.sub_samples)
+
+        box = np.column_stack((preprocessing.scale(x_hist[0]),
+                               preprocessing.scale(y_hist[0])))
+        size = len(box)
+
+        weightcalcdata = EmbeddingWeightcalcData(
+            {'auto_embed': True, 'k_search_max': 3, 'tau_search_max': 2})
+        weightcalculator = gaincalculators.TransentWeightcalc(
+            weightcalcdata, 'kraskov_native')
+
+        # The search is done once per variable and then taken from the cache
+        weightcalculator.set_boxembeddings(weightcalcdata, box, 0, size)
+        cached = dict(gaincalculators.embedding_cache)
+        weightcalculator.set_boxembeddings(weightcalcdata, box, 0, size)
+        self.assertEqual(cached, gaincalculators.embedding_cache)
+
+        # The searched embeddings give the same result as the search inside
+        # the estimator
+        parameters = weightcalculator.embedded_parameters(
+            *weightcalculator.pair_embeddings(0, 1))
+        self.assertFalse(parameters['auto_embed'])
+        result_auto, [_, properties_auto] = te_native(
+            'kraskov_native', box[:, 1], box[:, 0],
+            **weightcalcdata.additional_parameters)
+        result_fixed, [_, properties_fixed] = te_native(
+            'kraskov_native', box[:, 1], box[:, 0], **parameters)
+
+        self.assertEqual(properties_auto, properties_fixed)
+        self.assertEqual(result_auto, result_fixed)
+
+    def test_native_local_te_averages(self):
+        [_, x_hist, y_hist] = autoreg_datagen(
+            self.delay, self.delay, self.samples, self.sub_samples)
+
+        x_hist_norm = preprocessing.scale(x_hist, axis=1)
+        y_hist_norm = preprocessing.scale(y_hist, axis=1)
+        # The source is otherwise a linear function of the destination and
+        # its past, for which the linear-Gaussian estimate is round-off
+        y_noisy = y_hist_norm[0] + \
+            0.1 * np.random.RandomState(0).normal(size=self.sub_samples)
+
+        # The local values average to the transfer entropy of the data
+        for estimator in ['kraskov_native', 'gaussian', 'kernel_native',
+                          'discrete_native']:
+            result_native, _ = te_native(estimator, x_hist_norm[0], y_noisy)
+            local_te, [firstindex, _] = local_te_native(
+                estimator, x_hist_norm[0], y_noisy)
+
+            self.assertAlmostEqual(result_native,
+                                   local_te[firstindex:].mean(), places=6)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,873 @@
+# -*- coding: utf-8 -*-
+"""Verifies the helper functions that plan the weight calculation.
+
+"""
+
+import hashlib
+import itertools
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from scipy.stats import chi2
+
+import data_processing
+from gaincalc import estimator_threads, plan_settings_sweep, pool_size
+from gaincalc_oneset import SharedArray, calc_local_store, \
+    calc_pair_weights, calc_weights_pair, close_pool, create_pool, \
+    merge_pair_results, prescreen_delays, run_tasks, search_delays, \
+    unpublish_weightcalculator, worker_weightcalculator
+import gaincalculators
+import transentropy
+from transentropy_native import calc_native_te
+
+
+class TestCoreBudget(unittest.TestCase):
+
+    def setUp(self):
+        """Fix the number of cores so that the budget is known"""
+        self.cpu_count = multiprocessing.cpu_count
+        multiprocessing.cpu_count = lambda: 12
+        self.caseconfig = {
+            'scenario': {'settings': ['default', 'threaded']},
+            'default': {},
+            'threaded': {'surr_threads': 2,
+                         'additional_parameters': {'estimator_threads': 3}}}
+
+    def tearDown(self):
+        multiprocessing.cpu_count = self.cpu_count
+
+    def test_pool_size_default(self):
+        self.assertEqual(pool_size({'scenario': {'settings': ['default']},
+                                    'default': {}}, ['scenario']), 12)
+
+    def test_pool_size_threads(self):
+        # Each worker runs two surrogates with three threads each
+        self.assertEqual(pool_size(self.caseconfig, ['scenario']), 2)
+
+    def test_estimator_threads_available(self):
+        self.assertEqual(estimator_threads(None, 1), 12)
+        self.assertEqual(estimator_threads(None, 2, 2), 3)
+        self.assertEqual(estimator_threads(None, 13), 1)
+
+    def test_estimator_threads_requested(self):
+        self.assertEqual(estimator_threads(1, 1), 1)
+        self.assertEqual(estimator_threads(3, 2, 2), 3)
+        self.assertEqual(estimator_threads(8, 2, 2), 3)
+        self.assertEqual(estimator_threads(8, 4, 4), 1)
+
+    def test_budget_not_oversubscribed(self):
+        numworkers = pool_size(self.caseconfig, ['scenario'])
+        threads = estimator_threads(3, numworkers, 2)
+        self.assertLessEqual(numworkers * 2 * threads, 12)
+
+
+class TestSettingsSweep(unittest.TestCase):
+
+    def test_groups(self):
+        weightsettings = {'testsize': 100, 'sampling_rate': 1,
+                          'test_delays': 10}
+        caseconfig = {
+            'rankorder': dict(weightsettings, sigtest=True,
+                              te_thresh_method='rankorder'),
+            'sixsigma': dict(weightsettings, sigtest=True,
+                             te_thresh_method='sixsigma', surr_seed=3),
+            'delays': dict(weightsettings, test_delays=20, sigtest=True,
+                           te_thresh_method='rankorder'),
+            'nosigtest': dict(weightsettings, sigtest=False),
+            'threaded': dict(weightsettings, sigtest=True,
+                             te_thresh_method='rankorder', surr_threads=2)}
+        settings_set = ['rankorder', 'sixsigma', 'delays', 'nosigtest',
+                        'threaded']
+
+        # Settings only differing in their significance stage are grouped,
+        # with the groups in order of first appearance. Within a group the
+        # settings evaluating most surrogates come first, and otherwise keep
+        # their order.
+        self.assertEqual(plan_settings_sweep(caseconfig, settings_set),
+                         [['sixsigma', 'rankorder', 'threaded', 'nosigtest'],
+                          ['delays']])
+
+    def test_single_settings(self):
+        caseconfig = {'first': {'sigtest': False, 'testsize': 100},
+                      'second': {'sigtest': False, 'testsize': 200}}
+        self.assertEqual(plan_settings_sweep(caseconfig,
+                                             ['second', 'first']),
+                         [['second'], ['first']])
+
+
+class TestJVMHelpers(unittest.TestCase):
+
+    def setUp(self):
+        self.jvm_settings = dict(transentropy.jvm_settings)
+
+    def tearDown(self):
+        transentropy.jvm_settings.clear()
+        transentropy.jvm_settings.update(self.jvm_settings)
+
+    def test_jvm_arguments_default(self):
+        # Assertions are off unless requested
+        self.assertEqual(transentropy.jvm_arguments("infodynamics.jar"),
+                         ["-Xms32M", "-Xmx512M",
+                          "-Djava.class.path=infodynamics.jar"])
+
+    def test_jvm_arguments_configured(self):
+        transentropy.configure_jvm(max_heap='4G', assertions=True,
+                                   options=["-XX:+UseParallelGC"])
+        self.assertEqual(transentropy.jvm_arguments("infodynamics.jar"),
+                         ["-Xms32M", "-Xmx4G", "-ea", "-XX:+UseParallelGC",
+                          "-Djava.class.path=infodynamics.jar"])
+        self.assertRaises(NameError, transentropy.configure_jvm,
+                          heap='4G')
+
+    def test_to_java_array(self):
+        transentropy.start_jvm("infodynamics.jar")
+        data = np.arange(12.).reshape(3, 4) / 7.
+
+        # Strided and two-dimensional inputs are transferred in order
+        javaarray = transentropy.to_java_array(data[:, 1])
+        self.assertEqual(list(javaarray), list(data[:, 1]))
+        javaarray = transentropy.to_java_array(data[:, :1])
+        self.assertEqual(list(javaarray), list(data[:, 0]))
+
+        javaarray = transentropy.to_java_array([3, 1, 2], np.int32)
+        self.assertEqual(list(javaarray), [3, 1, 2])
+
+        self.assertRaises(TypeError, transentropy.to_java_array, data,
+                          np.float32)
+
+
+class LocalWeightcalcData(object):
+    """Settings required to calculate the local transfer entropies of a
+    single pair."""
+
+    def __init__(self, inputdata, local_te_store_limit=1024):
+        self.infodynamicsloc = "infodynamics.jar"
+        self.sigtest = False
+        self.kernel_width = None
+        self.additional_parameters = {}
+        self.variables = ['x', 'y']
+        self.causevarindexes = [0]
+        self.affectedvarindexes = [1]
+        self.sample_delays = [0, 1, 2]
+        self.inputdata = inputdata
+        self.boxstartindexes = [0, 100]
+        self.startindex = 0
+        self.testsize = 200
+        self.local_te_store_limit = local_te_store_limit
+
+
+class TestLocalStore(unittest.TestCase):
+
+    def setUp(self):
+        randstate = np.random.RandomState(0)
+        source = randstate.normal(size=301)
+        self.inputdata = np.column_stack(
+            [source[1:], source[:-1] + 0.5 * randstate.normal(size=300)])
+        self.connectionmatrix = np.ones((2, 2))
+        self.storedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.storedir)
+
+    def test_window_means(self):
+        weightcalcdata = LocalWeightcalcData(self.inputdata)
+        weightcalculator = gaincalculators.TransentWeightcalc(
+            weightcalcdata, 'gaussian')
+        localstore = calc_local_store(weightcalcdata, weightcalculator,
+                                      self.connectionmatrix, self.storedir)
+
+        # The cumulative sums of every delay are stored over all samples
+        self.assertEqual(localstore['cumsums'][0].shape, (1, 1, 3, 301))
+        self.assertEqual(localstore['firstindexes'][0].shape, (1, 1, 3))
+
+        # Any window averages to the mean of its local values
+        local_te, [firstindex, _] = weightcalculator.calc_local_te(
+            self.inputdata[1:, 1], self.inputdata[:-1, 0])
+        weightcalculator.set_localweights(localstore, 50, 250)
+        self.assertAlmostEqual(weightcalculator.boxweights[0][1, 0, 0],
+                               local_te[50+firstindex:250].mean(),
+                               places=10)
+
+        # Without a delay a window covering all data averages to the
+        # transfer entropy of the data
+        weightcalculator.set_localweights(localstore, 0, 300)
+        result, _ = calc_native_te('gaussian', self.inputdata[:, 1],
+                                   self.inputdata[:, 0])
+        self.assertAlmostEqual(weightcalculator.boxweights[0][0, 0, 0],
+                               result, places=10)
+
+    def test_store_limit(self):
+        weightcalcdata = LocalWeightcalcData(self.inputdata, 0)
+        weightcalculator = gaincalculators.TransentWeightcalc(
+            weightcalcdata, 'gaussian')
+        self.assertRaises(ValueError, calc_local_store, weightcalcdata,
+                          weightcalculator, self.connectionmatrix,
+                          self.storedir)
+
+
+class TestMergePairResults(unittest.TestCase):
+
+    def test_merge_blocks(self):
+        blockresults = [
+            ([[0.1, 0.2], [0.3, 0.4]], [[1., 2.], [3., 4.]], [False, True],
+             [['a', 'b'], ['c', 'd']], True, [0.7, 0.8]),
+            ([[0.5], [0.6]], [[5.], [6.]], [False], [['e'], ['f']], True,
+             [0.9])]
+
+        self.assertEqual(merge_pair_results(blockresults),
+                         ([[0.1, 0.2, 0.5], [0.3, 0.4, 0.6]],
+                          [[1., 2., 5.], [3., 4., 6.]], [False, True, False],
+                          [['a', 'b', 'e'], ['c', 'd', 'f']], True,
+                          [0.7, 0.8, 0.9]))
+
+
+class TaskWeightcalcData(object):
+    """Settings required to schedule the weight tasks of a box."""
+
+    def __init__(self, inputdata):
+        self.infodynamicsloc = "infodynamics.jar"
+        # Analytic thresholds need no surrogates
+        self.sigtest = True
+        self.te_thresh_method = 'analytic'
+        self.te_surr_method = None
+        self.te_thresh_mode = 'full'
+        self.surr_seed = 0
+        self.surr_cache_size = 256
+        self.surr_threads = 1
+        self.kernel_width = None
+        self.additional_parameters = {}
+        self.variables = ['x', 'y', 'z']
+        self.causevarindexes = [0, 1, 2]
+        self.affectedvarindexes = [0, 1, 2]
+        self.sample_delays = range(11)
+        self.actual_delays = range(11)
+        self.bidirectional_delays = False
+        self.delay_search = 'full'
+        self.te_prescreen_delays = None
+        self.startindex = 0
+        self.testsize = 200
+        self.allthresh = False
+        self.inputdata = inputdata
+
+
+class TestRunTasks(unittest.TestCase):
+
+    def setUp(self):
+        randstate = np.random.RandomState(0)
+        self.box = randstate.normal(size=(220, 3))
+        self.box[1:, 1] += self.box[:-1, 0]
+        self.weightcalcdata = TaskWeightcalcData(self.box)
+        self.weightcalculator = gaincalculators.TransentWeightcalc(
+            self.weightcalcdata, 'gaussian')
+        # The self-loops are skipped
+        self.connectionmatrix = 1 - np.eye(3)
+
+    def serial_results(self, causevarindex, affectedvarindex):
+        """Returns the weights and report of a pair calculated over all
+        delays in a single call."""
+        weightlist, _, _, proplist, _, _ = calc_weights_pair(
+            self.weightcalcdata, self.weightcalculator, self.box, 0, 200,
+            'transfer_entropy_gaussian', 0, causevarindex, affectedvarindex,
+            self.weightcalcdata.sample_delays)
+        return weightlist, self.weightcalculator.report(
+            self.weightcalcdata, causevarindex, affectedvarindex, weightlist,
+            proplist)
+
+    def scheduled_results(self, pool, numworkers):
+        """Returns the weights and reports of all pairs calculated by
+        run_tasks."""
+        # The stored pair only repeats the significance stage, which makes
+        # it cheaper than the others and moves it to the end of the queue
+        weightstore = {(2, 0): calc_pair_weights(
+            self.weightcalcdata, self.weightcalculator, self.box, 0, 200,
+            'transfer_entropy_gaussian', 2, 0,
+            self.weightcalcdata.sample_delays)}
+        non_iter_args = [
+            self.weightcalcdata, self.weightcalculator, self.box, 0, 200,
+            self.connectionmatrix, 'transfer_entropy_gaussian', 0,
+            lambda *_: 'missing', None, False]
+
+        results = {}
+        for causevarindex, causevarresults in \
+                run_tasks(non_iter_args, pool, numworkers, weightstore):
+            for affectedvarindex, pairresults in causevarresults.items():
+                results[(causevarindex, affectedvarindex)] = \
+                    (pairresults[0], pairresults[-1])
+
+        return results
+
+    def check_results(self, results):
+        pairs = [(causevarindex, affectedvarindex)
+                 for causevarindex in range(3)
+                 for affectedvarindex in range(3)
+                 if causevarindex != affectedvarindex]
+        self.assertEqual(sorted(results), pairs)
+        for pair in pairs:
+            self.assertEqual(results[pair], self.serial_results(*pair))
+
+    def test_serial_blocks(self):
+        # Four workers split the delays of each pair into uneven blocks
+        self.check_results(self.scheduled_results(None, 4))
+
+    def test_pool(self):
+        pool = create_pool(2)
+        try:
+            self.check_results(self.scheduled_results(pool, 2))
+        finally:
+            close_pool(pool)
+
+
+class DelaySearchData(object):
+    """Settings of the coarse-to-fine delay search over the given sample
+    delays."""
+
+    def __init__(self, sample_delays, bidirectional_delays):
+        self.infodynamicsloc = "infodynamics.jar"
+        self.sigtest = False
+        self.kernel_width = None
+        self.additional_parameters = {}
+        self.variables = ['x', 'y']
+        self.testsize = 1000
+        self.sample_delays = sample_delays
+        self.actual_delays = [0.5 * delay for delay in sample_delays]
+        self.bidirectional_delays = bidirectional_delays
+        self.delay_search_stride = 4
+        self.delay_search_peaks = 1
+
+
+class TestDelaySearch(unittest.TestCase):
+
+    def setUp(self):
+        self.evaluated = []
+
+    def evaluate_te(self, peakdelay, sidepeakdelay=None):
+        """Returns an evaluate function of a transfer entropy peaking at the
+        given delay, with a peak of half the height at the side peak delay,
+        which records the delays it is called with."""
+        def evaluate(delays):
+            self.evaluated.append(delays)
+            weights = [np.exp(-(delay - peakdelay)**2 / 8.)
+                       for delay in delays]
+            if sidepeakdelay is not None:
+                weights = [weight + 0.5 * np.exp(
+                    -(delay - sidepeakdelay)**2 / 8.)
+                    for weight, delay in zip(weights, delays)]
+            properties = [[delay] for delay in delays]
+            return [weights, weights], [properties, properties], True
+        return evaluate
+
+    def test_unidirectional(self):
+        weightcalcdata = DelaySearchData(range(21), False)
+        weightlist, proplist, twodimensions = search_delays(
+            weightcalcdata, self.evaluate_te(9),
+            'transfer_entropy_gaussian', weightcalcdata.sample_delays)
+
+        # The grid is followed by the delays around its peak at 8
+        self.assertEqual(self.evaluated, [[0, 4, 8, 12, 16, 20],
+                                          [5, 6, 7, 9, 10, 11]])
+        self.assertTrue(twodimensions)
+
+        skipped = [1, 2, 3, 13, 14, 15, 17, 18, 19]
+        for curve in weightlist:
+            self.assertEqual(
+                [delay for delay in range(21) if np.isnan(curve[delay])],
+                skipped)
+        for properties in proplist:
+            self.assertEqual(
+                [delay for delay in range(21) if properties[delay] is None],
+                skipped)
+
+        weightcalculator = gaincalculators.TransentWeightcalc(
+            weightcalcdata, 'gaussian')
+        _, maxval, delay_index, bestdelay, bestdelay_sample, _ = \
+            weightcalculator.select_weights(weightcalcdata, 'x', 'y',
+                                            weightlist[0], True)
+        self.assertEqual((maxval, delay_index, bestdelay, bestdelay_sample),
+                         (1., 9, 4.5, 9))
+
+    def test_bidirectional(self):
+        weightcalcdata = DelaySearchData(range(-10, 11), True)
+        weightlist, _, _ = search_delays(
+            weightcalcdata, self.evaluate_te(3, -6),
+            'transfer_entropy_gaussian', weightcalcdata.sample_delays)
+
+        # The peaks of the grid are refined separately among the negative
+        # delays and among the delays from zero, the base value
+        self.assertEqual(self.evaluated,
+                         [[-10, -6, -2, 0, 2, 6, 10],
+                          [-9, -8, -7, -5, -4, -3, 1, 3, 4, 5]])
+        self.assertEqual([index for index in range(21)
+                          if np.isnan(weightlist[0][index])],
+                         [9, 17, 18, 19])
+
+        weightcalculator = gaincalculators.TransentWeightcalc(
+            weightcalcdata, 'gaussian')
+        _, _, delay_index, bestdelay, _, directionpass = \
+            weightcalculator.select_weights(weightcalcdata, 'x', 'y',
+                                            weightlist[0], True)
+        self.assertEqual((delay_index, bestdelay, directionpass),
+                         (13, 1.5, True))
+
+    def test_correlation_magnitude(self):
+        weightcalcdata = DelaySearchData(range(21), False)
+
+        def evaluate(delays):
+            self.evaluated.append(delays)
+            return [-np.exp(-(delay - 15)**2 / 8.) for delay in delays], \
+                None, False
+
+        weightlist, proplist, twodimensions = search_delays(
+            weightcalcdata, evaluate, 'cross_correlation',
+            weightcalcdata.sample_delays)
+
+        # The negative correlation peak is ranked by its magnitude
+        self.assertEqual(self.evaluated[1], [13, 14, 15, 17, 18, 19])
+        self.assertIsNone(proplist)
+        self.assertFalse(twodimensions)
+
+        dataline = gaincalculators.CorrWeightcalc(weightcalcdata).report(
+            weightcalcdata, 0, 1, weightlist, None)
+        self.assertEqual(dataline[3:6], [-1., '7.5', '15'])
+
+
+class PrescreenWeightcalc(object):
+    """Transfer entropy calculator with a fixed pre-screening correlation
+    that records the delays it is evaluated at, which it reads from the
+    affected data of a box holding the sample indexes."""
+
+    def __init__(self, corrlist, startindex):
+        self.boxweights = None
+        self.prescreen = True
+        self.corrlist = corrlist
+        self.startindex = startindex
+        self.prescreen_calls = 0
+        self.delays = []
+
+    def prescreen_weights(self, *_):
+        self.prescreen_calls += 1
+        return self.corrlist
+
+    def calcweight(self, causevardata, affectedvardata, *_):
+        delay = int(affectedvardata[0]) - self.startindex
+        self.delays.append(delay)
+        return [1., 1.], [[None, [delay]], [None, [delay]]]
+
+
+class TestPrescreenDelays(unittest.TestCase):
+
+    def setUp(self):
+        self.weightcalcdata = DelaySearchData(range(11), False)
+        self.weightcalcdata.te_prescreen_delays = 1
+        self.weightcalcdata.te_prescreen_radius = 1
+        self.corrlist = [0.1, -0.2, 0.1, 0.3, 0.1, 0.2, -0.9, 0.4, 0.1, 0.,
+                         0.6]
+
+    def test_prescreen_delays(self):
+        # The peak is ranked by its magnitude
+        self.assertEqual(prescreen_delays(self.weightcalcdata,
+                                          self.corrlist), [5, 6, 7])
+
+        # Overlapping neighbourhoods are merged and clipped at the ends
+        self.weightcalcdata.te_prescreen_delays = 3
+        self.weightcalcdata.te_prescreen_radius = 2
+        self.assertEqual(prescreen_delays(self.weightcalcdata,
+                                          self.corrlist),
+                         [4, 5, 6, 7, 8, 9, 10])
+
+    def test_prescreen_curve(self):
+        startindex = 10
+        box = np.column_stack([np.zeros(40), np.arange(40.)])
+        weightcalculator = PrescreenWeightcalc(self.corrlist, startindex)
+
+        weightlist, proplist, twodimensions, prescreenlist = \
+            calc_pair_weights(self.weightcalcdata, weightcalculator, box,
+                              startindex, 20, 'transfer_entropy_gaussian',
+                              0, 1, self.weightcalcdata.sample_delays)
+
+        # The transfer entropy is only calculated around the correlation
+        # peak and at the first and last delays
+        self.assertEqual(weightcalculator.delays, [0, 5, 6, 7, 10])
+        self.assertEqual([index for index in range(11)
+                          if not np.isnan(weightlist[0][index])],
+                         [0, 5, 6, 7, 10])
+
+        # The correlations are calculated once and returned with the weights
+        self.assertEqual(weightcalculator.prescreen_calls, 1)
+        self.assertEqual(prescreenlist, self.corrlist)
+
+
+class CorrWeightcalcData(object):
+    """Settings required to correlate the pairs of a box."""
+
+    def __init__(self, testsize, sample_delays):
+        self.testsize = testsize
+        self.sample_delays = sample_delays
+        self.causevarindexes = [0, 1, 2]
+        self.affectedvarindexes = [1, 2, 3]
+
+
+def corrcoef_delays(box, startindex, size, causevarindex, affectedvarindex,
+                    sample_delays):
+    """Returns the correlations of a pair at each delay, evaluated
+    separately with np.corrcoef."""
+    causevardata = box[startindex:startindex+size, causevarindex]
+    return [np.corrcoef(
+        causevardata,
+        box[startindex+delay:startindex+delay+size, affectedvarindex])[1, 0]
+        for delay in sample_delays]
+
+
+class TestCorrelation(unittest.TestCase):
+
+    def setUp(self):
+        self.box = np.random.RandomState(0).normal(size=(60, 4))
+        self.box += np.linspace(0., 3., 60)[:, np.newaxis]
+        # The delays reach both ends of the box
+        self.sample_delays = range(-10, 11)
+        self.weightcalcdata = CorrWeightcalcData(40, self.sample_delays)
+        self.weightcalculator = gaincalculators.CorrWeightcalc(
+            self.weightcalcdata)
+
+    def test_box_matches_corrcoef(self):
+        # A constant variable, and one that is only constant in the windows
+        # of the delays up to zero
+        self.box[:, 2] = 0.1
+        self.box[:50, 3] = 0.
+
+        boxweights = self.weightcalculator.calcweights_box(
+            self.box, 10, 40, self.sample_delays,
+            self.weightcalcdata.causevarindexes,
+            self.weightcalcdata.affectedvarindexes)
+
+        for cause, causevarindex in \
+                enumerate(self.weightcalcdata.causevarindexes):
+            for affected, affectedvarindex in \
+                    enumerate(self.weightcalcdata.affectedvarindexes):
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    expected = corrcoef_delays(
+                        self.box, 10, 40, causevarindex, affectedvarindex,
+                        self.sample_delays)
+                np.testing.assert_allclose(boxweights[:, affected, cause],
+                                           expected, rtol=1e-10, atol=1e-12)
+
+    def test_alldelays_matches_corrcoef(self):
+        randstate = np.random.RandomState(1)
+        affected = [
+            ('random', self.box[:, 1]),
+            # Only the windows of the delays up to zero are constant
+            ('step', np.concatenate((np.zeros(50), np.ones(10)))),
+            ('near constant', 0.1 + 1e-9 * randstate.normal(size=60)),
+            ('offset', 1e6 + 1e-3 * randstate.normal(size=60)),
+            ('constant', np.ones(60) / 10.)]
+        cause = [('random', self.box[:, 0]), ('constant', np.ones(60) / 3.)]
+
+        for (causename, causedata), (affectedname, affecteddata) in \
+                itertools.product(cause, affected):
+            box = np.column_stack((causedata, affecteddata))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                expected = corrcoef_delays(box, 10, 40, 0, 1,
+                                           self.sample_delays)
+            np.testing.assert_allclose(
+                self.weightcalculator.calcweights_alldelays(
+                    box, 0, 1, 10, 40, self.sample_delays),
+                expected, rtol=1e-8, atol=1e-12,
+                err_msg=causename + ' cause, ' + affectedname + ' affected')
+
+
+class TestAnalyticThreshold(unittest.TestCase):
+
+    def setUp(self):
+        randstate = np.random.RandomState(0)
+        self.inputdata = randstate.normal(size=(300, 2))
+
+    def test_chi2_quantile(self):
+        weightcalcdata = LocalWeightcalcData(self.inputdata)
+        weightcalcdata.additional_parameters = {'k_history': 3,
+                                                'l_history': 2}
+        weightcalculator = gaincalculators.TransentWeightcalc(
+            weightcalcdata, 'gaussian')
+
+        # The first two samples only complete the destination history
+        observations = 300 - 2 - 1
+        for alpha in [0.05, 0.01]:
+            threshlist, nulllist = weightcalculator.thresh_analytic(
+                self.inputdata[:, 1], self.inputdata[:, 0], alpha)
+            # Quantile of 2N times the transfer entropy in nats, in bits
+            self.assertAlmostEqual(
+                threshlist[0],
+                chi2.ppf(1 - alpha, 2) / (2 * observations) / np.log(2.),
+                places=12)
+            self.assertEqual(nulllist[0], threshlist[0])
+
+    def test_unsupported_estimator(self):
+        weightcalcdata = LocalWeightcalcData(self.inputdata)
+        weightcalculator = gaincalculators.TransentWeightcalc(
+            weightcalcdata, 'kraskov_native')
+        self.assertRaises(ValueError, weightcalculator.thresh_analytic,
+                          self.inputdata[:, 1], self.inputdata[:, 0])
+
+
+class TestSurrogates(unittest.TestCase):
+
+    def setUp(self):
+        """Generate a skewed autoregressive signal"""
+        randstate = np.random.RandomState(0)
+        innovations = randstate.normal(size=500)
+        signal = np.zeros(500)
+        for index in range(1, 500):
+            signal[index] = 0.9 * signal[index - 1] + innovations[index]
+        self.data = np.exp(signal / 3.)
+
+    def spectrum_errors(self, surrogates):
+        """Returns the RMS error of the Fourier amplitudes of each surrogate
+        relative to those of the data."""
+        amplitudes = np.abs(np.fft.rfft(self.data))
+        return np.sqrt(np.mean(
+            (np.abs(np.fft.rfft(surrogates, axis=1)) - amplitudes)**2,
+            axis=1)) / np.sqrt(np.mean(amplitudes**2))
+
+    def test_iaaft_seed(self):
+        surrogates = data_processing.gen_iaaft_surrogates_batch(
+            self.data, 10, seed=3)
+        np.testing.assert_array_equal(
+            surrogates,
+            data_processing.gen_iaaft_surrogates_batch(self.data, 10, seed=3))
+        # A smaller batch gives the first surrogates of a larger one
+        np.testing.assert_array_equal(
+            surrogates[:4],
+            data_processing.gen_iaaft_surrogates_batch(self.data, 4, seed=3))
+        self.assertFalse(np.array_equal(
+            surrogates,
+            data_processing.gen_iaaft_surrogates_batch(self.data, 10, seed=4)))
+
+    def test_cache_eviction(self):
+        data_processing.clear_surr_cache()
+        # Each batch of ten surrogates takes 40000 bytes, so that two fit
+        # in the cap
+        max_megabytes = 100000. / 2**20
+
+        def get_surrogates(key, num=10):
+            return data_processing.get_surrogates(
+                self.data * (1 + key), num, 'random_shuffle', 0,
+                (key,), max_megabytes)
+
+        get_surrogates(0)
+        get_surrogates(1)
+        # A smaller batch is taken from the cache and marks it as used
+        get_surrogates(0, 5)
+        get_surrogates(2)
+        self.assertEqual([key[0] for key in data_processing.surr_cache],
+                         [0, 2])
+
+        info = data_processing.surr_cache_info()
+        self.assertEqual((info['hits'], info['misses']), (1, 3))
+        self.assertEqual(info['megabytes'], 2 * 40000. / 2**20)
+        self.assertEqual(data_processing.surr_cache_stats['bytes'],
+                         sum(entry.nbytes for entry in
+                             data_processing.surr_cache.values()))
+
+        # A batch larger than the cap is not cached and evicts nothing
+        get_surrogates(3, 30)
+        self.assertEqual([key[0] for key in data_processing.surr_cache],
+                         [0, 2])
+
+        data_processing.clear_surr_cache()
+        self.assertEqual(data_processing.surr_cache_info()['megabytes'], 0)
+
+    def test_iaaft_amplitudes_spectrum(self):
+        surrogates = data_processing.gen_iaaft_surrogates_batch(
+            self.data, 20, seed=0)
+
+        # Every surrogate is a reordering of the data
+        np.testing.assert_array_equal(np.sort(surrogates, axis=1),
+                                      np.tile(np.sort(self.data), (20, 1)))
+        # The Fourier amplitudes are kept close to those of the data, unlike
+        # those of a random shuffle
+        self.assertLess(self.spectrum_errors(surrogates).max(), 0.05)
+        shuffled = data_processing.gen_surrogates(self.data, 20,
+                                                  'random_shuffle', seed=0)
+        self.assertGreater(self.spectrum_errors(shuffled).min(), 0.2)
+
+
+class TestSequentialThreshold(unittest.TestCase):
+
+    def setUp(self):
+        randstate = np.random.RandomState(0)
+        self.causal = randstate.normal(size=300)
+        self.coupled = np.concatenate(([0.], self.causal[:-1])) + \
+            0.5 * randstate.normal(size=300)
+        self.independent = randstate.normal(size=300)
+
+        self.weightcalculator = gaincalculators.TransentWeightcalc(
+            LocalWeightcalcData(None), 'gaussian')
+        self.weightcalculator.te_surr_method = 'random_shuffle'
+        self.weightcalculator.surr_seed = 0
+        self.weightcalculator.surr_cache_size = 256
+        self.weightcalculator.surr_threads = 1
+
+    def threshpass(self, affected, mode):
+        """Returns the directional and absolute rank-order decisions."""
+        [te_fwd, te_bwd], _ = self.weightcalculator.calc_te_pair(
+            affected, self.causal)
+        observed = [te_fwd - te_bwd, te_fwd]
+        self.weightcalculator.te_thresh_mode = mode
+        thresholds = self.weightcalculator.thresh_rankorder(
+            affected, self.causal, observed=observed)
+
+        return [value >= threshold[0] and value > 0
+                for value, threshold in zip(observed, thresholds)]
+
+    def test_clear_pass(self):
+        self.assertEqual(self.threshpass(self.coupled, 'full'), [True, True])
+        self.assertEqual(self.threshpass(self.coupled, 'sequential'),
+                         [True, True])
+
+    def test_clear_fail(self):
+        self.assertEqual(self.threshpass(self.independent, 'full'),
+                         [False, False])
+        self.assertEqual(self.threshpass(self.independent, 'sequential'),
+                         [False, False])
+
+        # The failed tests are decided without evaluating all surrogates
+        [te_fwd, te_bwd], _ = self.weightcalculator.calc_te_pair(
+            self.independent, self.causal)
+        surr_te_directional, _ = \
+            self.weightcalculator.calc_surr_te_sequential(
+                self.independent, self.causal, 19,
+                observed=[te_fwd - te_bwd, te_fwd])
+        self.assertLess(len(surr_te_directional), 19)
+
+
+class TestSurrogateThreads(unittest.TestCase):
+
+    def test_threads_match_serial(self):
+        randstate = np.random.RandomState(0)
+        causal = randstate.normal(size=200)
+        affected = np.concatenate(([0.], causal[:-1])) + \
+            randstate.normal(size=200)
+
+        weightcalculator = gaincalculators.TransentWeightcalc(
+            LocalWeightcalcData(None), 'kraskov_native')
+        weightcalculator.te_surr_method = 'iAAFT'
+        weightcalculator.surr_seed = 0
+        weightcalculator.surr_cache_size = 256
+
+        results = []
+        for threads in [1, 4]:
+            weightcalculator.surr_threads = threads
+            results.append(weightcalculator.calc_surr_te(affected, causal,
+                                                         19))
+
+        self.assertEqual(results[0], results[1])
+
+
+class TestEmbeddingCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_entries = gaincalculators.embedding_cache_entries
+        gaincalculators.embedding_cache_entries = 2
+        gaincalculators.embedding_cache.clear()
+
+    def tearDown(self):
+        gaincalculators.embedding_cache_entries = self.cache_entries
+        gaincalculators.embedding_cache.clear()
+
+    def test_eviction(self):
+        weightcalcdata = LocalWeightcalcData(None)
+        weightcalcdata.additional_parameters = {
+            'auto_embed': True, 'k_search_max': 2, 'tau_search_max': 1}
+        weightcalculator = gaincalculators.TransentWeightcalc(
+            weightcalcdata, 'kraskov_native')
+        signals = np.random.RandomState(0).normal(size=(3, 100))
+
+        embedding = weightcalculator.search_embedding(signals[0])
+        weightcalculator.search_embedding(signals[1])
+        # A repeated search is taken from the cache and marks it as used
+        self.assertEqual(weightcalculator.search_embedding(signals[0]),
+                         embedding)
+        weightcalculator.search_embedding(signals[2])
+
+        # The least recently used result is evicted
+        self.assertEqual(len(gaincalculators.embedding_cache), 2)
+        digests = [key[-1] for key in gaincalculators.embedding_cache]
+        self.assertEqual(digests,
+                         [hashlib.sha1(signals[index].tobytes()).hexdigest()
+                          for index in [0, 2]])
+
+
+class TestWorkerCalculator(unittest.TestCase):
+
+    def setUp(self):
+        self.box = np.random.RandomState(0).normal(size=(60, 4))
+        self.weightcalcdata = CorrWeightcalcData(40, range(-5, 6))
+        self.storedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.storedir)
+
+    def test_corr_boxweights(self):
+        weightcalculator = gaincalculators.CorrWeightcalc(self.weightcalcdata)
+        weightcalculator.set_boxweights(self.weightcalcdata, self.box, 5, 40)
+        workercalculator = worker_weightcalculator(weightcalculator,
+                                                   self.storedir)
+
+        # Only a handle to the tensor is sent to the workers, while the
+        # calculator of the parent keeps the tensor itself
+        self.assertIsInstance(workercalculator.boxweights, SharedArray)
+        self.assertIsInstance(weightcalculator.boxweights, np.ndarray)
+        self.assertEqual(workercalculator.get_boxweights(2, 3, [-5, 0, 5]),
+                         weightcalculator.get_boxweights(2, 3, [-5, 0, 5]))
+
+        unpublish_weightcalculator(workercalculator)
+        self.assertEqual(os.listdir(self.storedir), [])
+
+    def test_transent_boxweights(self):
+        weightcalcdata = LocalWeightcalcData(self.box[:, :2])
+        weightcalculator = gaincalculators.TransentWeightcalc(
+            weightcalcdata, 'gaussian')
+        weightcalculator.set_boxweights(weightcalcdata, self.box, 5, 40)
+        workercalculator = worker_weightcalculator(weightcalculator,
+                                                   self.storedir)
+
+        # The forward and backward tensors are shared separately
+        self.assertEqual([type(tensor)
+                          for tensor in workercalculator.boxweights],
+                         [SharedArray, SharedArray])
+        self.assertEqual(workercalculator.get_boxweights(0, 1, [0, 2]),
+                         weightcalculator.get_boxweights(0, 1, [0, 2]))
+
+        unpublish_weightcalculator(workercalculator)
+        self.assertEqual(os.listdir(self.storedir), [])
+
+    def test_prescreen_boxweights(self):
+        weightcalcdata = LocalWeightcalcData(self.box[:, :2])
+        weightcalcdata.te_prescreen_delays = 1
+        weightcalcdata.correlation_engine = 'box'
+        weightcalculator = gaincalculators.TransentWeightcalc(
+            weightcalcdata, 'kraskov_native')
+        weightcalculator.set_prescreen(weightcalcdata, self.box, 5, 40)
+        workercalculator = worker_weightcalculator(weightcalculator,
+                                                   self.storedir)
+
+        # The correlation tensor of the pre-screening calculator is shared,
+        # without changing the calculator of the parent
+        self.assertIsInstance(workercalculator.prescreen.boxweights,
+                              SharedArray)
+        self.assertIsInstance(weightcalculator.prescreen.boxweights,
+                              np.ndarray)
+        self.assertEqual(
+            workercalculator.prescreen_weights(self.box, 5, 40, 0, 1,
+                                               [0, 1, 2]),
+            weightcalculator.prescreen_weights(self.box, 5, 40, 0, 1,
+                                               [0, 1, 2]))
+
+        unpublish_weightcalculator(workercalculator)
+        self.assertEqual(os.listdir(self.storedir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
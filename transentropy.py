@@ -3,9 +3,105 @@
 
 """
 
+import threading
+
 import jpype
 import numpy as np
 
+# Per-process cache of teCalc objects keyed by thread, estimator and
+# parameters, as teCalc objects cannot be shared between threads
+tecalc_cache = {}
+# Counters used to monitor the effectiveness of the teCalc cache
+tecalc_cache_stats = {'hits': 0, 'misses': 0}
+
+# Options used when starting the JVM for JIDT, see configure_jvm
+jvm_settings = {'initial_heap': '32M',
+                'max_heap': '512M',
+                'assertions': False,
+                'options': []}
+
+
+def configure_jvm(**settings):
+    """Sets the options used when the JVM is started in this process.
+
+    Has no effect on a JVM that has already been started.
+
+    Parameters
+    ----------
+        initial_heap : str, default='32M'
+            Initial heap size, passed as -Xms.
+        max_heap : str, default='512M'
+            Maximum heap size, passed as -Xmx. Large Kraskov windows may
+            require several gigabytes.
+        assertions : bool, default=False
+            Enables Java assertions (-ea), which helps when debugging JIDT
+            but slows it down.
+        options : list of str, default=[]
+            Additional JVM options, for example JIT compiler or garbage
+            collector flags such as "-XX:+UseParallelGC".
+
+    """
+    for setting in settings:
+        if setting not in jvm_settings:
+            raise NameError("JVM setting not recognized: " + setting)
+    jvm_settings.update(settings)
+
+
+def jvm_arguments(infodynamicsloc):
+    """Returns the arguments used to start the JVM according to the current
+    settings."""
+    arguments = ["-Xms" + jvm_settings['initial_heap'],
+                 "-Xmx" + jvm_settings['max_heap']]
+    if jvm_settings['assertions']:
+        arguments.append("-ea")
+    arguments += list(jvm_settings['options'])
+    arguments.append("-Djava.class.path=" + infodynamicsloc)
+
+    return arguments
+
+
+def start_jvm(infodynamicsloc):
+    """Starts the JVM with JIDT on the class path, unless it is already
+    running in this process."""
+    if not jpype.isJVMStarted():
+        jpype.startJVM(jpype.getDefaultJVMPath(),
+                       *jvm_arguments(infodynamicsloc))
+    elif not jpype.isThreadAttachedToJVM():
+        # Threads other than the one that started the JVM must be attached
+        jpype.attachThreadToJVM()
+
+
+def to_java_array(data, dtype=np.float64):
+    """Transfers a one-dimensional signal to a Java primitive array.
+
+    The data is first made into a C-contiguous buffer of the requested type
+    (without copying if it already is one), so that JPype can transfer it
+    to the JVM in bulk through the buffer protocol instead of converting it
+    element by element.
+
+    Parameters
+    ----------
+        data : array_like
+            The signal to transfer.
+        dtype : numpy.float64 or numpy.int32, default=numpy.float64
+            Type of the Java array, double[] or int[] respectively.
+
+    Returns
+    -------
+        javaArray : JArray
+
+    """
+    data = np.ascontiguousarray(data, dtype=dtype).ravel()
+
+    if dtype == np.float64:
+        javatype = jpype.JDouble
+    elif dtype == np.int32:
+        javatype = jpype.JInt
+    else:
+        raise TypeError("Java array type not supported")
+
+    return jpype.JArray(javatype, 1)(data)
+
 
 def setup_infodynamics_te(infodynamicsloc, calcmethod, **parameters):
     """Prepares the teCalc class of the Java Infodyamics Toolkit (JIDT)
@@ -21,12 +117,7 @@ def setup_infodynamics_te(infodynamicsloc, calcmethod, **parameters):
     available in JIDT 1.3.
     """
 
-    if not jpype.isJVMStarted():
-        jpype.startJVM(jpype.getDefaultJVMPath(),
-                       "-Xms32M",
-                       "-Xmx512M",
-                       "-ea",
-                       "-Djava.class.path=" + infodynamicsloc)
+    start_jvm(infodynamicsloc)
 
     if calcmethod == 'kernel':
         teCalcClass = \
@@ -115,6 +206,12 @@ def setup_infodynamics_te(infodynamicsloc, calcmethod, **parameters):
             l_tau = parameters['l_tau']
             teCalc.setProperty("l_TAU", str(l_tau))
 
+        # Number of threads used for the neighbour searches of a single
+        # estimate, JIDT uses all available cores by default
+        if 'estimator_threads' in parameters:
+            estimator_threads = parameters['estimator_threads']
+            teCalc.setProperty("NUM_THREADS", str(estimator_threads))
+
         teCalc.initialise()
 
     elif calcmethod == 'discrete':
@@ -128,15 +225,10 @@ def setup_infodynamics_te(infodynamicsloc, calcmethod, **parameters):
         # destination to condition on - this is k in Schreiber's notation
         # sourceHistoryEmbeddingLength - embedded history length of the source
         # to include - this is l in Schreiber's notation
-        # TODO: Allow these settings to be defined by configuration file
 
         base = parameters.get('base', 2)
-#            print "base default of 2 (binary) is used"
-
         destHistoryEmbedLength = parameters.get('destHistoryEmbedLength', 1)
 
-        base = 2
-        destHistoryEmbedLength = 1
 #        sourceHistoryEmbeddingLength = None  # not used at the moment
         teCalc = teCalcClass(base, destHistoryEmbedLength)
         teCalc.initialise()
@@ -146,6 +238,74 @@ def setup_infodynamics_te(infodynamicsloc, calcmethod, **parameters):
     return teCalc
 
 
+def initialise_infodynamics_te(teCalc, calcmethod, **parameters):
+    """Re-initialises an existing teCalc object so that it can be used for a
+    new set of observations.
+
+    Properties set during setup_infodynamics_te are retained by JIDT, so only
+    the initialisation arguments need to be supplied again.
+
+    """
+    if calcmethod == 'kernel':
+        k = parameters.get('k', 1)
+        kernel_width = parameters.get('kernel_width', 0.25)
+        teCalc.initialise(k, kernel_width)
+    elif calcmethod in ['kraskov', 'discrete']:
+        teCalc.initialise()
+    else:
+        raise NameError("Transfer entropy method name not recognized")
+
+    return teCalc
+
+
+def get_infodynamics_te(infodynamicsloc, calcmethod, **parameters):
+    """Returns an initialised teCalc object for the estimator and parameters
+    specified.
+
+    A calculator previously constructed in this thread with the same
+    estimator and parameters is re-initialised and reused. Otherwise a new
+    calculator is set up and added to the cache.
+
+    """
+    key = (threading.current_thread().ident, calcmethod,
+           repr(sorted(parameters.items())))
+
+    if key in tecalc_cache:
+        tecalc_cache_stats['hits'] += 1
+        teCalc = initialise_infodynamics_te(tecalc_cache[key], calcmethod,
+                                            **parameters)
+    else:
+        tecalc_cache_stats['misses'] += 1
+        teCalc = setup_infodynamics_te(infodynamicsloc, calcmethod,
+                                       **parameters)
+        tecalc_cache[key] = teCalc
+
+    return teCalc
+
+
+def tecalc_cache_info():
+    """Returns the number of hits and misses of the teCalc cache of this
+    process, as well as the resulting hit rate and cache size.
+
+    """
+    hits = tecalc_cache_stats['hits']
+    misses = tecalc_cache_stats['misses']
+    if hits + misses > 0:
+        hit_rate = float(hits) / (hits + misses)
+    else:
+        hit_rate = None
+
+    return {'hits': hits, 'misses': misses, 'hit_rate': hit_rate,
+            'size': len(tecalc_cache)}
+
+
+def clear_tecalc_cache():
+    """Removes all teCalc objects from the cache and resets the counters."""
+    tecalc_cache.clear()
+    tecalc_cache_stats['hits'] = 0
+    tecalc_cache_stats['misses'] = 0
+
+
 def calc_infodynamics_te(infodynamicsloc, calcmethod,
                          affected_data, causal_data, **parameters):
     """Calculates the transfer entropy for a specific timelag (equal to
@@ -160,33 +320,25 @@ def calc_infodynamics_te(infodynamicsloc, calcmethod,
 
     """
 
-    teCalc = setup_infodynamics_te(infodynamicsloc, calcmethod,
-                                   **parameters)
+    teCalc = get_infodynamics_te(infodynamicsloc, calcmethod, **parameters)
 
     test_significance = parameters.get('test_signifiance', False)
     significance_permutations = parameters.get('significance_permutations', 30)
 
-#    sourceArray = causal_data.tolist()
-#    destArray = affected_data.tolist()
-
     if (len(causal_data) != len(affected_data)):
         print("Source length: " + str(len(causal_data)))
         print("Destination length: " + str(len(affected_data)))
         raise ValueError(
             "The source and destination arrays are of different lengths")
 
-    #sourceArrayJava = jpype.JArray(jpype.JDouble, 1)(sourceArray)
-    #destArrayJava = jpype.JArray(jpype.JDouble, 1)(destArray)
-
-#    sourceArrayJava = np.asarray(sourceArray)
-#    destArrayJava = np.asarray(destArray)
-
     if calcmethod == 'discrete':
-        source = map(int, causal_data)
-        dest = map(int, affected_data)
+        source = to_java_array(causal_data, np.int32)
+        dest = to_java_array(affected_data, np.int32)
         teCalc.addObservations(source, dest)
     else:
-        teCalc.setObservations(causal_data, affected_data)
+        source = to_java_array(causal_data)
+        dest = to_java_array(affected_data)
+        teCalc.setObservations(source, dest)
 
     transentropy = teCalc.computeAverageLocalOfObservations()
 
@@ -205,19 +357,94 @@ def calc_infodynamics_te(infodynamicsloc, calcmethod,
     else:
         significance = None
 
-    # Get all important properties from used teCalc
+    return transentropy, [significance, infodynamics_properties(teCalc,
+                                                                calcmethod)]
+
+
+def infodynamics_properties(teCalc, calcmethod):
+    """Returns the embedding properties and number of threads of a teCalc
+    object as strings, or [None] for the discrete estimator."""
     if calcmethod != 'discrete':
         k_history = teCalc.getProperty("k_HISTORY")
         k_tau = teCalc.getProperty("k_TAU")
         l_history = teCalc.getProperty("l_HISTORY")
         l_tau = teCalc.getProperty("l_TAU")
         delay = teCalc.getProperty("DELAY")
+        # Only the Kraskov estimator is multi-threaded
+        if calcmethod == 'kraskov':
+            threads = teCalc.getProperty("NUM_THREADS")
+        else:
+            threads = '1'
 
-        properties = [k_history, k_tau, l_history, l_tau, delay]
+        properties = [k_history, k_tau, l_history, l_tau, delay, threads]
     else:
         properties = [None]
 
-    return transentropy, [significance, properties]
+    return properties
+
+
+def calc_infodynamics_local_te(infodynamicsloc, calcmethod,
+                               affected_data, causal_data, **parameters):
+    """Calculates the local transfer entropy from the causal data to the
+    affected data at every sample with JIDT, see calc_infodynamics_te.
+
+    Returns
+    -------
+        local_te : one-dimensional numpy.ndarray
+            Local transfer entropy in bits at every sample of the affected
+            data, which is zero for the samples preceding the first complete
+            embedding.
+        auxdata : list
+            The index of the first local value, followed by the properties
+            in the format of calc_infodynamics_te.
+
+    """
+    teCalc = get_infodynamics_te(infodynamicsloc, calcmethod, **parameters)
+
+    if (len(causal_data) != len(affected_data)):
+        print("Source length: " + str(len(causal_data)))
+        print("Destination length: " + str(len(affected_data)))
+        raise ValueError(
+            "The source and destination arrays are of different lengths")
+
+    if calcmethod == 'discrete':
+        source = to_java_array(causal_data, np.int32)
+        dest = to_java_array(affected_data, np.int32)
+        teCalc.addObservations(source, dest)
+        local_te = teCalc.computeLocalFromPreviousObservations(source, dest)
+    else:
+        source = to_java_array(causal_data)
+        dest = to_java_array(affected_data)
+        teCalc.setObservations(source, dest)
+        local_te = teCalc.computeLocalOfObservations()
+
+    local_te = np.array(local_te, dtype=float)
+    # Align the local values with the end of the data, where they are only
+    # returned from the first complete embedding onwards
+    local_te = np.concatenate((np.zeros(len(affected_data) - len(local_te)),
+                               local_te))
+
+    # Convert nats to bits if necessary
+    if calcmethod == 'kraskov':
+        local_te = local_te / np.log(2.)
+    elif calcmethod not in ['kernel', 'discrete']:
+        raise NameError("Transfer entropy method name not recognized")
+
+    properties = infodynamics_properties(teCalc, calcmethod)
+
+    # Index of the first sample with a complete embedding
+    if calcmethod == 'kraskov':
+        k_history, k_tau, l_history, l_tau, delay = \
+            [int(value) for value in properties[:5]]
+        firstindex = max((k_history - 1) * k_tau,
+                         (l_history - 1) * l_tau + delay - 1) + 1
+    elif calcmethod == 'kernel':
+        firstindex = parameters.get('k', 1)
+    else:
+        firstindex = parameters.get('destHistoryEmbedLength', 1)
+    local_te[:firstindex] = 0.
+
+    return local_te, [firstindex, properties]
 
 
 def setup_infodynamics_entropy(infodynamicsloc, estimator='kernel',
@@ -246,12 +473,7 @@ def setup_infodynamics_entropy(infodynamicsloc, estimator='kernel',
         entropyCalc : EntropyCalculator JIDT object
 
     """
-    if not jpype.isJVMStarted():
-        jpype.startJVM(jpype.getDefaultJVMPath(),
-                       "-Xms32M",
-                       "-Xmx512M",
-                       "-ea",
-                       "-Djava.class.path=" + infodynamicsloc)
+    start_jvm(infodynamicsloc)
 
     if estimator == 'kernel':
         if mult:
@@ -319,8 +541,7 @@ def calc_infodynamics_entropy(entropyCalc, data, estimator):
         Nats can be converted to bits by division with ln(2).
     """
 
-    dataArray = data.tolist()
-    dataArrayJava = jpype.JArray(jpype.JDouble, 1)(dataArray)
+    dataArrayJava = to_java_array(data)
     entropyCalc.setObservations(dataArrayJava)
     entropy = entropyCalc.computeAverageLocalOfObservations()
     if estimator == 'gaussian':
@@ -0,0 +1,1262 @@
+# -*- coding: utf-8 -*-
+"""Native NumPy/Numba transfer entropy estimators.
+
+These estimators mirror the JIDT calculators wrapped in the transentropy
+module, but run entirely in-process so that no data needs to cross into the
+JVM. Results are returned in bits together with the same auxiliary data
+structure as transentropy.calc_infodynamics_te.
+
+"""
+
+import numpy as np
+from numba import jit
+from scipy.special import digamma
+
+# Estimators implemented in this module
+native_estimators = ['kraskov_native', 'gaussian', 'kernel_native',
+                     'discrete_native']
+# Estimators that can calculate both directions of a pair in a single pass
+paired_estimators = ['kraskov_native', 'gaussian']
+# Determinant of a correlation matrix below which the linear-Gaussian
+# estimator treats the source as collinear with the destination past
+collinear_tolerance = 1e-12
+
+
+@jit(nopython=True, nogil=True)
+def knn_chebyshev(points, nn):
+    """Finds the nn nearest neighbours of every point under the maximum norm
+    by means of a brute-force search.
+
+    Parameters
+    ----------
+        points : two-dimensional numpy.ndarray
+            Observations in rows, embedding dimensions in columns.
+        nn : int
+            Number of nearest neighbours to find.
+
+    Returns
+    -------
+        indexes : two-dimensional numpy.ndarray
+            Indexes of the neighbours of each point, nearest first.
+        distances : two-dimensional numpy.ndarray
+            Maximum norm distances to the neighbours of each point.
+
+    """
+    samples, dims = points.shape
+    indexes = np.zeros((samples, nn), dtype=np.int64)
+    distances = np.empty((samples, nn))
+
+    for i in range(samples):
+        for m in range(nn):
+            distances[i, m] = np.inf
+        for j in range(samples):
+            if j == i:
+                continue
+            dist = 0.
+            for d in range(dims):
+                diff = abs(points[i, d] - points[j, d])
+                if diff > dist:
+                    dist = diff
+            if dist < distances[i, nn - 1]:
+                # Insertion into the sorted list of nearest neighbours
+                m = nn - 1
+                while m > 0 and distances[i, m - 1] > dist:
+                    distances[i, m] = distances[i, m - 1]
+                    indexes[i, m] = indexes[i, m - 1]
+                    m -= 1
+                distances[i, m] = dist
+                indexes[i, m] = j
+
+    return indexes, distances
+
+
+@jit(nopython=True, nogil=True)
+def block_chebyshev(columns, bounds, i, blockdist):
+    """Calculates the maximum norm distance between point i and every point
+    in each of the column blocks delimited by bounds.
+
+    The points are stored column-wise, i.e. with embedding dimensions in rows
+    and observations in columns, so that the inner loop runs over contiguous
+    memory.
+
+    """
+    samples = columns.shape[1]
+    for b in range(len(bounds) - 1):
+        for j in range(samples):
+            blockdist[b, j] = 0.
+        for d in range(bounds[b], bounds[b + 1]):
+            value = columns[d, i]
+            for j in range(samples):
+                diff = abs(value - columns[d, j])
+                if diff > blockdist[b, j]:
+                    blockdist[b, j] = diff
+
+
+@jit(nopython=True, nogil=True)
+def space_chebyshev(blockdist, membership, i, spacedist):
+    """Combines block distances into the maximum norm distance in a space
+    made up of the blocks flagged in membership. The distance of point i to
+    itself is set to infinity so that it is never counted as a neighbour.
+
+    """
+    samples = blockdist.shape[1]
+    for j in range(samples):
+        spacedist[j] = 0.
+    for b in range(blockdist.shape[0]):
+        if membership[b]:
+            for j in range(samples):
+                if blockdist[b, j] > spacedist[j]:
+                    spacedist[j] = blockdist[b, j]
+    spacedist[i] = np.inf
+
+
+@jit(nopython=True, nogil=True)
+def multispace_knn_radii(columns, bounds, spaces, nn):
+    """Finds the distance to the nn-th nearest neighbour of every point in
+    several spaces at once.
+
+    Each space is a union of the column blocks delimited by bounds, so that
+    the distance in every block only needs to be computed once for each pair
+    of points.
+
+    Parameters
+    ----------
+        columns : two-dimensional numpy.ndarray
+            All block dimensions in rows, observations in columns.
+        bounds : one-dimensional numpy.ndarray
+            Row index bounds of the blocks.
+        spaces : two-dimensional numpy.ndarray
+            Membership of each block (columns) in each space (rows).
+        nn : int
+            Number of nearest neighbours.
+
+    Returns
+    -------
+        radii : two-dimensional numpy.ndarray
+            Distance to the nn-th neighbour of each point (columns) in each
+            space (rows).
+
+    """
+    samples = columns.shape[1]
+    numspaces = spaces.shape[0]
+    blockdist = np.empty((len(bounds) - 1, samples))
+    spacedist = np.empty(samples)
+    nearest = np.empty(nn)
+    radii = np.empty((numspaces, samples))
+
+    for i in range(samples):
+        block_chebyshev(columns, bounds, i, blockdist)
+        for s in range(numspaces):
+            space_chebyshev(blockdist, spaces[s], i, spacedist)
+            for m in range(nn):
+                nearest[m] = np.inf
+            for j in range(samples):
+                dist = spacedist[j]
+                if dist < nearest[nn - 1]:
+                    # Insertion into the sorted list of nearest distances
+                    m = nn - 1
+                    while m > 0 and nearest[m - 1] > dist:
+                        nearest[m] = nearest[m - 1]
+                        m -= 1
+                    nearest[m] = dist
+            radii[s, i] = nearest[nn - 1]
+
+    return radii
+
+
+@jit(nopython=True, nogil=True)
+def multispace_counts(columns, bounds, spaces, radii, radiispaces):
+    """Counts the number of other points that lie strictly within the given
+    radius of every point in several spaces at once.
+
+    The spaces are defined as for multispace_knn_radii. Each row of radii
+    is applied to the space indexed by the corresponding entry of
+    radiispaces, so that a space shared by several estimates only has its
+    distances combined once.
+
+    Returns
+    -------
+        counts : two-dimensional numpy.ndarray
+            Counts of each point (columns) for each row of radii (rows).
+
+    """
+    samples = columns.shape[1]
+    numspaces = spaces.shape[0]
+    blockdist = np.empty((len(bounds) - 1, samples))
+    spacedist = np.empty(samples)
+    counts = np.zeros((radii.shape[0], samples), dtype=np.int64)
+
+    for i in range(samples):
+        block_chebyshev(columns, bounds, i, blockdist)
+        for s in range(numspaces):
+            space_chebyshev(blockdist, spaces[s], i, spacedist)
+            for r in range(radii.shape[0]):
+                if radiispaces[r] != s:
+                    continue
+                radius = radii[r, i]
+                count = 0
+                for j in range(samples):
+                    if spacedist[j] < radius:
+                        count += 1
+                counts[r, i] = count
+
+    return counts
+
+
+@jit(nopython=True, nogil=True)
+def box_kernel_counts(columns, bounds, width):
+    """Counts the points within a box kernel of every point in the joint and
+    marginal spaces of a conditional mutual information I(x; y | z).
+
+    A point lies within the kernel if its distance to the centre point is no
+    larger than the kernel width in every dimension, as in JIDT. The centre
+    point itself is included in the counts.
+
+    Instead of comparing all pairs of points, the points are sorted on the
+    first dimension of z, which is part of every space counted. Only the
+    points in the slab of the sorted order that lies within the kernel width
+    along this dimension are compared in the remaining dimensions. The start
+    of the slab of every point is found by bisection, so that the cost is
+    O(N log N) for the sort and the slab lookups plus O(N * slab * d) for
+    the comparisons, where slab is the mean number of points within the
+    kernel width along the sorted dimension and d the number of dimensions.
+    This is O(N log N) only while the slabs stay bounded, and approaches
+    O(N^2) for data concentrated within a few kernel widths.
+
+    Cumulative counts over a grid at the kernel width give exact counts
+    along a single dimension only, since the kernels are centred on the
+    points rather than aligned with the cells, so they are not used for the
+    counts in the joint spaces.
+
+    Parameters
+    ----------
+        columns : two-dimensional numpy.ndarray
+            Dimensions of the x, y and z blocks in rows, observations in
+            columns.
+        bounds : one-dimensional numpy.ndarray
+            Row index bounds of the x, y and z blocks.
+        width : float
+            Kernel width, applied to every dimension.
+
+    Returns
+    -------
+        counts : two-dimensional numpy.ndarray
+            Counts of each point (columns) in the z, yz, xz and xyz spaces
+            (rows).
+
+    """
+    samples = columns.shape[1]
+    sortrow = bounds[2]
+    order = np.argsort(columns[sortrow])
+    key = columns[sortrow][order]
+    counts = np.zeros((4, samples), dtype=np.int64)
+
+    for ii in range(samples):
+        i = order[ii]
+        # Bisect for the start of the slab within the kernel width of
+        # point i, which is the first point passing the same test
+        lo = 0
+        hi = ii
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key[ii] - key[mid] <= width:
+                hi = mid
+            else:
+                lo = mid + 1
+        jj = lo
+        while jj < samples and key[jj] - key[ii] <= width:
+            j = order[jj]
+            jj += 1
+            inside = True
+            for d in range(bounds[2] + 1, bounds[3]):
+                if abs(columns[d, j] - columns[d, i]) > width:
+                    inside = False
+                    break
+            if not inside:
+                continue
+            inside_x = True
+            for d in range(bounds[0], bounds[1]):
+                if abs(columns[d, j] - columns[d, i]) > width:
+                    inside_x = False
+                    break
+            inside_y = True
+            for d in range(bounds[1], bounds[2]):
+                if abs(columns[d, j] - columns[d, i]) > width:
+                    inside_y = False
+                    break
+            counts[0, i] += 1
+            if inside_y:
+                counts[1, i] += 1
+            if inside_x:
+                counts[2, i] += 1
+                if inside_y:
+                    counts[3, i] += 1
+
+    return counts
+
+
+def embed_history(data, history, tau, startindex, samples):
+    """Builds a delay embedding of a single signal.
+
+    Row t contains data[startindex + t], data[startindex + t - tau], ...
+    up to the specified history length.
+
+    """
+    embedding = np.empty((samples, history))
+    for n in range(history):
+        offset = startindex - n * tau
+        embedding[:, n] = data[offset:offset + samples]
+    return embedding
+
+
+def embedding_starttime(k_history, k_tau, l_history, l_tau, delay):
+    """Returns the index of the last destination past value of the first
+    observation that the embedding allows."""
+    return max((k_history - 1) * k_tau,
+               (l_history - 1) * l_tau + delay - 1)
+
+
+def embed_te(affected_data, causal_data, k_history, k_tau,
+             l_history, l_tau, delay, starttime=None):
+    """Embeds a source and destination signal pair for transfer entropy
+    estimation according to the conventions used by JIDT.
+
+    The source embedding ends delay samples before the next value of the
+    destination, while the destination embedding ends on the sample directly
+    preceding the next value.
+
+    A later starttime than the embedding requires can be specified so that
+    different embeddings are evaluated on the same time indexes.
+
+    Returns
+    -------
+        dest_next : two-dimensional numpy.ndarray
+        dest_past : two-dimensional numpy.ndarray
+        source_past : two-dimensional numpy.ndarray
+
+    """
+    # Index of the last destination past value of the first observation
+    if starttime is None:
+        starttime = embedding_starttime(k_history, k_tau, l_history, l_tau,
+                                        delay)
+    samples = len(affected_data) - starttime - 1
+
+    if samples <= 0:
+        raise ValueError("Not enough samples for the requested embedding")
+
+    dest_next = embed_history(affected_data, 1, 1, starttime + 1, samples)
+    dest_past = embed_history(affected_data, k_history, k_tau,
+                              starttime, samples)
+    source_past = embed_history(causal_data, l_history, l_tau,
+                                starttime + 1 - delay, samples)
+
+    return dest_next, dest_past, source_past
+
+
+def ksg_conditional_mi(x, y, z, nn=4):
+    """Estimates the conditional mutual information I(x; y | z) in nats using
+    the first algorithm of Kraskov, Stoegbauer and Grassberger as extended
+    to the conditional case by Frenzel and Pompe.
+
+    """
+    return np.mean(ksg_local_conditional_mi(x, y, z, nn))
+
+
+def ksg_local_conditional_mi(x, y, z, nn=4):
+    """Estimates the local conditional mutual information in nats of every
+    observation with the KSG estimator, see ksg_conditional_mi."""
+    columns = np.ascontiguousarray(np.hstack((x, y, z)).T)
+    bounds = np.cumsum([0, x.shape[1], y.shape[1], z.shape[1]])
+
+    radii = multispace_knn_radii(columns, bounds,
+                                 np.array([[1, 1, 1]]), nn)
+
+    # Marginal spaces xz, yz and z, all searched with the joint space radii
+    n_xz, n_yz, n_z = multispace_counts(
+        columns, bounds, np.array([[1, 0, 1], [0, 1, 1], [0, 0, 1]]),
+        np.repeat(radii, 3, axis=0), np.arange(3))
+
+    return digamma(nn) + digamma(n_z + 1) - digamma(n_xz + 1) - \
+        digamma(n_yz + 1)
+
+
+def kernel_conditional_mi(x, y, z, width=0.25):
+    """Estimates the conditional mutual information I(x; y | z) in nats from
+    box kernel counts in the joint and marginal spaces, in the same way as
+    the JIDT kernel transfer entropy calculator.
+
+    """
+    return np.mean(kernel_local_conditional_mi(x, y, z, width))
+
+
+def kernel_local_conditional_mi(x, y, z, width=0.25):
+    """Estimates the local conditional mutual information in nats of every
+    observation from box kernel counts, see kernel_conditional_mi."""
+    columns = np.ascontiguousarray(np.hstack((x, y, z)).T)
+    bounds = np.cumsum([0, x.shape[1], y.shape[1], z.shape[1]])
+
+    n_z, n_yz, n_xz, n_xyz = box_kernel_counts(columns, bounds, width)
+
+    return np.log((n_xyz.astype(float) / n_xz) / (n_yz.astype(float) / n_z))
+
+
+def quantise(data, base):
+    """Quantises every column of the data into base levels of equal width
+    between the minimum and maximum of the column.
+
+    Signals with base or fewer distinct values, such as alarm or on-off
+    tags with base=2, keep their states. Constant columns are mapped to
+    level zero.
+
+    """
+    data = np.asarray(data, dtype=float)
+    minimum = np.min(data, axis=0)
+    span = np.max(data, axis=0) - minimum
+    span = np.where(span > 0, span, 1.)
+    levels = np.floor((data - minimum) / span * base).astype(np.int64)
+
+    return np.minimum(levels, base - 1)
+
+
+def pack_states(blocks, base):
+    """Packs the columns of an integer block with values below base into a
+    single state code per row."""
+    codes = np.zeros(blocks.shape[0], dtype=np.int64)
+    for column in range(blocks.shape[1]):
+        codes = codes * base + blocks[:, column].astype(np.int64)
+    return codes
+
+
+def discrete_counts_condmi(counts):
+    """Calculates the conditional mutual information I(x; y | z) in nats from
+    joint counts indexed by the x, y and z states over the last three axes.
+
+    """
+    counts = np.asarray(counts, dtype=float)
+    c_xz = np.sum(counts, axis=-2, keepdims=True)
+    c_yz = np.sum(counts, axis=-3, keepdims=True)
+    c_z = np.sum(counts, axis=(-3, -2), keepdims=True)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        terms = counts * np.log(counts * c_z / (c_xz * c_yz))
+    # Empty states do not contribute
+    terms[counts == 0] = 0.
+
+    return np.sum(terms, axis=(-3, -2, -1)) / \
+        np.sum(counts, axis=(-3, -2, -1))
+
+
+def discrete_conditional_mi(x, y, z, base=2):
+    """Estimates the conditional mutual information I(x; y | z) in nats of
+    quantised signals from the joint state counts, which are obtained with
+    a single bincount over packed state codes.
+
+    """
+    numstates = [base**block.shape[1] for block in [x, y, z]]
+    codes = (pack_states(x, base) * numstates[1] +
+             pack_states(y, base)) * numstates[2] + pack_states(z, base)
+    counts = np.bincount(codes, minlength=np.prod(numstates))
+
+    return discrete_counts_condmi(counts.reshape(numstates))
+
+
+def discrete_local_conditional_mi(x, y, z, base=2):
+    """Estimates the local conditional mutual information in nats of every
+    observation of quantised signals from the joint state counts, see
+    discrete_conditional_mi."""
+    numstates = [base**block.shape[1] for block in [x, y, z]]
+    x_codes, y_codes, z_codes = [pack_states(block, base)
+                                 for block in [x, y, z]]
+    codes = (x_codes * numstates[1] + y_codes) * numstates[2] + z_codes
+    counts = np.bincount(codes, minlength=np.prod(numstates))
+    counts = counts.reshape(numstates).astype(float)
+
+    c_xz = np.sum(counts, axis=1)
+    c_yz = np.sum(counts, axis=0)
+    c_z = np.sum(counts, axis=(0, 1))
+
+    # Every observed state has non-zero counts in all spaces
+    return np.log(counts[x_codes, y_codes, z_codes] * c_z[z_codes] /
+                  (c_xz[x_codes, z_codes] * c_yz[y_codes, z_codes]))
+
+
+def discrete_te_box(box, startindex, size, sample_delays,
+                    causevarindexes, affectedvarindexes, base=2, k_history=1):
+    """Calculates the discrete transfer entropy between every causal and
+    affected variable for every sample delay in a box, in both directions.
+
+    Every window is quantised separately, as in the pairwise calculation:
+    the causal windows once and the affected windows once per delay. For
+    each delay and affected variable, the joint states of the pairs with
+    all causal variables are packed into codes offset by pair, so that their
+    joint state counts follow from a single bincount.
+
+    The embedding is that of the JIDT discrete calculator: a destination
+    history of k_history samples and a source history of one sample, with
+    a delay of one sample.
+
+    Returns
+    -------
+        te_fwd : three-dimensional numpy.ndarray
+            Transfer entropies from the causal to the affected variables in
+            bits, indexed by (delay, affectedvar, causevar).
+        te_bwd : three-dimensional numpy.ndarray
+            Transfer entropies in the opposite direction, with the same
+            indexes.
+
+    """
+    samples = size - k_history
+
+    if samples <= 0:
+        raise ValueError("Not enough samples for the requested embedding")
+
+    def window_levels(varindexes, windowstart):
+        # Quantised window of every variable, one variable per row
+        return quantise(box[windowstart:windowstart+size,
+                            list(varindexes)], base).T
+
+    def dest_codes(levels):
+        # Codes of the next value and past of the destination, which end
+        # on the sample before the next value
+        codes = levels[:, k_history:k_history+samples]
+        for n in range(k_history):
+            offset = k_history - 1 - n
+            codes = codes * base + levels[:, offset:offset+samples]
+        return codes
+
+    def source_states(levels):
+        offset = k_history - 1
+        return levels[:, offset:offset+samples]
+
+    deststates = base**(k_history + 1)
+    jointstates = base * deststates
+    # Joint state counts are indexed by (source, next, past)
+    countshape = (base, base, base**k_history)
+
+    def te_pairs(codes):
+        # Transfer entropy of the pairs in the rows of the joint state codes
+        numpairs = codes.shape[0]
+        counts = np.bincount(codes.ravel(), minlength=numpairs*jointstates)
+        counts = counts.reshape((numpairs,) + countshape)
+        # Convert nats to bits
+        return discrete_counts_condmi(counts) / np.log(2.)
+
+    # The causal windows do not depend on the delay. Their contributions to
+    # the joint state codes are offset by pair, so that only the code of
+    # the affected variable needs to be added for each pair.
+    pairoffsets = jointstates * \
+        np.arange(len(causevarindexes))[:, np.newaxis]
+    causelevels = window_levels(causevarindexes, startindex)
+    cause_dest = dest_codes(causelevels) + pairoffsets
+    cause_source = source_states(causelevels) * deststates + pairoffsets
+
+    te_fwd = np.empty((len(sample_delays), len(affectedvarindexes),
+                       len(causevarindexes)))
+    te_bwd = np.empty_like(te_fwd)
+    for delayindex, sample_delay in enumerate(sample_delays):
+        affectedlevels = window_levels(affectedvarindexes,
+                                       startindex + sample_delay)
+        affected_dest = dest_codes(affectedlevels)
+        affected_source = source_states(affectedlevels)
+        for affectedindex in range(len(affectedvarindexes)):
+            te_fwd[delayindex, affectedindex] = te_pairs(
+                cause_source + affected_dest[affectedindex])
+            te_bwd[delayindex, affectedindex] = te_pairs(
+                cause_dest + affected_source[affectedindex] * deststates)
+
+    return te_fwd, te_bwd
+
+
+def gaussian_conditional_mi(x, y, z):
+    """Calculates the conditional mutual information I(x; y | z) in nats of
+    a linear-Gaussian model from the log-determinants of the sample
+    correlation matrices of the joint and marginal spaces.
+
+    """
+    def logdet(*blocks):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            correlation = np.atleast_2d(
+                np.corrcoef(np.hstack(blocks), rowvar=False))
+            return np.linalg.slogdet(correlation)[1]
+
+    return float(gaussian_logdet_condmi(logdet(x, z), logdet(y, z),
+                                        logdet(z), logdet(x, y, z)))
+
+
+def gaussian_logdet_condmi(logdet_xz, logdet_yz, logdet_z, logdet_xyz):
+    """Combines the log-determinants of the correlation matrices of the
+    joint and marginal spaces into the linear-Gaussian conditional mutual
+    information I(x; y | z) in nats.
+
+    The variances cancel in the log-determinant ratios, so that correlation
+    matrices can be used to detect degenerate spaces independently of scale.
+    Where x is collinear with z or a signal is constant, x carries no
+    additional information and the result is zero.
+
+    """
+    with np.errstate(invalid='ignore'):
+        condmi = 0.5 * (logdet_xz + logdet_yz - logdet_z - logdet_xyz)
+        degenerate = np.isnan(condmi) | \
+            (logdet_xz < np.log(collinear_tolerance))
+
+    return np.where(degenerate, 0., condmi)
+
+
+def gaussian_local_conditional_mi(x, y, z):
+    """Calculates the local conditional mutual information in nats of every
+    observation of a linear-Gaussian model, see gaussian_conditional_mi.
+
+    The local values are the log-density ratios of the standardised
+    observations. Since the mean Mahalanobis distance of each space equals
+    its dimension, their mean equals gaussian_conditional_mi. Where the
+    latter is zero because a space is degenerate, all local values are zero.
+
+    """
+    data = np.hstack((x, y, z))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        data = (data - np.mean(data, axis=0)) / np.std(data, axis=0)
+    bounds = np.cumsum([0, x.shape[1], y.shape[1], z.shape[1]])
+    blocks = [range(bounds[n], bounds[n+1]) for n in range(3)]
+
+    def logdensity(*blockindexes):
+        # Log-determinant and Mahalanobis distances of a space
+        columns = [column for n in blockindexes for column in blocks[n]]
+        space = data[:, columns]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            correlation = np.atleast_2d(np.corrcoef(space, rowvar=False))
+            logdet = np.linalg.slogdet(correlation)[1]
+        if not np.isfinite(logdet):
+            return logdet, None
+        distances = np.sum(space * np.linalg.solve(correlation, space.T).T,
+                           axis=1)
+        return logdet, distances
+
+    (ld_xz, m_xz), (ld_yz, m_yz), (ld_z, m_z), (ld_xyz, m_xyz) = [
+        logdensity(*space) for space in [(0, 2), (1, 2), (2,), (0, 1, 2)]]
+
+    if gaussian_logdet_condmi(ld_xz, ld_yz, ld_z, ld_xyz) == 0. or \
+            any(distances is None for distances in [m_xz, m_yz, m_z, m_xyz]):
+        return np.zeros(data.shape[0])
+
+    return 0.5 * (ld_xz + ld_yz - ld_z - ld_xyz) + \
+        0.5 * (m_xz + m_yz - m_z - m_xyz)
+
+
+def local_conditional_mi(calcmethod, x, y, z, **parameters):
+    """Estimates the local conditional mutual information in nats of every
+    observation with the specified native estimator and its parameters, see
+    conditional_mi."""
+    if calcmethod == 'gaussian':
+        return gaussian_local_conditional_mi(x, y, z)
+    elif calcmethod == 'kernel_native':
+        return kernel_local_conditional_mi(
+            x, y, z, parameters.get('kernel_width', 0.25))
+    elif calcmethod == 'discrete_native':
+        return discrete_local_conditional_mi(x, y, z,
+                                             parameters.get('base', 2))
+    else:
+        return ksg_local_conditional_mi(x, y, z,
+                                        parameters.get('kraskov_k', 4))
+
+
+def conditional_mi(calcmethod, x, y, z, **parameters):
+    """Estimates the conditional mutual information I(x; y | z) in nats with
+    the specified native estimator and its parameters."""
+    if calcmethod == 'gaussian':
+        return gaussian_conditional_mi(x, y, z)
+    elif calcmethod == 'kernel_native':
+        return kernel_conditional_mi(x, y, z,
+                                     parameters.get('kernel_width', 0.25))
+    elif calcmethod == 'discrete_native':
+        return discrete_conditional_mi(x, y, z, parameters.get('base', 2))
+    else:
+        return ksg_conditional_mi(x, y, z, parameters.get('kraskov_k', 4))
+
+
+def gaussian_te_blocks(destblocks, sourceblocks):
+    """Calculates the linear-Gaussian transfer entropy in bits from every
+    source variable to every destination variable.
+
+    Parameters
+    ----------
+        destblocks : list of two-dimensional numpy.ndarray
+            Centred windows of the destination variables, with observations
+            in rows and variables in columns. The first window holds the
+            next values and the remaining windows the past values.
+        sourceblocks : list of two-dimensional numpy.ndarray
+            Centred windows of the past values of the source variables.
+
+    Returns
+    -------
+        transentropies : two-dimensional numpy.ndarray
+            Transfer entropies indexed by (destination, source).
+
+    """
+    blocks = destblocks + sourceblocks
+    destdims = len(destblocks)
+    dims = len(blocks)
+    numdest = destblocks[0].shape[1]
+    numsource = sourceblocks[0].shape[1]
+
+    # Covariance matrix of the joint space of every pair, scaled to a
+    # correlation matrix below
+    covariance = np.empty((numdest, numsource, dims, dims))
+    for i in range(dims):
+        for j in range(i, dims):
+            if j < destdims:
+                cov = np.sum(blocks[i] * blocks[j], axis=0)[:, np.newaxis]
+            elif i >= destdims:
+                cov = np.sum(blocks[i] * blocks[j], axis=0)[np.newaxis, :]
+            else:
+                cov = np.dot(blocks[i].T, blocks[j])
+            covariance[:, :, i, j] = cov
+            covariance[:, :, j, i] = cov
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stdev = np.sqrt(np.diagonal(covariance, axis1=2, axis2=3))
+        covariance /= stdev[:, :, :, np.newaxis] * \
+            stdev[:, :, np.newaxis, :]
+
+    def logdet(indexes, pairs=True):
+        if pairs:
+            matrices = covariance
+        else:
+            # The space only contains destination variables
+            matrices = covariance[:, :1]
+        with np.errstate(invalid='ignore'):
+            return np.linalg.slogdet(
+                matrices[:, :, indexes][:, :, :, indexes])[1]
+
+    nextindex = [0]
+    pastindexes = list(range(1, destdims))
+    sourceindexes = list(range(destdims, dims))
+
+    condmi = gaussian_logdet_condmi(
+        logdet(sourceindexes + pastindexes),
+        logdet(nextindex + pastindexes, False),
+        logdet(pastindexes, False),
+        logdet(nextindex + pastindexes + sourceindexes))
+
+    # Convert nats to bits
+    return condmi / np.log(2.)
+
+
+def gaussian_te_box(box, startindex, size, sample_delays,
+                    causevarindexes, affectedvarindexes, k_history=1,
+                    k_tau=1, l_history=1, l_tau=1, delay=1):
+    """Calculates the linear-Gaussian transfer entropy between every causal
+    and affected variable for every sample delay in a box, in both
+    directions.
+
+    Each sample delay shifts the affected window in the same way as the
+    pairwise calculation. The covariances between the destination and
+    source windows of all pairs are obtained from one matrix product per
+    combination of embedding offsets, after which all transfer entropies of
+    a delay follow from batched determinants of small matrices.
+
+    Returns
+    -------
+        te_fwd : three-dimensional numpy.ndarray
+            Transfer entropies from the causal to the affected variables in
+            bits, indexed by (delay, affectedvar, causevar).
+        te_bwd : three-dimensional numpy.ndarray
+            Transfer entropies in the opposite direction, with the same
+            indexes.
+
+    """
+    # Index of the last destination past value of the first observation,
+    # see embed_te
+    starttime = max((k_history - 1) * k_tau,
+                    (l_history - 1) * l_tau + delay - 1)
+    samples = size - starttime - 1
+
+    if samples <= 0:
+        raise ValueError("Not enough samples for the requested embedding")
+
+    destoffsets = [starttime + 1] + \
+        [starttime - n * k_tau for n in range(k_history)]
+    sourceoffsets = [starttime + 1 - delay - n * l_tau
+                     for n in range(l_history)]
+
+    causedata = np.asarray(box[:, list(causevarindexes)], dtype=float)
+    affecteddata = np.asarray(box[:, list(affectedvarindexes)], dtype=float)
+
+    def windows(data, windowstart, offsets):
+        blocks = []
+        for offset in offsets:
+            block = data[windowstart+offset:windowstart+offset+samples]
+            blocks.append(block - np.mean(block, axis=0))
+        return blocks
+
+    # The causal windows do not depend on the delay
+    cause_dest = windows(causedata, startindex, destoffsets)
+    cause_source = windows(causedata, startindex, sourceoffsets)
+
+    te_fwd = np.empty((len(sample_delays), len(affectedvarindexes),
+                       len(causevarindexes)))
+    te_bwd = np.empty_like(te_fwd)
+    for delayindex, sample_delay in enumerate(sample_delays):
+        affected_dest = windows(affecteddata, startindex + sample_delay,
+                                destoffsets)
+        affected_source = windows(affecteddata, startindex + sample_delay,
+                                  sourceoffsets)
+        te_fwd[delayindex] = gaussian_te_blocks(affected_dest, cause_source)
+        te_bwd[delayindex] = \
+            gaussian_te_blocks(cause_dest, affected_source).T
+
+    return te_fwd, te_bwd
+
+
+def ragwitz_embedding(data, k_search_max, tau_search_max, nn=4):
+    """Selects the embedding length and delay of a signal that minimises the
+    local prediction error (Ragwitz criterion).
+
+    Each candidate embedding is scored by predicting the next value of every
+    embedded vector as the mean next value of its nn nearest neighbours.
+
+    Returns
+    -------
+        history : int
+        tau : int
+
+    """
+    best_error = np.inf
+    best_history, best_tau = 1, 1
+
+    for history in range(1, k_search_max + 1):
+        for tau in range(1, tau_search_max + 1):
+            # A history of one is the same for all values of tau
+            if history == 1 and tau > 1:
+                continue
+            starttime = (history - 1) * tau
+            samples = len(data) - starttime - 1
+            if samples <= nn:
+                continue
+            past = embed_history(data, history, tau, starttime, samples)
+            future = data[starttime + 1:starttime + 1 + samples]
+            indexes, _ = knn_chebyshev(past, nn)
+            prediction = future[indexes].mean(axis=1)
+            error = np.mean((future - prediction)**2)
+            if error < best_error:
+                best_error = error
+                best_history, best_tau = history, tau
+
+    return best_history, best_tau
+
+
+def auto_embedding(data, signal, **parameters):
+    """Returns the history length and embedding delay of a signal selected
+    with the Ragwitz criterion.
+
+    The search is skipped if the result is supplied in the parameters as
+    affected_embedding or causal_embedding, according to whether signal is
+    'affected' or 'causal', for example from an earlier search over the
+    same data.
+
+    """
+    if signal + '_embedding' in parameters:
+        return list(parameters[signal + '_embedding'])
+
+    return list(ragwitz_embedding(data,
+                                  parameters.get('k_search_max', 5),
+                                  parameters.get('tau_search_max', 5),
+                                  parameters.get('kraskov_k', 4)))
+
+
+def setup_native_te(affected_data, causal_data, **parameters):
+    """Resolves the embedding parameters of a native transfer entropy
+    estimate, defaulting to the same values as JIDT.
+
+    If auto_embed is set, the destination and source embeddings are selected
+    with the Ragwitz criterion, unless manually overridden.
+
+    """
+    k_history = parameters.get('k_history', 1)
+    k_tau = parameters.get('k_tau', 1)
+    l_history = parameters.get('l_history', 1)
+    l_tau = parameters.get('l_tau', 1)
+    delay = parameters.get('delay', 1)
+
+    if parameters.get('auto_embed', False) is True:
+        if 'k_history' not in parameters and 'k_tau' not in parameters:
+            k_history, k_tau = auto_embedding(affected_data, 'affected',
+                                              **parameters)
+        if 'l_history' not in parameters and 'l_tau' not in parameters:
+            l_history, l_tau = auto_embedding(causal_data, 'causal',
+                                              **parameters)
+
+    return k_history, k_tau, l_history, l_tau, delay
+
+
+def calc_native_te(calcmethod, affected_data, causal_data, **parameters):
+    """Calculates the transfer entropy from the causal data to the affected
+    data without making use of JIDT.
+
+    Accepts the same parameters and returns the same auxiliary data as
+    transentropy.calc_infodynamics_te, so that it can be used as a drop-in
+    replacement.
+
+    """
+    affected_data, causal_data, embedding = prepare_native_te(
+        calcmethod, affected_data, causal_data, **parameters)
+
+    def estimate(source):
+        dest_next, dest_past, source_past = embed_te(
+            affected_data, source, *embedding)
+        # Convert nats to bits
+        return conditional_mi(calcmethod, source_past, dest_next, dest_past,
+                              **parameters) / np.log(2.)
+
+    transentropy = estimate(causal_data)
+
+    significance = native_significance(estimate, causal_data, transentropy,
+                                       **parameters)
+
+    return transentropy, [significance, native_properties(embedding)]
+
+
+def calc_native_local_te(calcmethod, affected_data, causal_data,
+                         **parameters):
+    """Calculates the local transfer entropy from the causal data to the
+    affected data at every sample without making use of JIDT, see
+    calc_native_te.
+
+    Returns
+    -------
+        local_te : one-dimensional numpy.ndarray
+            Local transfer entropy in bits at every sample of the affected
+            data, which is zero for the samples preceding the first complete
+            embedding.
+        auxdata : list
+            The index of the first local value, followed by the properties
+            in the format of calc_native_te.
+
+    """
+    affected_data, causal_data, embedding = prepare_native_te(
+        calcmethod, affected_data, causal_data, **parameters)
+
+    dest_next, dest_past, source_past = embed_te(
+        affected_data, causal_data, *embedding)
+    firstindex = len(affected_data) - len(dest_next)
+
+    local_te = np.zeros(len(affected_data))
+    # Convert nats to bits
+    local_te[firstindex:] = local_conditional_mi(
+        calcmethod, source_past, dest_next, dest_past,
+        **parameters) / np.log(2.)
+
+    return local_te, [firstindex, native_properties(embedding)]
+
+
+def prepare_native_te(calcmethod, affected_data, causal_data, **parameters):
+    """Checks and converts the signals of a native transfer entropy estimate
+    and resolves its embedding.
+
+    Returns
+    -------
+        affected_data : one-dimensional numpy.ndarray
+        causal_data : one-dimensional numpy.ndarray
+        embedding : list
+            The k_history, k_tau, l_history, l_tau and delay parameters.
+
+    """
+    if calcmethod not in native_estimators:
+        raise NameError("Transfer entropy method name not recognized")
+
+    if (len(causal_data) != len(affected_data)):
+        print("Source length: " + str(len(causal_data)))
+        print("Destination length: " + str(len(affected_data)))
+        raise ValueError(
+            "The source and destination arrays are of different lengths")
+
+    affected_data = np.asarray(affected_data, dtype=float).ravel()
+    causal_data = np.asarray(causal_data, dtype=float).ravel()
+
+    # Add a small amount of noise to break ties between neighbour distances
+    # in the same way as JIDT does for the Kraskov estimators
+    noise_level = parameters.get('noise_level', 1e-8)
+    if noise_level and calcmethod == 'kraskov_native':
+        randstate = np.random.RandomState(parameters.get('noise_seed', 0))
+        affected_data = affected_data + \
+            noise_level * randstate.normal(size=len(affected_data))
+        causal_data = causal_data + \
+            noise_level * randstate.normal(size=len(causal_data))
+
+    if calcmethod == 'kernel_native':
+        # As in JIDT, the kernel estimator only embeds the destination
+        # history, which is set by k
+        embedding = [parameters.get('k', 1), 1, 1, 1, 1]
+    elif calcmethod == 'discrete_native':
+        # Each signal is quantised separately, with the destination history
+        # set as for the JIDT discrete calculator
+        base = parameters.get('base', 2)
+        affected_data = quantise(affected_data, base)
+        causal_data = quantise(causal_data, base)
+        embedding = [parameters.get('destHistoryEmbedLength', 1),
+                     1, 1, 1, 1]
+    else:
+        embedding = setup_native_te(affected_data, causal_data, **parameters)
+
+    return affected_data, causal_data, embedding
+
+
+def local_window_means(cumsums, firstindexes, start, stop):
+    """Averages local transfer entropies over a window from their
+    cumulative sums.
+
+    The window covers the samples from start up to stop, and the average
+    excludes the samples preceding the first complete embedding within the
+    window, in the same way as an estimate over the window data alone.
+
+    Parameters
+    ----------
+        cumsums : numpy.ndarray
+            Cumulative sums of the local values over the last axis, starting
+            with zero, so that the sum over samples a up to b is
+            cumsums[..., b] - cumsums[..., a].
+        firstindexes : numpy.ndarray of int
+            Index of the first local value of each series relative to the
+            start of its window, with the shape of cumsums without the last
+            axis.
+        start : int
+        stop : int
+
+    Returns
+    -------
+        means : numpy.ndarray
+            Window averages with the shape of firstindexes.
+
+    """
+    firstindexes = np.asarray(firstindexes)
+    starts = start + firstindexes.ravel()
+    # Only the two cumulative sums bounding each series are read
+    cumsums = cumsums.reshape(-1, cumsums.shape[-1])
+    series = np.arange(len(starts))
+    sums = cumsums[series, stop] - cumsums[series, starts]
+
+    return (sums / (stop - starts)).reshape(firstindexes.shape)
+
+
+def native_significance(estimate, causal_data, transentropy, **parameters):
+    """Returns the fraction of source permutations that give a transfer
+    entropy estimate at least as large as the observed value, if
+    test_significance is set.
+
+    """
+    if not parameters.get('test_significance', False):
+        return None
+
+    significance_permutations = parameters.get('significance_permutations', 30)
+    randstate = np.random.RandomState(0)
+    permuted = [estimate(randstate.permutation(causal_data))
+                for _ in range(significance_permutations)]
+
+    return np.mean(np.asarray(permuted) >= transentropy)
+
+
+def native_properties(embedding):
+    """Formats the embedding parameters in the same way as the properties
+    returned by JIDT, followed by the number of threads used, which is
+    always one for the native estimators.
+
+    """
+    return [str(value) for value in embedding] + ['1']
+
+
+def calc_native_te_pair(calcmethod, affected_data, causal_data,
+                        **parameters):
+    """Calculates the transfer entropy from the causal data to the affected
+    data (forward) as well as in the opposite direction (backward) in a
+    single pass.
+
+    The embeddings of both signals are built once and shared by both
+    directions. The neighbour search evaluates the distance in each embedded
+    block once per pair of points and reuses it in all joint and marginal
+    spaces of both directions. Both directions are evaluated on the same
+    time indexes, which is the intersection of the time indexes the two
+    separate estimates would use.
+
+    Returns
+    -------
+        transentropies : list
+            Forward and backward transfer entropy in bits.
+        auxdata : list
+            Forward and backward auxiliary data in the format returned by
+            calc_native_te.
+
+    """
+    if calcmethod not in paired_estimators:
+        raise NameError("Transfer entropy method name not recognized")
+
+    if (len(causal_data) != len(affected_data)):
+        print("Source length: " + str(len(causal_data)))
+        print("Destination length: " + str(len(affected_data)))
+        raise ValueError(
+            "The source and destination arrays are of different lengths")
+
+    affected_data = np.asarray(affected_data, dtype=float).ravel()
+    causal_data = np.asarray(causal_data, dtype=float).ravel()
+
+    noise_level = parameters.get('noise_level', 1e-8)
+    if noise_level and calcmethod == 'kraskov_native':
+        randstate = np.random.RandomState(parameters.get('noise_seed', 0))
+        affected_data = affected_data + \
+            noise_level * randstate.normal(size=len(affected_data))
+        causal_data = causal_data + \
+            noise_level * randstate.normal(size=len(causal_data))
+
+    embedding_fwd, embedding_bwd = \
+        setup_native_te_pair(affected_data, causal_data, **parameters)
+
+    nn = parameters.get('kraskov_k', 4)
+
+    # Both directions are evaluated on the time indexes of the embedding
+    # that starts last
+    start = max(embedding_starttime(*embedding_fwd),
+                embedding_starttime(*embedding_bwd))
+
+    # Significance is tested with the single direction estimator, as
+    # permuting the source breaks the pairing of the two directions. It is
+    # evaluated on the same time indexes as the paired estimate.
+    def estimate_fwd(source):
+        dest_next, dest_past, source_past = embed_te(
+            affected_data, source, *embedding_fwd, starttime=start)
+        return conditional_mi(calcmethod, source_past, dest_next, dest_past,
+                              **parameters) / np.log(2.)
+
+    def estimate_bwd(source):
+        dest_next, dest_past, source_past = embed_te(
+            causal_data, source, *embedding_bwd, starttime=start)
+        return conditional_mi(calcmethod, source_past, dest_next, dest_past,
+                              **parameters) / np.log(2.)
+
+    if calcmethod == 'gaussian':
+        # Covariance estimates have no neighbour searches to share
+        te_fwd = estimate_fwd(causal_data)
+        te_bwd = estimate_bwd(affected_data)
+    else:
+        te_fwd, te_bwd = ksg_te_pair(affected_data, causal_data,
+                                     embedding_fwd, embedding_bwd, nn)
+
+    significance_fwd = native_significance(estimate_fwd, causal_data, te_fwd,
+                                           **parameters)
+    significance_bwd = native_significance(estimate_bwd, affected_data,
+                                           te_bwd, **parameters)
+
+    auxdata_fwd = [significance_fwd, native_properties(embedding_fwd)]
+    auxdata_bwd = [significance_bwd, native_properties(embedding_bwd)]
+
+    return [te_fwd, te_bwd], [auxdata_fwd, auxdata_bwd]
+
+
+def setup_native_te_pair(affected_data, causal_data, **parameters):
+    """Resolves the embedding parameters of both directions of a pair.
+
+    With auto_embed set, the Ragwitz search is done only once per signal,
+    since the embedding of a signal does not depend on whether it acts as
+    source or destination.
+
+    """
+    k_history = parameters.get('k_history', 1)
+    k_tau = parameters.get('k_tau', 1)
+    l_history = parameters.get('l_history', 1)
+    l_tau = parameters.get('l_tau', 1)
+    delay = parameters.get('delay', 1)
+
+    embedding_fwd = [k_history, k_tau, l_history, l_tau, delay]
+    embedding_bwd = [k_history, k_tau, l_history, l_tau, delay]
+
+    if parameters.get('auto_embed', False) is True:
+        affected_embedding = auto_embedding(affected_data, 'affected',
+                                            **parameters)
+        causal_embedding = auto_embedding(causal_data, 'causal',
+                                          **parameters)
+        if 'k_history' not in parameters and 'k_tau' not in parameters:
+            embedding_fwd[0:2] = affected_embedding
+            embedding_bwd[0:2] = causal_embedding
+        if 'l_history' not in parameters and 'l_tau' not in parameters:
+            embedding_fwd[2:4] = causal_embedding
+            embedding_bwd[2:4] = affected_embedding
+
+    return embedding_fwd, embedding_bwd
+
+
+def ksg_te_pair(affected_data, causal_data, embedding_fwd, embedding_bwd,
+                nn=4):
+    """Estimates the forward and backward transfer entropy in bits with the
+    KSG estimator, sharing the embedded blocks and neighbour searches between
+    the two directions.
+
+    """
+    start = max(embedding_starttime(*embedding_fwd),
+                embedding_starttime(*embedding_bwd))
+    samples = len(affected_data) - start - 1
+
+    if samples <= 0:
+        raise ValueError("Not enough samples for the requested embedding")
+
+    # Unique embedded blocks, identified by signal, history, tau and the
+    # index of their most recent value
+    blockkeys = []
+
+    def block(signal, history, tau, startindex):
+        key = (signal, history, tau, startindex)
+        if key not in blockkeys:
+            blockkeys.append(key)
+        return blockkeys.index(key)
+
+    def direction_blocks(dest, source, embedding):
+        k_history, k_tau, l_history, l_tau, delay = embedding
+        dest_next = block(dest, 1, 1, start + 1)
+        dest_past = block(dest, k_history, k_tau, start)
+        source_past = block(source, l_history, l_tau, start + 1 - delay)
+        return source_past, dest_next, dest_past
+
+    blocks_fwd = direction_blocks('affected', 'causal', embedding_fwd)
+    blocks_bwd = direction_blocks('causal', 'affected', embedding_bwd)
+
+    signals = {'affected': affected_data, 'causal': causal_data}
+    columns = np.ascontiguousarray(np.hstack([
+        embed_history(signals[signal], history, tau, startindex, samples)
+        for signal, history, tau, startindex in blockkeys]).T)
+    bounds = np.cumsum([0] + [history for _, history, _, _ in blockkeys])
+
+    def space(*blockindexes):
+        membership = np.zeros(len(blockkeys), dtype=np.int64)
+        membership[list(blockindexes)] = 1
+        return membership
+
+    # Joint spaces of both directions
+    jointspaces = np.array([space(*blocks_fwd), space(*blocks_bwd)])
+    radii = multispace_knn_radii(columns, bounds, jointspaces, nn)
+
+    # Marginal spaces (source and past, next and past, past) of both
+    # directions, each searched with the radii of its own direction.
+    # Spaces that coincide between the directions are only combined once.
+    marginalspaces = []
+    marginalradii = []
+    radiispaces = []
+    for direction, (source_past, dest_next, dest_past) in \
+            enumerate([blocks_fwd, blocks_bwd]):
+        for blockset in [set([source_past, dest_past]),
+                         set([dest_next, dest_past]),
+                         set([dest_past])]:
+            if blockset not in marginalspaces:
+                marginalspaces.append(blockset)
+            radiispaces.append(marginalspaces.index(blockset))
+            marginalradii.append(radii[direction])
+    counts = multispace_counts(
+        columns, bounds,
+        np.array([space(*blockset) for blockset in marginalspaces]),
+        np.array(marginalradii), np.array(radiispaces))
+
+    transentropies = []
+    for direction in range(2):
+        n_xz, n_yz, n_z = counts[3 * direction:3 * direction + 3]
+        condmi = digamma(nn) + np.mean(digamma(n_z + 1) -
+                                       digamma(n_xz + 1) -
+                                       digamma(n_yz + 1))
+        # Convert nats to bits
+        transentropies.append(condmi / np.log(2.))
+
+    return transentropies